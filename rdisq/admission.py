@@ -0,0 +1,21 @@
+"""What happens when a task is sent to a queue that's at its depth limit, see AbstractRedisDispatcher.set_queue_limit"""
+
+REJECT_POLICY = "reject"  # raise QueueFullError
+BLOCK_POLICY = "block"  # wait for room, up to the dispatcher's admission_timeout, then raise QueueFullError
+DROP_OLDEST_POLICY = "drop_oldest"  # make room by dropping the task that waited longest, its caller gets QueueFullError
+ADMISSION_POLICIES = frozenset({REJECT_POLICY, BLOCK_POLICY, DROP_OLDEST_POLICY})
+
+
+class QueueFullError(Exception):
+    """The queue is at its depth limit. Callers can map it to HTTP 429 or 503."""
+    queue_name = None
+
+    def __init__(self, queue_name: str, max_depth: int = None):
+        self.queue_name = queue_name
+        self.max_depth = max_depth
+        super().__init__(queue_name, max_depth)
+
+
+def validate_admission_policy(policy: str):
+    if policy not in ADMISSION_POLICIES:
+        raise RuntimeError(f"Unknown admission policy {policy}, must be one of {set(ADMISSION_POLICIES)}")
@@ -0,0 +1,28 @@
+"""Handlers that are called once for many queued tasks, see remote_method(batch_size=...) and set_batch_handler"""
+from typing import *
+
+
+class BatchOptions(NamedTuple):
+    batch_size: int  # most tasks handled in one call
+    max_wait: float = 0  # seconds to wait for more tasks when fewer than batch_size are queued
+
+
+class BatchSizeMismatch(Exception):
+    """A batch handler returned a different number of results than it was given items"""
+
+
+def call_batch(handler: Callable[[List], Iterable], items: List) -> List[Tuple[Any, Optional[Exception]]]:
+    """
+    Call a batch handler with a list of items. It returns a list with a result for each item, in order,
+    where an exception stands for the item having failed.
+
+    :return: The returned value and the raised exception of each item.
+        If the handler itself raised, every item gets its exception.
+    """
+    try:
+        results = list(handler(items))
+        if len(results) != len(items):
+            raise BatchSizeMismatch(f"Batch handler returned {len(results)} results for {len(items)} items")
+    except Exception as ex:
+        return [(None, ex)] * len(items)
+    return [(None, r) if isinstance(r, Exception) else (r, None) for r in results]
@@ -0,0 +1,124 @@
+from typing import *
+from collections import OrderedDict
+import hashlib
+import threading
+import time
+from types import ModuleType
+
+from redis import Redis
+
+from rdisq.serialization import PickleSerializer
+
+CACHE_KEY_PREFIX = "rdisq_cache:"
+
+
+def get_call_digest(serializer: PickleSerializer, args: Tuple, kwargs: Dict) -> str:
+    """
+    A stable hash of a call's serialized arguments, the same in every process.
+    kwargs are sorted so their order doesn't matter, and so are the items of sets and dicts within the arguments,
+    whose pickles otherwise depend on the process' hash seed.
+    """
+    serialized = serializer.dumps(_canonicalize(serializer, (tuple(args), kwargs), set()))
+    return hashlib.sha1(serialized).hexdigest()
+
+
+def _canonicalize(serializer: PickleSerializer, value: Any, path: Set[int]) -> Any:
+    """:return: A value that pickles the same for equal arguments, regardless of set and dict ordering."""
+    if isinstance(value, (str, bytes, int, float, bool, type(None))):
+        return value
+    if id(value) in path:
+        # A reference cycle, the enclosing value already stands for it
+        return "<cycle>"
+    path.add(id(value))
+    try:
+        if isinstance(value, (set, frozenset)):
+            items = sorted((_canonicalize(serializer, v, path) for v in value), key=serializer.dumps)
+            return type(value).__name__, tuple(items)
+        if isinstance(value, dict):
+            items = sorted(((_canonicalize(serializer, k, path), _canonicalize(serializer, v, path))
+                            for k, v in value.items()), key=serializer.dumps)
+            return type(value).__name__, tuple(items)
+        if isinstance(value, (list, tuple)):
+            return type(value).__name__, tuple(_canonicalize(serializer, v, path) for v in value)
+        if hasattr(value, "__dict__") and not callable(value) and not isinstance(value, ModuleType):
+            # e.g messages, whose fields may be sets
+            return type(value).__module__, type(value).__qualname__, _canonicalize(serializer, vars(value), path)
+        return value
+    finally:
+        path.discard(id(value))
+
+
+def get_cache_key(namespace: str, digest: str) -> str:
+    return CACHE_KEY_PREFIX + namespace + ":" + digest
+
+
+class LocalResultCache:
+    """A small in-process LRU of serialized responses, each entry expiring after its own ttl."""
+
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, serialized_response = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return serialized_response
+
+    def put(self, key: str, serialized_response: bytes, ttl: float):
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, serialized_response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard_prefix(self, prefix: str):
+        with self._lock:
+            for key in [k for k in self._entries if k.startswith(prefix)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class ResultCache:
+    """
+    Looks up cached responses of remote calls.
+
+    Responses are written to redis by the service that processed the call (see RequestPayload.cache_key).
+    If a LocalResultCache is given, redis hits are also kept in-process, so hot keys don't need a round trip.
+    """
+
+    def __init__(self, local_cache: LocalResultCache = None):
+        self.local_cache = local_cache
+
+    def get(self, redis_con: Redis, key: str, ttl: float) -> Optional[bytes]:
+        if self.local_cache is not None:
+            serialized_response = self.local_cache.get(key)
+            if serialized_response is not None:
+                return serialized_response
+        serialized_response = redis_con.get(key)
+        if serialized_response is not None and self.local_cache is not None:
+            self.local_cache.put(key, serialized_response, ttl)
+        return serialized_response
+
+    def remember(self, key: str, serialized_response: bytes, ttl: float):
+        """Keep a freshly received response in-process, if there's a local cache."""
+        if self.local_cache is not None:
+            self.local_cache.put(key, serialized_response, ttl)
+
+    def invalidate(self, redis_con: Redis, namespace: str):
+        """Remove all cached responses of a namespace."""
+        keys = list(redis_con.scan_iter(match=get_cache_key(namespace, "*")))
+        if keys:
+            redis_con.delete(*keys)
+        if self.local_cache is not None:
+            self.local_cache.discard_prefix(get_cache_key(namespace, ""))
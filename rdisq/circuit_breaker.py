@@ -0,0 +1,116 @@
+from typing import *
+import threading
+import time
+
+CLOSED = "closed"  # calls go through
+OPEN = "open"  # calls fail fast
+HALF_OPEN = "half_open"  # a few trial calls go through, to tell if the service recovered
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of sending a call to a service that's considered down."""
+
+    def __init__(self, name: str, retry_at: float):
+        self.name = name
+        self.retry_at = retry_at
+        super().__init__(f"Circuit of {name} is open, not sending calls until {time.ctime(retry_at)}")
+
+
+class CircuitBreaker:
+    """
+    Stops sending calls to a service after it failed to answer failure_threshold calls in a row.
+
+    After reset_timeout seconds, up to probes trial calls are let through.
+    If they're all answered the circuit closes again, if one of them isn't it opens for another reset_timeout.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 10, probes: int = 1,
+                 live_check_interval: float = 1):
+        """:param live_check_interval: Seconds between checks of whether the service has any live workers."""
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.probes = probes
+        self.live_check_interval = live_check_interval
+        self.state = CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._half_opened_at = 0.0
+        self._probes_sent = 0
+        self._probes_answered = 0
+        self._last_live_check = 0.0
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """Raises CircuitOpenError if the call shouldn't be sent."""
+        with self._lock:
+            now = time.time()
+            if self.state == OPEN:
+                if now - self._opened_at < self.reset_timeout:
+                    raise CircuitOpenError(self.name, self._opened_at + self.reset_timeout)
+                self.__half_open(now)
+            if self.state == HALF_OPEN:
+                if self._probes_sent >= self.probes:
+                    if now - self._half_opened_at < self.reset_timeout:
+                        raise CircuitOpenError(self.name, self._half_opened_at + self.reset_timeout)
+                    # Nobody waited for the trial calls, so it's still unknown whether the service recovered
+                    self.__half_open(now)
+                self._probes_sent += 1
+
+    def on_success(self):
+        with self._lock:
+            self._consecutive_failures = 0
+            if self.state == HALF_OPEN:
+                self._probes_answered += 1
+                if self._probes_answered >= self.probes:
+                    self.state = CLOSED
+
+    def on_failure(self):
+        with self._lock:
+            self._consecutive_failures += 1
+            if self.state == HALF_OPEN or self._consecutive_failures >= self.failure_threshold:
+                self.__open()
+
+    def trip(self):
+        """Open the circuit right away, e.g when the service is known to have no live workers."""
+        with self._lock:
+            self.__open()
+
+    def should_check_live(self) -> bool:
+        """:return: Whether it's time to check again if the service has live workers."""
+        with self._lock:
+            now = time.time()
+            if now - self._last_live_check < self.live_check_interval:
+                return False
+            self._last_live_check = now
+            return True
+
+    def __half_open(self, now: float):
+        self.state = HALF_OPEN
+        self._half_opened_at = now
+        self._probes_sent = self._probes_answered = 0
+
+    def __open(self):
+        self.state = OPEN
+        self._opened_at = time.time()
+        self._probes_sent = self._probes_answered = 0
+
+
+class CircuitBreakers:
+    """The circuit breakers of a dispatcher, one for each queue, all with the same settings."""
+
+    def __init__(self, **breaker_kwargs):
+        self.breaker_kwargs = breaker_kwargs
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    def get(self, name: str) -> CircuitBreaker:
+        with self._lock:
+            breaker = self._breakers.get(name)
+            if breaker is None:
+                breaker = self._breakers[name] = CircuitBreaker(name, **self.breaker_kwargs)
+            return breaker
+
+    def get_states(self) -> Dict[str, str]:
+        with self._lock:
+            return {name: breaker.state for name, breaker in self._breakers.items()}
@@ -4,3 +4,5 @@ RECEIVER_SERVICE_NAME = "ReceiverService"
 QueueName = NewType("QueueName", str)  # names of redis keys that are used as message queues
 ServiceUid = NewType("ServiceUid", str)  # uids of rdisq instances
 RdisqSessionUid = NewType("RdisqSessionUid", str)  # uids of rdisq sessions
+# Shortest timeout for blocking pops. The server rounds shorter ones down to 0, which means waiting forever
+MIN_BLOCKING_TIMEOUT = 0.01
@@ -1,12 +1,16 @@
 __author__ = 'smackware'
 
 from typing import *
+from collections import deque
+from itertools import islice
+import time
 from .payload import RequestPayload
 
 from .identification import generate_task_id
 from .identification import get_request_key
 
-from .response import RdisqResponse
+from .response import RdisqResponse, wait_any
+from .hedging import HedgingPolicy, HedgedResponse
 
 if TYPE_CHECKING:
     from .service import RdisqService
@@ -15,9 +19,17 @@ if TYPE_CHECKING:
 class AbstractRdisqConsumer(object):
     service_class: "RdisqService"
 
-    def __init__(self, service_class):
+    def __init__(self, service_class, hedging: HedgingPolicy = None, admission_policy: str = None):
+        """
+        :param hedging: If given, calls that aren't answered within the policy's delay are sent again,
+            and the first reply is used. Only for services whose methods are idempotent.
+        :param admission_policy: What to do when a method's queue is at its depth limit, see rdisq.admission.
+            Defaults to the dispatcher's.
+        """
         self.__queue_to_callable = None
         self.service_class: RdisqService = service_class
+        self.hedging = hedging
+        self.admission_policy = admission_policy
         self.__setup_stub_methods_for_consumer()
 
     def __setup_stub_methods_for_consumer(self):
@@ -33,10 +45,150 @@ class AbstractRdisqConsumer(object):
     def send(self, method_name, *args, **kwargs):
         timeout = kwargs.pop("timeout", self.service_class.response_timeout)
         uid = kwargs.pop("rdisq_uid", None)
+        send_at = kwargs.pop("rdisq_send_at", None)
+        no_reply = kwargs.pop("rdisq_no_reply", False)
         method_queue_name = self.service_class.get_queue_name_for_method(method_name, uid)
+        dispatcher = self.service_class.redis_dispatcher
 
-        return self.service_class.redis_dispatcher.queue_task(
-            method_queue_name, *args, timeout=timeout, **kwargs)
+        call = self.__queue_to_callable.get(method_name)
+        if getattr(call, "batch_options", None) is not None and (len(args) != 1 or kwargs):
+            raise TypeError(f"{method_name} is a batch handler, its calls take a single argument")
+        namespace = self.service_class.get_queue_name_for_method(method_name)
+        cache_ttl = getattr(call, "cache_ttl", None)
+        cache_key = None
+        if cache_ttl and not no_reply:
+            cache_key = dispatcher.get_cache_key(namespace, args, kwargs)
+            cached_response = dispatcher.get_cached_response(cache_key, cache_ttl)
+            if cached_response is not None:
+                return cached_response
+        breaker = dispatcher.get_circuit_breaker(method_queue_name)
+        if breaker is not None and uid is None and breaker.should_check_live() and not self.service_class.count_uids():
+            # No instance of the service is processing, so the call would only time out
+            breaker.trip()
+        if send_at is None:
+            dispatcher.check_rate_limit(namespace, getattr(call, "rate_limit", None))
+        coalesce_key = None
+        if getattr(call, "coalesce", False) and not no_reply:
+            coalesce_key = dispatcher.get_coalesce_key(method_queue_name, args, kwargs)
+
+        response = dispatcher.queue_task(
+            method_queue_name, *args, timeout=timeout, cache_key=cache_key, cache_ttl=cache_ttl,
+            coalesce_key=coalesce_key, admission_policy=self.admission_policy, send_at=send_at,
+            no_reply=no_reply, **kwargs)
+        if self.hedging is not None and uid is None and send_at is None and not no_reply:
+            # The broadcast queue is shared by all instances, the one that's stuck on the first send won't take this
+            response = HedgedResponse(
+                response, lambda: dispatcher.queue_task(method_queue_name, *args, timeout=timeout, cache_key=cache_key,
+                                                        cache_ttl=cache_ttl, admission_policy=self.admission_policy,
+                                                        **kwargs),
+                self.hedging, method_name)
+        return response
+
+    def send_no_reply(self, method_name, *args, **kwargs) -> None:
+        """Call a remote method as fire and forget. The service sends no response, see queue_task(no_reply=True)."""
+        self.send(method_name, *args, rdisq_no_reply=True, **kwargs)
+
+    def send_at(self, send_at: float, method_name, *args, **kwargs) -> RdisqResponse:
+        """Call a remote method, but not before send_at (unix time). Returns the response without waiting for it."""
+        return self.send(method_name, *args, rdisq_send_at=send_at, **kwargs)
+
+    def send_after(self, seconds: float, method_name, *args, **kwargs) -> RdisqResponse:
+        """Call a remote method, but not in the next seconds. Returns the response without waiting for it."""
+        return self.send_at(time.time() + seconds, method_name, *args, **kwargs)
+
+    def map(self, method_name, iterable: Iterable, chunksize: int = 1, max_in_flight: int = 100,
+            timeout: float = None) -> List:
+        """Like imap, returns the list of results."""
+        return list(self.imap(method_name, iterable, chunksize, max_in_flight, timeout))
+
+    def imap(self, method_name, iterable: Iterable, chunksize: int = 1, max_in_flight: int = 100,
+             timeout: float = None) -> Iterator:
+        """
+        Call a remote method with each item of iterable, across the instances of the service, like Pool.imap.
+        The iterable is consumed lazily, keeping up to max_in_flight tasks outstanding.
+        Results are yielded in order; a failed call raises its exception when its result is reached.
+
+        :param chunksize: Items sent together in a single task. Items are sent one by one, like send does,
+            to batch handlers, rate limited, cached or coalesced methods, and by consumers that hedge.
+        :param timeout: Seconds to wait for each task's response, and for the task to be taken.
+            Defaults to the service's response_timeout.
+        """
+        in_flight: Deque[Tuple[RdisqResponse, bool]] = deque()
+        try:
+            for _ in self.__send_for_map(method_name, iterable, chunksize, max_in_flight, timeout, in_flight):
+                response, chunked = in_flight.popleft()
+                result = response.wait(timeout)
+                if chunked:
+                    yield from result
+                else:
+                    yield result
+        finally:
+            self.__cancel_all(in_flight)
+
+    def imap_unordered(self, method_name, iterable: Iterable, chunksize: int = 1, max_in_flight: int = 100,
+                       timeout: float = None) -> Iterator:
+        """Like imap, but results are yielded as they arrive."""
+        in_flight: Deque[Tuple[RdisqResponse, bool]] = deque()
+        try:
+            for _ in self.__send_for_map(method_name, iterable, chunksize, max_in_flight, timeout, in_flight):
+                response = wait_any([r for r, _ in in_flight], timeout)
+                answered = next(a for a in in_flight if a[0] is response)
+                in_flight.remove(answered)
+                chunked = answered[1]
+                if chunked:
+                    yield from response.wait()
+                else:
+                    yield response.wait()
+        finally:
+            self.__cancel_all(in_flight)
+
+    def __send_for_map(self, method_name, iterable: Iterable, chunksize: int, max_in_flight: int,
+                       timeout: Optional[float], in_flight: Deque[Tuple[RdisqResponse, bool]]) -> Iterator[None]:
+        """Keep up to max_in_flight tasks in in_flight, yielding whenever there's a response to take from it."""
+        call = self.__queue_to_callable.get(method_name)
+        if call is None:
+            raise AttributeError(f"{self.service_class.get_service_name()} has no remote method {method_name}")
+        # A chunk is a single task, the per-call options of send can't apply to its items
+        chunked = chunksize > 1 and self.hedging is None and not any(
+            getattr(call, option, None) for option in ["batch_options", "rate_limit", "cache_ttl", "coalesce"])
+        dispatcher = self.service_class.redis_dispatcher
+        queue_name = self.service_class.get_queue_name_for_method(method_name)
+        timeout = timeout or self.service_class.response_timeout
+        items = iter(iterable)
+        while True:
+            while len(in_flight) < max_in_flight:
+                chunk = list(islice(items, chunksize if chunked else 1))
+                if not chunk:
+                    break
+                if chunked:
+                    response = dispatcher.queue_task(queue_name, chunk, timeout=timeout,
+                                                     admission_policy=self.admission_policy, chunk=True)
+                else:
+                    response = self.send(method_name, chunk[0], timeout=timeout)
+                in_flight.append((response, chunked))
+            if not in_flight:
+                return
+            yield None
+
+    @staticmethod
+    def __cancel_all(in_flight: Deque[Tuple[RdisqResponse, bool]]):
+        # The caller stopped iterating, nobody will take these
+        for response, _ in in_flight:
+            response.cancel()
+
+    def invalidate_cache(self, method_name):
+        """Drop all cached results of a remote method."""
+        dispatcher = self.service_class.redis_dispatcher
+        dispatcher.result_cache.invalidate(
+            dispatcher.get_redis(), self.service_class.get_queue_name_for_method(method_name))
+
+    def get_rate_limit_wait(self, method_name) -> float:
+        """:return: Seconds until the method's rate limit allows a call, 0 if it allows one now or has no limit."""
+        rate_limit = getattr(self.__queue_to_callable.get(method_name), "rate_limit", None)
+        if rate_limit is None:
+            return 0
+        return self.service_class.redis_dispatcher.get_rate_limit_wait(
+            self.service_class.get_queue_name_for_method(method_name), rate_limit)
 
     def get_stub_method(self, method_name):
         raise NotImplementedError()
@@ -0,0 +1,34 @@
+"""The deadline of the call being handled, so calls made from inside a handler don't outlive their caller."""
+from typing import *
+from contextlib import contextmanager
+import threading
+
+_current = threading.local()
+
+EXPIRED = "expired"  # the deadline passed while the task waited in its queue
+UNMEETABLE = "unmeetable"  # the deadline would pass before the handler, at its recent latency, would finish
+
+
+class RdisqDeadlineExceeded(Exception):
+    task_id = None
+
+    def __init__(self, task_id, deadline: float = None):
+        self.task_id = task_id
+        self.deadline = deadline
+        super().__init__(task_id, deadline)
+
+
+def get_current_deadline() -> Optional[float]:
+    """:return: The deadline of the call the current thread is handling, or None if it isn't handling one."""
+    return getattr(_current, "deadline", None)
+
+
+@contextmanager
+def deadline_scope(deadline: Optional[float]):
+    """Calls sent inside the scope have a deadline no later than this one."""
+    previous = get_current_deadline()
+    _current.deadline = deadline if previous is None or deadline is None else min(previous, deadline)
+    try:
+        yield
+    finally:
+        _current.deadline = previous
@@ -0,0 +1,148 @@
+from typing import *
+from collections import deque, defaultdict
+import math
+import threading
+import time
+
+from rdisq.consts import MIN_BLOCKING_TIMEOUT
+from rdisq.response import RdisqResponse, RdisqResponseTimeout, _pop
+
+
+class HedgeStats(NamedTuple):
+    requests: int = 0
+    hedged: int = 0  # requests that were sent a second time
+    hedge_wins: int = 0  # hedged requests that were answered by the second send first
+
+    @property
+    def hedge_rate(self) -> float:
+        return self.hedged / self.requests if self.requests else 0.0
+
+
+class HedgingPolicy:
+    """
+    Decides when an unanswered request is sent again, and keeps statistics of it.
+
+    The delay is a percentile of the recent reply latencies of the same kind of call, so only the slowest calls
+    are hedged. Only use it for idempotent calls, as both sends may end up being handled.
+    """
+
+    def __init__(self, percentile: float = 95, window: int = 200, min_samples: int = 20,
+                 initial_delay: float = None, min_delay: float = MIN_BLOCKING_TIMEOUT):
+        """
+        :param percentile: Hedge calls that weren't answered by this percentile of the recent latencies.
+        :param window: How many recent latencies are kept for each kind of call.
+        :param min_samples: Until this many latencies are known, initial_delay is used.
+        :param initial_delay: Seconds. None means not hedging until enough latencies are known.
+        :param min_delay: Seconds, a lower bound of the delay. Shorter waits than the default can't block on the server.
+        """
+        self.percentile = percentile
+        self.window = window
+        self.min_samples = min_samples
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self._latencies: Dict[str, Deque[float]] = defaultdict(lambda: deque(maxlen=self.window))
+        self._stats: Dict[str, HedgeStats] = defaultdict(HedgeStats)
+        self._lock = threading.Lock()
+
+    def get_delay(self, name: str) -> Optional[float]:
+        """:return: Seconds to wait for a reply before hedging, or None not to hedge."""
+        with self._lock:
+            latencies = sorted(self._latencies[name])
+        if len(latencies) < self.min_samples:
+            delay = self.initial_delay
+        else:
+            delay = latencies[min(len(latencies) - 1, math.ceil(len(latencies) * self.percentile / 100) - 1)]
+        return None if delay is None else max(delay, self.min_delay)
+
+    def observe(self, name: str, latency_seconds: float, hedged: bool, hedge_won: bool):
+        with self._lock:
+            self._latencies[name].append(latency_seconds)
+            requests, hedged_count, hedge_wins = self._stats[name]
+            self._stats[name] = HedgeStats(requests + 1, hedged_count + hedged, hedge_wins + hedge_won)
+
+    def get_stats(self) -> Dict[str, HedgeStats]:
+        with self._lock:
+            return dict(self._stats)
+
+    def clear(self):
+        with self._lock:
+            self._latencies.clear()
+            self._stats.clear()
+
+
+class HedgedResponse(RdisqResponse):
+    """
+    A response that, if not answered within its policy's delay, sends the request again and takes the first reply.
+    The losing send is cancelled, so it's skipped if it wasn't picked up yet.
+    """
+
+    def __init__(self, primary: RdisqResponse, send_hedge: Callable[[], Optional[RdisqResponse]],
+                 policy: HedgingPolicy, name: str):
+        """
+        :param send_hedge: Sends the request again, returns its response. May return None if there's nowhere to send.
+        :param name: The kind of call, latencies are tracked separately for each.
+        """
+        super().__init__(primary.task_id, primary.rdisq_consumer, primary.dispatcher)
+        self.called_at_unixtime = primary.called_at_unixtime
+        self.cache_key, self.cache_ttl = primary.cache_key, primary.cache_ttl
+        self.queue_name = primary.queue_name
+        self.send_at = primary.send_at
+        self.primary = primary
+        self.hedge: Optional[RdisqResponse] = None
+        self.policy = policy
+        self.name = name
+        self._send_hedge = send_hedge
+
+    def is_processed(self):
+        return self.response_payload is not None or any(r.is_processed() for r in self.__get_sent())
+
+    def wait(self, timeout=None, cancel_on_timeout: bool = None):
+        if self.response_payload is not None or self.cancelled:
+            return super().wait()
+        if not timeout:
+            timeout = self.get_default_timeout()
+        deadline = time.time() + timeout
+        delay = self.policy.get_delay(self.name)
+        if self.hedge is None and delay is not None:
+            hedge_at = min(self.called_at_unixtime + delay, deadline)
+            redis_response = self.__pop([self.primary], hedge_at - time.time())
+            if redis_response is None and time.time() < deadline:
+                self.hedge = self._send_hedge()
+        else:
+            redis_response = None
+        if redis_response is None:
+            redis_response = self.__pop(self.__get_sent(), deadline - time.time())
+        if redis_response is None:
+            self._on_timeout(cancel_on_timeout)
+            raise RdisqResponseTimeout(self.task_id)
+
+        reply_key, response = redis_response
+        self._on_reply(reply_key.decode(), response)
+        return super().wait()
+
+    def _get_reply_keys(self) -> List[str]:
+        """Waiting on these doesn't send the hedge, only wait() does."""
+        return [r.task_id for r in self.__get_sent()]
+
+    def _on_reply(self, reply_key: str, response: bytes):
+        winner = self.hedge if self.hedge is not None and reply_key == self.hedge.task_id else self.primary
+        winner._on_reply(reply_key, response)
+        for loser in self.__get_sent():
+            if loser is not winner:
+                loser.cancel()
+        self.response_payload = winner.response_payload
+        self.total_time_seconds = time.time() - self.called_at_unixtime
+        self.policy.observe(self.name, winner.total_time_seconds,
+                            hedged=self.hedge is not None, hedge_won=winner is self.hedge)
+
+    def cancel(self) -> bool:
+        if self.response_payload is not None:
+            return False
+        self.cancelled = True
+        return any([r.cancel() for r in self.__get_sent()])
+
+    def __get_sent(self) -> List[RdisqResponse]:
+        return [self.primary] if self.hedge is None else [self.primary, self.hedge]
+
+    def __pop(self, responses: List[RdisqResponse], timeout: float):
+        return _pop(self.redis_con, [r.task_id for r in responses], timeout)
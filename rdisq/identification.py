@@ -3,6 +3,16 @@ __author__ = 'smackware'
 import os
 import uuid
 
+WAITERS_KEY_PREFIX = "waiters_"
+DEADLINE_SEPARATOR = "@"
+IN_FLIGHT_KEY_PREFIX = "rdisq_in_flight:"
+COALESCED_CALL_KEY_PREFIX = "rdisq_coalesced:"
+RECEIVER_INDEX_KEY_PREFIX = "rdisq_receivers:"
+LIVE_RECEIVERS_KEY = RECEIVER_INDEX_KEY_PREFIX + "live"
+RATE_LIMIT_KEY_PREFIX = "rdisq_rate_limit:"
+DELAYED_QUEUE_KEY_PREFIX = "rdisq_delayed:"
+STREAM_ACK_KEY_PREFIX = "rdisq_stream_ack:"
+
 
 def get_mac():
     return uuid.getnode()
@@ -16,7 +26,79 @@ def get_request_key(task_id):
     return "request_%s" % (task_id, )
 
 
-def generate_task_id():
-    return "%s-%s" % (get_consumer_id(), uuid.uuid4().hex, )
+def get_waiters_key(task_id):
+    return WAITERS_KEY_PREFIX + task_id
+
+
+def get_in_flight_key(namespace, call_digest):
+    return IN_FLIGHT_KEY_PREFIX + namespace + ":" + call_digest
+
+
+def get_coalesced_call_key(task_id):
+    """The in-flight key of the coalesced call a task leads, see JOIN_IN_FLIGHT"""
+    return COALESCED_CALL_KEY_PREFIX + task_id
+
+
+def get_delayed_queue_key(queue_name):
+    """A sorted set of the tasks to be moved to the queue later, scored by when they're due"""
+    return DELAYED_QUEUE_KEY_PREFIX + queue_name
+
+
+def get_stream_ack_key(task_id):
+    """A list the caller pushes to as it reads a streamed response, see rdisq.stream"""
+    return STREAM_ACK_KEY_PREFIX + task_id
+
+
+def get_rate_limit_key(name):
+    return RATE_LIMIT_KEY_PREFIX + name
+
+
+# Tag values of other types may be equal while their reprs differ, or the other way around
+INDEXED_TAG_VALUE_TYPES = (str, int, float, bool, type(None))
+
+
+def is_indexed_tag_value(value):
+    return type(value) in INDEXED_TAG_VALUE_TYPES
+
+
+def normalize_tag_value(value):
+    """Equal values are indexed the same, e.g. True, 1 and 1.0 are all indexed as 1"""
+    if isinstance(value, bool) or isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def get_receiver_tag_index_key(tag, value):
+    return "%stag:%s=%r" % (RECEIVER_INDEX_KEY_PREFIX, tag, normalize_tag_value(value), )
+
+
+def get_receiver_message_index_key(message_class_id):
+    return "%smessage:%s" % (RECEIVER_INDEX_KEY_PREFIX, message_class_id, )
+
+
+def get_receiver_queue_index_key(queue_name):
+    return "%squeue:%s" % (RECEIVER_INDEX_KEY_PREFIX, queue_name, )
+
+
+def get_receiver_indexes_key(uid):
+    return "%sindexes:%s" % (RECEIVER_INDEX_KEY_PREFIX, uid, )
+
+
+def generate_task_id(deadline=None):
+    """Task ids carry their deadline, so workers can drop expired tasks without fetching them"""
+    task_id = "%s-%s" % (get_consumer_id(), uuid.uuid4().hex, )
+    if deadline is not None:
+        task_id += "%s%.3f" % (DEADLINE_SEPARATOR, deadline, )
+    return task_id
+
+
+def get_task_deadline(task_id):
+    _, separator, deadline = task_id.rpartition(DEADLINE_SEPARATOR)
+    if not separator:
+        return None
+    try:
+        return float(deadline)
+    except ValueError:
+        return None
 
 
@@ -0,0 +1,26 @@
+from typing import *
+import math
+
+
+class ServiceLoad(NamedTuple):
+    """How busy a service instance is, as published with its heartbeat."""
+    in_flight: int = 0  # calls being handled right now
+    latency_ewma: Optional[float] = None  # seconds, recent handler latency. None until a call was handled
+    queue_depth: int = 0  # tasks waiting in the queues only this instance listens to
+
+
+def get_expected_wait(load: ServiceLoad) -> float:
+    """
+    :return: Roughly how long a new call would take on an instance with this load, in seconds.
+        Infinite for an instance that has work, but hasn't finished a call yet to tell how fast it is.
+    """
+    if load.latency_ewma is None:
+        return 0 if load.in_flight + load.queue_depth == 0 else math.inf
+    return (load.in_flight + load.queue_depth + 1) * load.latency_ewma
+
+
+def get_load_score(load: Optional[ServiceLoad]) -> Tuple[float, int]:
+    """:return: A sort key, lower is less loaded. Instances with unknown load come last."""
+    if load is None:
+        return math.inf, 0
+    return get_expected_wait(load), load.in_flight + load.queue_depth
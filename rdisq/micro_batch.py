@@ -0,0 +1,81 @@
+"""Buffering of small operations from many threads, so they're sent to redis together. See enable_micro_batching"""
+from typing import *
+import threading
+import time
+
+T = TypeVar("T")
+
+
+class MicroBatcher(Generic[T]):
+    """
+    Collects items added from any thread, and hands them to flush in batches, from a thread of its own.
+    A batch is flushed once it has max_size items, or max_delay seconds after its first item was added.
+    If flush raises, on_error is called with the batch and the exception, and later batches are still flushed.
+    """
+
+    def __init__(self, flush: Callable[[List[T]], None], max_size: int = 64, max_delay: float = 0.0005,
+                 on_error: Callable[[List[T], Exception], None] = None):
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self._flush = flush
+        self._on_error = on_error
+        self._items: List[T] = []
+        self._first_added_at = 0.0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    def add(self, item: T):
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Adding to a closed micro batcher")
+            if not self._items:
+                self._first_added_at = time.time()
+            self._items.append(item)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.__run, name="rdisq-micro-batcher", daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def flush(self):
+        """Flush the pending items now, from the calling thread."""
+        with self._condition:
+            items, self._items = self._items, []
+        if items:
+            self.__flush(items)
+
+    def close(self):
+        """Flush the pending items and stop the flushing thread."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+        self.flush()
+
+    def __run(self):
+        while True:
+            with self._condition:
+                while not self._items and not self._closed:
+                    self._condition.wait()
+                if not self._items:
+                    return
+                while len(self._items) < self.max_size and not self._closed:
+                    remaining = self._first_added_at + self.max_delay - time.time()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                items = self._items[:self.max_size]
+                del self._items[:self.max_size]
+                if self._items:
+                    self._first_added_at = time.time()
+            self.__flush(items)
+
+    def __flush(self, items: List[T]):
+        try:
+            self._flush(items)
+        except Exception as ex:
+            if self._on_error is None:
+                raise
+            self._on_error(items, ex)
@@ -2,12 +2,23 @@ __author__ = 'smackware'
 
 from typing import *
 
-from collections import namedtuple
-
 if TYPE_CHECKING:
     from rdisq.consts import ServiceUid
 
-RequestPayload = namedtuple("RequestPayload", "task_id timeout args kwargs")
+
+class RequestPayload(NamedTuple):
+    task_id: str
+    timeout: int
+    args: Tuple
+    kwargs: Dict
+    enqueued_at: float = None
+    cache_key: str = None  # if set, a successful response is cached under this key for cache_ttl seconds
+    cache_ttl: int = None
+    coalesce_key: str = None  # if set, identical calls attached to this task get its response too
+    deadline: float = None  # unix time, after which the caller no longer waits for the response
+    chunk: bool = False  # args[0] is a list of items, the method is called with each and returns the list of results
+    no_reply: bool = False  # nobody waits for the response, so none is sent
+
 
 class SessionResult(NamedTuple):
     result: Any
@@ -19,3 +30,8 @@ class ResponsePayload(NamedTuple):
     processing_time_seconds: float
     service_uid: "ServiceUid"
     session_data: Dict = None
+    chunk_count: int = None  # for generator handlers, how many StreamChunks were sent ahead of this, see rdisq.stream
+
+
+class StreamChunk(NamedTuple):
+    value: Any  # a value yielded by a generator handler
@@ -0,0 +1,40 @@
+"""Limits on how often a remote method or a message is handled, shared by all the workers handling it."""
+from typing import *
+
+from rdisq.identification import get_rate_limit_key
+from rdisq.scripts import run_script, TAKE_TOKENS
+
+if TYPE_CHECKING:
+    from redis import Redis
+
+
+class RateLimit(NamedTuple):
+    """A token bucket: rate calls per second on average, with bursts of up to burst calls after an idle period."""
+    rate: float
+    burst: int = 1
+
+
+class RateLimitExceeded(Exception):
+    """Raised instead of sending a call whose rate limit is used up, see AbstractRedisDispatcher.check_rate_limits"""
+
+    def __init__(self, name: str, retry_after: float):
+        self.name = name
+        self.retry_after = retry_after
+        super().__init__(f"Rate limit of {name} is used up, retry in {retry_after:.3f}s")
+
+
+def take_token(redis_con: "Redis", name: str, rate_limit: RateLimit) -> float:
+    """
+    Take a call from the rate limit.
+
+    :param name: Calls with the same name share the limit.
+    :return: 0 if the call may be made now, otherwise how many seconds until it may.
+    """
+    return float(run_script(redis_con, TAKE_TOKENS, [get_rate_limit_key(name)],
+                            [rate_limit.rate, rate_limit.burst, 1]))
+
+
+def get_rate_limit_wait(redis_con: "Redis", name: str, rate_limit: RateLimit) -> float:
+    """:return: Like take_token, without taking the call."""
+    return float(run_script(redis_con, TAKE_TOKENS, [get_rate_limit_key(name)],
+                            [rate_limit.rate, rate_limit.burst, 0]))
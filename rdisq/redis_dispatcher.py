@@ -1,24 +1,91 @@
 __author__ = 'smackware'
 
-from typing import ClassVar
+import math
+import time
+from typing import *
 
 from redis import Redis
 from redis import ConnectionPool
+from redis.exceptions import RedisError
 
-from rdisq.identification import generate_task_id, get_request_key
-from rdisq.payload import RequestPayload
+from rdisq.cache import ResultCache, LocalResultCache, get_call_digest, get_cache_key
+from rdisq.circuit_breaker import CircuitBreakers, CircuitBreaker
+from rdisq.deadline import get_current_deadline, RdisqDeadlineExceeded
+from rdisq.admission import (QueueFullError, validate_admission_policy, REJECT_POLICY, BLOCK_POLICY,
+                             DROP_OLDEST_POLICY)
+from rdisq.identification import (generate_task_id, get_request_key, get_in_flight_key, get_waiters_key,
+                                  get_delayed_queue_key, get_coalesced_call_key, WAITERS_KEY_PREFIX,
+                                  COALESCED_CALL_KEY_PREFIX)
+from rdisq.payload import RequestPayload, ResponsePayload
 from rdisq.response import RdisqResponse
+from rdisq.rate_limit import RateLimit, RateLimitExceeded, get_rate_limit_wait
+from rdisq.micro_batch import MicroBatcher
 
+from rdisq.scripts import run_script, JOIN_IN_FLIGHT, RELEASE_IN_FLIGHT, ENQUEUE, SCHEDULE_TASK
 from rdisq.serialization import PickleSerializer
 
 
+class _BufferedTask(NamedTuple):
+    queue_name: str
+    task_id: str
+    serialized_request: bytes
+    timeout: int
+    admission_policy: str
+    response: RdisqResponse
+
+
 class AbstractRedisDispatcher(object):
     default_call_timeout = 10
     DEFAULT_REQUEST_TIMEOUT = 500
     serializer: ClassVar[PickleSerializer] = PickleSerializer()
+    result_cache: ResultCache
+    circuit_breakers: Optional[CircuitBreakers] = None
+    cancel_on_timeout = False  # cancel tasks whose responses timed out, see RdisqResponse.cancel
+    QUEUE_LIMITS_REDIS_HASH = "rdisq_queue_limits"  # queue -> how many tasks may wait in it
+    ADMISSION_RETRY_DELAY = 0.01  # seconds, first wait for room in a full queue under the block policy
+    ADMISSION_MAX_RETRY_DELAY = 0.5
+    admission_policy = REJECT_POLICY  # what to do when sending to a full queue, see rdisq.admission
+    admission_timeout = 5  # seconds to wait for room in a full queue under the block policy
+    check_rate_limits = False  # raise RateLimitExceeded instead of sending calls whose rate limit is used up
+    micro_batcher: Optional[MicroBatcher[_BufferedTask]] = None
 
     def __init__(self, *args, **kwargs):
-        pass
+        self.result_cache = ResultCache()
+
+    def enable_local_cache(self, max_size: int = 1024):
+        """Keep cached responses in-process too, so hot keys are served without a redis round trip."""
+        self.result_cache.local_cache = LocalResultCache(max_size)
+
+    def enable_circuit_breaker(self, failure_threshold: int = 5, reset_timeout: float = 10, probes: int = 1,
+                               live_check_interval: float = 1):
+        """
+        Fail fast, with CircuitOpenError, when sending to a queue whose calls keep timing out.
+        See rdisq.circuit_breaker.CircuitBreaker for the parameters.
+        """
+        self.circuit_breakers = CircuitBreakers(failure_threshold=failure_threshold, reset_timeout=reset_timeout,
+                                                probes=probes, live_check_interval=live_check_interval)
+
+    def get_circuit_breaker(self, queue_name: str) -> Optional[CircuitBreaker]:
+        """:return: The circuit breaker of the queue, or None if circuit breakers aren't enabled."""
+        if self.circuit_breakers is None:
+            return None
+        return self.circuit_breakers.get(queue_name)
+
+    def enable_micro_batching(self, max_size: int = 64, max_delay: float = 0.0005):
+        """
+        Buffer the tasks queued from all threads, and queue them in a single pipeline once max_size are buffered,
+        or max_delay seconds after the first. queue_task returns without waiting for redis, and a task rejected
+        by its queue's depth limit gets QueueFullError as its response.
+        Coalesced, delayed, and block-admission calls are queued right away.
+        """
+        self.disable_micro_batching()
+        self.micro_batcher = MicroBatcher(self.__enqueue_buffered, max_size, max_delay, self.__fail_buffered)
+
+    def disable_micro_batching(self):
+        """Queue the buffered tasks, and stop buffering."""
+        if self.micro_batcher is not None:
+            self.micro_batcher.close()
+            self.micro_batcher = None
 
     def get_redis(self, *args, **kwargs) -> Redis:
         """
@@ -26,24 +93,227 @@ class AbstractRedisDispatcher(object):
         """
         raise NotImplementedError("Must implement get_redis(self) method of Rdisq subclass")
 
-    def queue_task(self, queue_name: str, *task_args, timeout=None, **task_kwargs):
+    def get_cache_key(self, namespace: str, args: Tuple, kwargs: Dict) -> str:
+        return get_cache_key(namespace, get_call_digest(self.serializer, args, kwargs))
+
+    def get_coalesce_key(self, namespace: str, args: Tuple, kwargs: Dict) -> str:
+        return get_in_flight_key(namespace, get_call_digest(self.serializer, args, kwargs))
+
+    def get_cached_response(self, cache_key: str, cache_ttl: float) -> Optional[RdisqResponse]:
+        """:return: An already-processed response if the call's result is cached, None otherwise."""
+        serialized_response = self.result_cache.get(self.get_redis(), cache_key, cache_ttl)
+        if serialized_response is None:
+            return None
+        return RdisqResponse(cache_key, dispatcher=self,
+                             response_payload=self.serializer.loads(serialized_response))
+
+    def queue_task(self, queue_name: str, *task_args, timeout=None, cache_key: str = None, cache_ttl: int = None,
+                   coalesce_key: str = None, admission_policy: str = None, send_at: float = None, chunk: bool = False,
+                   no_reply: bool = False, **task_kwargs):
+        """
+        :param admission_policy: What to do if the queue is at its depth limit, see rdisq.admission.
+            Defaults to the dispatcher's admission_policy. Delayed tasks aren't limited.
+        :param cache_key: If given (with cache_ttl), the service will cache a successful result under this key.
+        :param coalesce_key: If given, and an identical call (same coalesce_key) is already in flight,
+            no task is queued. The returned response will receive the in-flight task's reply instead.
+        :param timeout: Seconds the caller would wait. The task's deadline, which is no later than the deadline of
+            the call being handled by the current thread, if any. See rdisq.deadline
+        :param send_at: Unix time. If given, the task is kept aside until then, and only then moved to the queue,
+            by a worker listening on it. Its timeout counts from then, and it doesn't inherit a deadline.
+        :param chunk: The single task arg is a list of items. The handler is called with each of them in turn,
+            and the response is the list of results. See AbstractRdisqConsumer.imap
+        :param no_reply: Fire and forget. The worker sends no response, and only logs and counts the exception
+            the call may raise. The returned response can't be waited on. Caching and coalescing don't apply.
+        """
         if not timeout:
             timeout = self.DEFAULT_REQUEST_TIMEOUT
-        task_id = queue_name + generate_task_id()
-        request_payload = RequestPayload(
-            task_id=task_id,
-            args=task_args,
-            kwargs=task_kwargs,
-            timeout=timeout
-        )
-
+        now = time.time()
+        if send_at is not None and send_at <= now:
+            send_at = None
+        deadline = (send_at or now) + timeout
+        inherited_deadline = get_current_deadline()
+        if send_at is None and inherited_deadline is not None and inherited_deadline < deadline:
+            # Sent from a handler, whose caller won't wait for this call beyond its own deadline
+            if inherited_deadline <= now:
+                raise RdisqDeadlineExceeded(queue_name, inherited_deadline)
+            deadline = inherited_deadline
+            timeout = math.ceil(deadline - now)
+        breaker = self.get_circuit_breaker(queue_name)
+        if breaker is not None:
+            breaker.before_call()
+        task_id = queue_name + generate_task_id(deadline)
         redis_con = self.get_redis()
-        # todo -- ask lital why he isn't passing the serialized_request inside the lpush? wouldn't that save a network call?
-        redis_con.setex(get_request_key(task_id), timeout,
-                        self.serializer.dumps(request_payload))
-        redis_con.lpush(queue_name, task_id)
+        if send_at is not None:
+            # The in-flight call's reply could come long before this one is due
+            coalesce_key = None
+        if no_reply:
+            coalesce_key = cache_key = None
+        response = RdisqResponse(task_id, dispatcher=self)
+        response.queue_name = queue_name
+        response.send_at = send_at
+        response.no_reply = no_reply
+        # Callers of identical coalesced calls may be waiting for this task's reply
+        response.cancellable = not coalesce_key
+        if not coalesce_key or not self.__attach_to_in_flight(redis_con, coalesce_key, task_id, timeout):
+            request_payload = RequestPayload(
+                task_id=task_id,
+                args=task_args,
+                kwargs=task_kwargs,
+                timeout=timeout,
+                enqueued_at=send_at or now,
+                cache_key=cache_key,
+                cache_ttl=cache_ttl,
+                coalesce_key=coalesce_key,
+                deadline=deadline,
+                chunk=chunk,
+                no_reply=no_reply
+            )
+            serialized_request = self.serializer.dumps(request_payload)
+            admission_policy = admission_policy or self.admission_policy
+            validate_admission_policy(admission_policy)
+            micro_batcher = self.micro_batcher
+            if send_at is not None:
+                self.__schedule(redis_con, queue_name, task_id, serialized_request, math.ceil(send_at - now) + timeout,
+                                send_at - now)
+            elif micro_batcher is not None and not coalesce_key and admission_policy != BLOCK_POLICY:
+                response.buffered = True
+                micro_batcher.add(_BufferedTask(queue_name, task_id, serialized_request, timeout, admission_policy,
+                                                response))
+            else:
+                self.__enqueue(redis_con, queue_name, task_id, serialized_request, timeout, admission_policy,
+                               coalesce_key)
 
-        return RdisqResponse(task_id, dispatcher=self)
+        if cache_key:
+            response.cache_key, response.cache_ttl = cache_key, cache_ttl
+        return response
+
+    def __enqueue(self, redis_con: Redis, queue_name: str, task_id: str, serialized_request: bytes, timeout: int,
+                  admission_policy: str, coalesce_key: str = None):
+        """Queue the task in a single round trip, if the queue's depth limit allows. See set_queue_limit"""
+        dropped_response = b""
+        if admission_policy == DROP_OLDEST_POLICY:
+            dropped_response = self.__get_queue_full_response(queue_name)
+        give_up_at = time.time() + self.admission_timeout
+        delay = self.ADMISSION_RETRY_DELAY
+        while not run_script(redis_con, ENQUEUE, [queue_name, get_request_key(task_id), self.QUEUE_LIMITS_REDIS_HASH],
+                             [task_id, serialized_request, timeout, admission_policy, get_request_key(""),
+                              dropped_response, COALESCED_CALL_KEY_PREFIX, WAITERS_KEY_PREFIX]):
+            remaining = give_up_at - time.time()
+            if admission_policy != BLOCK_POLICY or remaining <= 0:
+                if coalesce_key:
+                    # Identical calls may have attached to this one in the meantime
+                    run_script(redis_con, RELEASE_IN_FLIGHT,
+                               [coalesce_key, get_waiters_key(task_id), get_coalesced_call_key(task_id)],
+                               [task_id, self.__get_queue_full_response(queue_name), timeout])
+                raise QueueFullError(queue_name, self.get_queue_limit(queue_name))
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, self.ADMISSION_MAX_RETRY_DELAY)
+
+    def __enqueue_buffered(self, tasks: List[_BufferedTask]):
+        """Queue tasks buffered by the micro batcher in a single pipeline, see enable_micro_batching"""
+        for t in tasks:
+            t.response.buffered = False
+        tasks = [t for t in tasks if not t.response.cancelled]
+        if not tasks:
+            return
+        queue_full_responses = {t.queue_name: self.__get_queue_full_response(t.queue_name) for t in tasks}
+        pipe = self.get_redis().pipeline(transaction=False)
+        for t in tasks:
+            dropped_response = queue_full_responses[t.queue_name] if t.admission_policy == DROP_OLDEST_POLICY else b""
+            run_script(pipe, ENQUEUE, [t.queue_name, get_request_key(t.task_id), self.QUEUE_LIMITS_REDIS_HASH],
+                       [t.task_id, t.serialized_request, t.timeout, t.admission_policy, get_request_key(""),
+                        dropped_response, COALESCED_CALL_KEY_PREFIX, WAITERS_KEY_PREFIX])
+        try:
+            # Each task is queued or not regardless of the others, so errors are taken per task
+            results = pipe.execute(raise_on_error=False)
+        except RedisError as ex:
+            self.__fail_buffered(tasks, ex)
+            return
+        rejected = []
+        for t, result in zip(tasks, results):
+            if isinstance(result, Exception):
+                self.__fail_buffered([t], result)
+            elif not result and not t.response.no_reply:
+                rejected.append(t)
+                pipe.lpush(t.task_id, queue_full_responses[t.queue_name])
+                pipe.expire(t.task_id, t.timeout)
+        try:
+            pipe.execute()
+        except RedisError as ex:
+            self.__fail_buffered(rejected, ex)
+
+    def __fail_buffered(self, tasks: List[_BufferedTask], ex: Exception):
+        """Answer buffered tasks that weren't queued with ex, on their reply keys too, for callers already waiting"""
+        response_payload = ResponsePayload(
+            returned_value=None, raised_exception=ex, processing_time_seconds=0, service_uid=None)
+        for t in tasks:
+            t.response.response_payload = response_payload
+        try:
+            serialized_response = self.serializer.dumps(response_payload)
+            pipe = self.get_redis().pipeline(transaction=False)
+            for t in tasks:
+                if not t.response.no_reply:
+                    pipe.lpush(t.task_id, serialized_response)
+                    pipe.expire(t.task_id, t.timeout)
+            pipe.execute()
+        except Exception:
+            # The error can't be sent, e.g redis is down. Callers that didn't wait yet still get it.
+            pass
+
+    @staticmethod
+    def __schedule(redis_con: Redis, queue_name: str, task_id: str, serialized_request: bytes, ttl: int,
+                   delay: float):
+        """Keep the task aside for delay seconds, see RdisqService.delayed_task_check_interval"""
+        run_script(redis_con, SCHEDULE_TASK, [get_request_key(task_id), get_delayed_queue_key(queue_name)],
+                   [task_id, serialized_request, ttl * 1000, delay])
+
+    def __get_queue_full_response(self, queue_name: str) -> bytes:
+        return self.serializer.dumps(ResponsePayload(
+            returned_value=None,
+            raised_exception=QueueFullError(queue_name),
+            processing_time_seconds=0,
+            service_uid=None
+        ))
+
+    def set_queue_limit(self, queue_name: str, max_depth: Optional[int]):
+        """
+        Limit how many tasks may wait in a queue. The limit is kept in redis, and applies to all senders.
+
+        :param max_depth: None to remove the limit.
+        """
+        if max_depth is None:
+            self.get_redis().hdel(self.QUEUE_LIMITS_REDIS_HASH, queue_name)
+        else:
+            self.get_redis().hset(self.QUEUE_LIMITS_REDIS_HASH, queue_name, max_depth)
+
+    def get_queue_limit(self, queue_name: str) -> Optional[int]:
+        max_depth = self.get_redis().hget(self.QUEUE_LIMITS_REDIS_HASH, queue_name)
+        return int(max_depth) if max_depth is not None else None
+
+    def get_rate_limit_wait(self, name: str, rate_limit: RateLimit) -> float:
+        """:return: Seconds until a call may be made under the rate limit, 0 if it may be made now."""
+        return get_rate_limit_wait(self.get_redis(), name, rate_limit)
+
+    def check_rate_limit(self, name: str, rate_limit: Optional[RateLimit]):
+        """
+        Raise RateLimitExceeded if check_rate_limits is set and the rate limit is used up.
+        Only calls that workers already took count, so a backlog in the queue isn't noticed.
+        """
+        if not self.check_rate_limits or rate_limit is None:
+            return
+        wait = self.get_rate_limit_wait(name, rate_limit)
+        if wait:
+            raise RateLimitExceeded(name, wait)
+
+    @staticmethod
+    def __attach_to_in_flight(redis_con: Redis, coalesce_key: str, task_id: str, timeout: int) -> bool:
+        """
+        :return: True if an identical call is in flight, and task_id will receive its reply.
+            False if task_id is now the in-flight call, and should be queued.
+        """
+        leader_task_id = run_script(redis_con, JOIN_IN_FLIGHT, [coalesce_key, get_coalesced_call_key(task_id)],
+                                    [task_id, timeout, WAITERS_KEY_PREFIX])
+        return leader_task_id is not None
 
     def close(self):
         raise NotImplementedError("Must implement close(self) of dispatcher")
@@ -63,6 +333,7 @@ class SimpleRedisDispatcher(AbstractRedisDispatcher):
         return self.redis
 
     def close(self):
+        self.disable_micro_batching()
         self.redis.close()
 
 
@@ -82,4 +353,5 @@ class PoolRedisDispatcher(AbstractRedisDispatcher):
         return Redis(connection_pool=self.redis_pool)
 
     def close(self):
+        self.disable_micro_batching()
         self.redis_pool.disconnect()
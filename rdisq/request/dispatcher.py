@@ -4,8 +4,13 @@ import time
 
 import uuid
 
+from rdisq.load import ServiceLoad
 from rdisq.redis_dispatcher import PoolRedisDispatcher
 from rdisq.consts import QueueName, ServiceUid
+from rdisq.identification import LIVE_RECEIVERS_KEY, get_receiver_indexes_key, get_receiver_tag_index_key, \
+    get_receiver_message_index_key, get_receiver_queue_index_key, get_delayed_queue_key, is_indexed_tag_value
+from rdisq.request.receiver_filter import ReceiverFilter
+from rdisq.scripts import run_script, UPDATE_RECEIVER_INDEXES, FIND_RECEIVERS, FIND_QUEUES, COLLECT_DEAD_RECEIVER
 
 if TYPE_CHECKING:
     from rdisq.request.message import RdisqMessage
@@ -26,27 +31,137 @@ class ReceiverServiceStatus:
         self.broadcast_queues: FrozenSet[QueueName] = worker.listening_queues
         self.tags: Dict = worker.tags
         self.stopping: bool = worker.is_stopping
+        self.scheduling: Dict = worker.queue_scheduler.describe()
+        self.heartbeat_time: float = time.time()
+        self.expires_at: float = self.heartbeat_time + worker.status_ttl_seconds
+        self.load: ServiceLoad = worker.get_load()
+        self.shed: Dict[str, int] = worker.get_shed_counts()
+
+    def is_alive(self, now: float = None) -> bool:
+        """:return: Whether the receiver is still serving, and refreshed its status recently."""
+        if self.stopping:
+            return False
+        # statuses written before receivers had a ttl never expire by themselves
+        expires_at = getattr(self, "expires_at", None)
+        return expires_at is not None and expires_at > (now or time.time())
 
 
 class RequestDispatcher(PoolRedisDispatcher):
     ACTIVE_SERVICES_REDIS_HASH = "receiver_services"
+    JANITOR_REDIS_KEY = "rdisq_janitor"  # holds the uid of the receiver currently cleaning up after dead ones
+    QUEUE_USAGE_REDIS_HASH = "rdisq_queue_usage"  # generated queue -> when a request was last sent to it
+    QUEUE_USAGE_REPORT_INTERVAL = 60  # seconds, usage of a queue is written to redis at most this often
+    GENERATED_QUEUE_PREFIX = "rdisq_queue__"
+    PENDING_QUEUE_TIMEOUT = 30  # seconds to wait for receivers to add a queue before provisioning another one
+    provision_in_background = False  # don't hold back a request while its receivers are given a shared queue
+
+    def __init__(self, *pool_args, **pool_kwargs):
+        super().__init__(*pool_args, **pool_kwargs)
+        self._pending_queues: Dict[FrozenSet[ServiceUid], Tuple[QueueName, float]] = {}
+        self._queue_usage_reported: Dict[QueueName, float] = {}
 
     def update_receiver_service_status(self, receiver: "ReceiverService") -> ReceiverServiceStatus:
         status = ReceiverServiceStatus(receiver)
-        self.get_redis().hset(self.ACTIVE_SERVICES_REDIS_HASH, key=status.uid,
-                              value=receiver.serializer.dumps(status)
-                              )
+        pipe = self.get_redis().pipeline(transaction=True)
+        pipe.hset(self.ACTIVE_SERVICES_REDIS_HASH, key=status.uid,
+                  value=receiver.serializer.dumps(status)
+                  )
+        if status.stopping:
+            self.__remove_from_indexes(pipe, status.uid)
+        else:
+            # Indexes for ReceiverFilter, see find_receiver_uids
+            index_keys = [get_receiver_tag_index_key(k, v) for k, v in status.tags.items() if is_indexed_tag_value(v)]
+            index_keys += [get_receiver_message_index_key(m.get_message_class_id()) for m in status.registered_messages]
+            index_keys += [get_receiver_queue_index_key(q) for q in status.broadcast_queues]
+            run_script(pipe, UPDATE_RECEIVER_INDEXES, [get_receiver_indexes_key(status.uid)], [status.uid, *index_keys])
+            pipe.zadd(LIVE_RECEIVERS_KEY, {status.uid: status.expires_at})
+        pipe.execute()
         return status
 
-    def get_receiver_services(self) -> Dict[str, ReceiverServiceStatus]:
+    @staticmethod
+    def __remove_from_indexes(pipe, uid: ServiceUid):
+        run_script(pipe, UPDATE_RECEIVER_INDEXES, [get_receiver_indexes_key(uid)], [uid])
+        pipe.zrem(LIVE_RECEIVERS_KEY, uid)
+
+    def find_receiver_uids(self, service_filter: Callable[["ReceiverServiceStatus"], bool]) -> Set[ServiceUid]:
+        """
+        :return: The uids of the live receivers that pass the filter.
+            A ReceiverFilter is resolved on the redis server, any other filter is run on every receiver's status.
+        """
+        if not isinstance(service_filter, ReceiverFilter):
+            return {s.uid for s in self.filter_services(service_filter)}
+        args = [time.time()]
+        uids = service_filter.uids if service_filter.uids is not None else ()
+        if service_filter.uids is not None and not uids:
+            return set()
+        args += [len(uids), *uids]
+        for group in service_filter.get_index_key_groups():
+            args += [len(group), *group]
+        return {uid.decode() for uid in run_script(self.get_redis(), FIND_RECEIVERS, [LIVE_RECEIVERS_KEY], args)}
+
+    def get_all_receiver_statuses(self) -> Dict[str, ReceiverServiceStatus]:
+        """:return: Every status in redis, including those of stopped and dead receivers."""
         raw_statuses: Dict[bytearray, bytearray] = self.get_redis().hgetall(self.ACTIVE_SERVICES_REDIS_HASH)
         statuses: Dict[str, ReceiverServiceStatus] = {}
         for k, v in raw_statuses.items():
             statuses[k.decode()] = self.serializer.loads(v)
+        return statuses
 
-        statuses = {k: v for k, v in statuses.items() if not v.stopping}
+    def get_receiver_services(self) -> Dict[str, ReceiverServiceStatus]:
+        now = time.time()
+        return {k: v for k, v in self.get_all_receiver_statuses().items() if v.is_alive(now)}
+
+    def get_receiver_statuses(self, uids: Iterable[ServiceUid]) -> Dict[ServiceUid, ReceiverServiceStatus]:
+        """:return: The statuses of just these receivers, those that have one."""
+        uids = sorted(uids)
+        if not uids:
+            return {}
+        raw_statuses = self.get_redis().hmget(self.ACTIVE_SERVICES_REDIS_HASH, uids)
+        return {uid: self.serializer.loads(v) for uid, v in zip(uids, raw_statuses) if v is not None}
+
+    def try_become_janitor(self, uid: ServiceUid, seconds: float) -> bool:
+        """:return: Whether uid was elected to clean up for the next seconds. Only one receiver is at a time."""
+        return bool(self.get_redis().set(self.JANITOR_REDIS_KEY, uid, nx=True, ex=max(1, int(seconds))))
+
+    def collect_dead_receivers(self) -> Set[ServiceUid]:
+        """
+        Remove the statuses of receivers that stopped, or whose status expired, along with the queues only they
+        listened to. Queues of message classes are shared by all receivers, and are kept.
 
-        return statuses
+        :return: The uids of the removed receivers.
+        """
+        # imported here, since the receiver module imports this one
+        from rdisq.request.receiver import ReceiverService
+        now = time.time()
+        statuses = self.get_all_receiver_statuses()
+        dead = {uid for uid, status in statuses.items() if not status.is_alive(now)}
+        if not dead:
+            return dead
+
+        live_queues: Set[QueueName] = set()
+        for uid, status in statuses.items():
+            if uid not in dead:
+                live_queues.update(status.broadcast_queues)
+        orphaned_queues: Dict[ServiceUid, Set[QueueName]] = {}
+        for uid in dead:
+            orphaned_queues[uid] = {q for q in statuses[uid].broadcast_queues
+                                    if q not in live_queues and (q.startswith(uid) or self.GENERATED_QUEUE_PREFIX in q)}
+            orphaned_queues[uid].add(ReceiverService.get_control_queue_name(uid))
+
+        # A receiver may have refreshed its status since it was read, so whether it's still dead is checked
+        # again on the server, along with the removal.
+        uids = list(dead)
+        pipe = self.get_redis().pipeline(transaction=False)
+        for uid in uids:
+            queues = orphaned_queues[uid]
+            run_script(pipe, COLLECT_DEAD_RECEIVER,
+                       [self.ACTIVE_SERVICES_REDIS_HASH, LIVE_RECEIVERS_KEY, get_receiver_indexes_key(uid),
+                        *queues, *(get_delayed_queue_key(q) for q in queues)],
+                       [uid, now])
+        collected = {uid for uid, removed in zip(uids, pipe.execute()) if removed}
+        self.forget_queue_usage(q for uid in collected for q in orphaned_queues[uid]
+                                if self.GENERATED_QUEUE_PREFIX in q)
+        return collected
 
     def filter_services(self, service_filter: Callable[["ReceiverServiceStatus"], bool]) -> Iterable[
         "ReceiverServiceStatus"]:
@@ -54,28 +169,74 @@ class RequestDispatcher(PoolRedisDispatcher):
 
         :return: Statuses of services that match the filter.
         """
+        if isinstance(service_filter, ReceiverFilter):
+            return list(self.get_receiver_statuses(self.find_receiver_uids(service_filter)).values())
         services = self.get_receiver_services()
         return filter(service_filter, services.values())
 
-    def find_queues_for_services(self, service_uids: Set[str]) -> FrozenSet[QueueName]:
+    def get_queue_listeners(self) -> Dict[QueueName, Set[ServiceUid]]:
+        """:return: For each queue that's listened to, the uids of the services listening to it."""
+        queue_to_services: Dict[QueueName, Set[ServiceUid]] = defaultdict(set)
+        for service in self.get_receiver_services().values():
+            for q in service.broadcast_queues:
+                queue_to_services[q].add(service.uid)
+        return queue_to_services
+
+    def find_queues_for_services(self, service_uids: Set[str],
+                                 queue_listeners: Dict[QueueName, Set[ServiceUid]] = None) -> FrozenSet[QueueName]:
         """
-        Find all queues that are listened to by all these services.
+        Find all queues that are listened to by all these services, and no other.
+        Resolved on the redis server, against the queue index sets the receivers keep up to date.
 
         :param service_uids: Set IDs of queues to match.
+        :param queue_listeners: As returned by get_queue_listeners, to match against it instead.
         :return: Set of queue names.
         """
-        services = self.get_receiver_services().values()
-        queue_to_services: Dict[QueueName, set] = defaultdict(set)
-        for service in services:
-            for q in service.broadcast_queues:
-                queue_to_services[q].add(service.uid)
-
-        queue_to_services = {k: v for k, v in queue_to_services.items() if
-                             v == service_uids}
-
-        return frozenset(queue_to_services.keys())
-
-    @staticmethod
-    def generate_queue_name():
+        if queue_listeners is not None:
+            return frozenset(k for k, v in queue_listeners.items() if v == service_uids)
+        if not service_uids:
+            return frozenset()
+        queues = run_script(self.get_redis(), FIND_QUEUES, [LIVE_RECEIVERS_KEY],
+                            [time.time(), get_receiver_queue_index_key(""), get_receiver_indexes_key(""),
+                             *sorted(service_uids)])
+        return frozenset(q.decode() for q in queues)
+
+    @classmethod
+    def generate_queue_name(cls):
         """"""
-        return f"rdisq_queue__{uuid.uuid4()}"
+        return f"{cls.GENERATED_QUEUE_PREFIX}{uuid.uuid4()}"
+
+    def get_pending_queue(self, service_uids: Set[ServiceUid]) -> Optional[QueueName]:
+        """:return: A queue that's being added to these services, if one was requested recently."""
+        key = frozenset(service_uids)
+        pending = self._pending_queues.get(key)
+        if pending is None:
+            return None
+        queue, requested_at = pending
+        if time.time() - requested_at > self.PENDING_QUEUE_TIMEOUT:
+            self._pending_queues.pop(key, None)
+            return None
+        return queue
+
+    def set_pending_queue(self, service_uids: Set[ServiceUid], queue: Optional[QueueName]):
+        if queue is None:
+            self._pending_queues.pop(frozenset(service_uids), None)
+        else:
+            self._pending_queues[frozenset(service_uids)] = (queue, time.time())
+
+    def record_queue_usage(self, queue: QueueName, force: bool = False):
+        """Note that a request was sent to a generated queue, so it isn't collected as unused."""
+        now = time.time()
+        if force or now - self._queue_usage_reported.get(queue, 0) >= self.QUEUE_USAGE_REPORT_INTERVAL:
+            self._queue_usage_reported[queue] = now
+            self.get_redis().hset(self.QUEUE_USAGE_REDIS_HASH, queue, now)
+
+    def get_queue_usage(self) -> Dict[QueueName, float]:
+        return {k.decode(): float(v) for k, v in self.get_redis().hgetall(self.QUEUE_USAGE_REDIS_HASH).items()}
+
+    def forget_queue_usage(self, queues: Iterable[QueueName]):
+        queues = list(queues)
+        for q in queues:
+            self._queue_usage_reported.pop(q, None)
+        if queues:
+            self.get_redis().hdel(self.QUEUE_USAGE_REDIS_HASH, *queues)
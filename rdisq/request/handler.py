@@ -1,6 +1,8 @@
 from typing import *
 from importlib import import_module
 
+from rdisq.batch import BatchOptions, call_batch
+
 if TYPE_CHECKING:
     from rdisq.request.message import RdisqMessage
 
@@ -21,6 +23,7 @@ class _Handler:
         self._handler_function = handler_function
         self._handler_class = handler_class
         self._handler_name = self._handler_function.__name__
+        self.batch_options: Optional[BatchOptions] = getattr(handler_function, "batch_options", None)
         error = None
 
         new_handler_instance = None
@@ -50,10 +53,22 @@ class _Handler:
             self._handler_instance = new_handler_instance
 
     def handle(self, message: "RdisqMessage") -> Any:
+        if self.batch_options is not None:
+            result, raised_exception = self.handle_batch([message])[0]
+            if raised_exception is not None:
+                raise raised_exception
+            return result
+        return self.__call_function(message)
+
+    def handle_batch(self, messages: List["RdisqMessage"]) -> List[Tuple[Any, Optional[Exception]]]:
+        """For batch handlers. :return: The returned value and the raised exception for each message"""
+        return call_batch(self.__call_function, messages)
+
+    def __call_function(self, arg) -> Any:
         if not self._handler_instance:
-            return self._handler_function(message)
+            return self._handler_function(arg)
         else:
-            return getattr(self._handler_instance, self._handler_name)(message)
+            return getattr(self._handler_instance, self._handler_name)(arg)
 
 
 T = TypeVar('T', bound=type)
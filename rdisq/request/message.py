@@ -1,12 +1,15 @@
 from typing import *
+import time
 
 from rdisq.configuration import get_rdisq_config
 from rdisq.consts import ServiceUid
 from rdisq.request.handler import _HandlerFactory
+from rdisq.batch import BatchOptions
 
 if TYPE_CHECKING:
     from rdisq.request.dispatcher import ReceiverServiceStatus, RequestDispatcher
     from rdisq.request.rdisq_request import RdisqRequest
+    from rdisq.rate_limit import RateLimit
 
 
 class RdisqMessage:
@@ -20,15 +23,44 @@ class RdisqMessage:
     """
     handler_factory: "_HandlerFactory" = None
     session_data: Dict = None
+    # Options are prefixed, so they don't clash with the fields of messages
+    rdisq_slow_call_threshold: ClassVar[float] = None  # seconds, overrides the receiver's slow_call_threshold
+    rdisq_cache_ttl: ClassVar[int] = None  # for pure handlers, cache results for this long, keyed by message content
+    rdisq_coalesce: ClassVar[bool] = False  # for idempotent handlers, identical in-flight messages share a single task
+    rdisq_priority: ClassVar[int] = None  # receivers serve queues of higher priority messages first
+    rdisq_weight: ClassVar[int] = None  # share of the receiver among its priority level, under the weighted policy
+    rdisq_time_limit: ClassVar[int] = None  # seconds from sending, after which receivers drop the message unhandled
+    rdisq_rate_limit: ClassVar["RateLimit"] = None  # how often the message may be handled, across all receivers
 
     def __init__(self, **kwargs):
         for k, v in kwargs.items():
             setattr(self, k, v)
 
+    def __repr__(self):
+        fields = ", ".join(f"{k}={v!r}" for k, v in vars(self).items())
+        return f"{type(self).__name__}({fields})"
+
     @classmethod
     def get_message_class_id(cls) -> str:
         return "%s.%s_handler" % (cls.__module__, cls.__name__)
 
+    @classmethod
+    def get_rate_limit_wait(cls) -> float:
+        """:return: Seconds until rdisq_rate_limit allows handling a message, 0 if it allows one now or there's no limit."""
+        if cls.rdisq_rate_limit is None:
+            return 0
+        return get_rdisq_config().request_dispatcher.get_rate_limit_wait(cls.get_message_class_id(),
+                                                                         cls.rdisq_rate_limit)
+
+    def get_routing_key(self) -> Optional[Hashable]:
+        """
+        Override to give messages affinity to receivers.
+        Messages with the same routing key go to the same receiver, as long as the matching receivers don't change.
+
+        :return: The routing key of this message, or None for no affinity.
+        """
+        return None
+
     # ===================================================================
     # Convenience Methods
     # ===================================================================
@@ -38,14 +70,45 @@ class RdisqMessage:
         """Can be used as a decorator"""
         return get_rdisq_config().handler_factory.set_handler_function(handler_function, cls)
 
+    @classmethod
+    def set_batch_handler(cls, handler_function: Callable = None, *, batch_size: int = 16,
+                          max_wait: float = 0) -> Callable:
+        """
+        Like set_handler, for a handler that's called with a list of up to batch_size queued messages of this class,
+        and returns a list with the result of each, in order. An exception in the returned list is raised to the
+        sender of that message alone. Can be used bare or with options, as a decorator.
+
+        :param max_wait: Seconds to wait for more messages when fewer than batch_size are queued.
+        """
+        def decorate(f: Callable) -> Callable:
+            f.batch_options = BatchOptions(batch_size, max_wait)
+            return cls.set_handler(f)
+
+        if handler_function is None:
+            return decorate
+        return decorate(handler_function)
+
     def send_async(self, service_filter: Callable[["ReceiverServiceStatus"], bool] = None,
-                   targets: Set[ServiceUid] = None, request_dispatcher: "RequestDispatcher" = None) -> "RdisqRequest":
+                   targets: Set[ServiceUid] = None, request_dispatcher: "RequestDispatcher" = None,
+                   no_reply: bool = False) -> "RdisqRequest":
         """Generate a request for this message, send it, and return the request handle
+        :param no_reply: Fire and forget, the receiver sends no response. See queue_task
         :return: The request that was send with this message
         """
         # if we import this at module level, it would cause a circular import
         from rdisq.request.rdisq_request import RdisqRequest
-        return RdisqRequest(self, service_filter, targets, request_dispatcher).send_async()
+        return RdisqRequest(self, service_filter, targets, request_dispatcher).send_async(no_reply=no_reply)
+
+    def send_at(self, send_at: float, service_filter: Callable[["ReceiverServiceStatus"], bool] = None,
+                targets: Set[ServiceUid] = None, request_dispatcher: "RequestDispatcher" = None) -> "RdisqRequest":
+        """Like send_async, but the message isn't handled before send_at (unix time)"""
+        from rdisq.request.rdisq_request import RdisqRequest
+        return RdisqRequest(self, service_filter, targets, request_dispatcher).send_async(send_at)
+
+    def send_after(self, seconds: float, service_filter: Callable[["ReceiverServiceStatus"], bool] = None,
+                   targets: Set[ServiceUid] = None, request_dispatcher: "RequestDispatcher" = None) -> "RdisqRequest":
+        """Like send_async, but the message isn't handled in the next seconds"""
+        return self.send_at(time.time() + seconds, service_filter, targets, request_dispatcher)
 
     def send_and_wait(self, service_filter: Callable[["ReceiverServiceStatus"], bool] = None,
                       targets: Set[ServiceUid] = None, request_dispatcher: "RequestDispatcher" = None, timeout=None) -> Any:
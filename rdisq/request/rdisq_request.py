@@ -1,15 +1,26 @@
 from abc import abstractmethod
 from typing import *
+import random
+import time
 
 from rdisq.configuration import get_rdisq_config
 from rdisq.request.message import RdisqMessage
 from rdisq.request.dispatcher import ReceiverServiceStatus, RequestDispatcher
+from rdisq.request.receiver_filter import ReceiverFilter
+from rdisq.request.routing import choose_receiver, validate_routing, get_hash_ring
 from rdisq.consts import QueueName, ServiceUid
-from rdisq.request.receiver import AddQueue
+from rdisq.hedging import HedgingPolicy, HedgedResponse
+from rdisq.request.receiver import AddQueue, RemoveQueue, ReceiverService, CORE_RECEIVER_MESSAGES
+
+from rdisq.response import RdisqResponseTimeout, gather
 
 if TYPE_CHECKING:
     from rdisq.response import RdisqResponse
 
+# Receivers listen on generated queues under their broadcast names
+_BROADCAST_QUEUE_PREFIX = ReceiverService.get_queue_name_for_method("")
+_GENERATED_QUEUE_BROADCAST_PREFIX = _BROADCAST_QUEUE_PREFIX + RequestDispatcher.GENERATED_QUEUE_PREFIX
+
 
 class _BaseRequest:
     dispatcher: RequestDispatcher
@@ -25,6 +36,7 @@ class _BaseRequest:
         """
         :param message:
         :param service_filter: Filter which services will be targeted by this request.
+            A ReceiverFilter is resolved on the redis server, and only matches receivers that handle the message.
         :param targets: List of service UIDs this request is aimed at.
         """
         self.dispatcher = request_dispatcher or get_rdisq_config().request_dispatcher
@@ -34,7 +46,9 @@ class _BaseRequest:
         self._target_service_uids = targets
         self._sent: bool = False
         self.message: RdisqMessage = message
-        if service_filter:
+        if isinstance(service_filter, ReceiverFilter):
+            self._filter_wrapper(service_filter)
+        elif service_filter:
             self._service_filter = service_filter
         else:
             self._filter_wrapper()
@@ -73,27 +87,61 @@ class _BaseRequest:
 
     def _get_target_uids(self) -> Set[ServiceUid]:
         if not self._target_service_uids:
-            services = self.dispatcher.filter_services(self._service_filter)
-            service_ids = map(lambda s: s.uid, services)
-            self._target_service_uids = set(service_ids)
+            self._target_service_uids = self.dispatcher.find_receiver_uids(self._service_filter)
         return self._target_service_uids
 
     def get_queue_for_services(self, service_uids: Set[str]) -> QueueName:
-        preexisting = self.dispatcher.find_queues_for_services(service_uids)
         if not service_uids:
             raise RuntimeError("Got empty service_uids set")
+        preexisting = self.dispatcher.find_queues_for_services(service_uids)
         if preexisting:
-            queue = list(preexisting)[0]
+            queue = self._choose_queue(preexisting, service_uids)
+            self.dispatcher.set_pending_queue(service_uids, None)
+        elif not self.dispatcher.provision_in_background:
+            queue = provision_queue(service_uids, self.dispatcher)
         else:
-            queue = self.dispatcher.generate_queue_name()
-            MultiRequest(
-                AddQueue(queue),
-                targets=self._get_target_uids()).send_and_wait_reply()
+            if self.dispatcher.get_pending_queue(service_uids) is None:
+                provision_queue(service_uids, self.dispatcher, wait=False)
+            # Until all the receivers have added the new queue, deliver through a queue of just one of them
+            queue = None
+            for uid in random.sample(sorted(service_uids), len(service_uids)):
+                own_queues = self.dispatcher.find_queues_for_services({uid})
+                if own_queues:
+                    queue = self._choose_queue(own_queues, {uid})
+                    break
+            if queue is None:
+                # Control queues are served alongside the data queues, so data messages wait for the new queue instead
+                queue = self.__wait_for_pending_queue(service_uids)
 
+        if queue.startswith(_GENERATED_QUEUE_BROADCAST_PREFIX):
+            self.dispatcher.record_queue_usage(queue)
         return queue
 
+    def __wait_for_pending_queue(self, service_uids: Set[str]) -> QueueName:
+        """:return: The queue being added to the services, once all of them listen on it."""
+        queue = self.dispatcher.get_pending_queue(service_uids)
+        give_up_at = time.time() + self.dispatcher.PENDING_QUEUE_TIMEOUT
+        while queue not in self.dispatcher.find_queues_for_services(service_uids):
+            if time.time() >= give_up_at:
+                raise RuntimeError(f"Receivers {service_uids} didn't add the queue {queue} in time")
+            time.sleep(0.05)
+        self.dispatcher.set_pending_queue(service_uids, None)
+        return queue
+
+    def _choose_queue(self, queues: FrozenSet[QueueName], service_uids: Set[str]) -> QueueName:
+        # Prefer the message's own queue, so its scheduling priority applies
+        message_queue_base_name = self.message.get_message_class_id()
+        own_queues = {ReceiverService.get_queue_name_for_method(message_queue_base_name, uid)
+                      for uid in service_uids}
+        own_queues.add(ReceiverService.get_queue_name_for_method(message_queue_base_name))
+        return min(queues & own_queues or queues)
+
     def _filter_wrapper(self, base_filter: Callable[[ReceiverServiceStatus], bool] = None):
         message_class = type(self.message)
+        if base_filter is None or isinstance(base_filter, ReceiverFilter):
+            # Resolved on the redis server, see ReceiverFilter
+            self._service_filter = (base_filter or ReceiverFilter()).with_message_class(message_class)
+            return
 
         def filter_by_message(service_status: ReceiverServiceStatus) -> bool:
             flag = True
@@ -108,6 +156,30 @@ class _BaseRequest:
 
 class RdisqRequest(_BaseRequest):
     _response: "RdisqResponse"
+    _queue: QueueName = None
+    _routed_uid: Optional[ServiceUid] = None
+    routing: Optional[str] = None
+    hedging: Optional[HedgingPolicy] = None
+
+    def __init__(self, message: RdisqMessage,
+                 service_filter: Callable[["ReceiverServiceStatus"], bool] = None,
+                 targets: Set[ServiceUid] = None,
+                 request_dispatcher: RequestDispatcher = None,
+                 routing: str = None,
+                 hedging: HedgingPolicy = None
+                 ):
+        """
+        :param routing: If given, the request goes to the least busy of the matching receivers,
+            instead of a queue shared by all of them. See rdisq.request.routing
+        :param hedging: If given, and the message isn't answered within the policy's delay,
+            it's sent again to another receiver. Only for idempotent messages.
+        """
+        validate_routing(routing)
+        super().__init__(message, service_filter, targets, request_dispatcher)
+        if routing is not None:
+            self.routing = routing
+        if hedging is not None:
+            self.hedging = hedging
 
     @property
     def returned_value(self):
@@ -127,52 +199,194 @@ class RdisqRequest(_BaseRequest):
         else:
             raise RuntimeError("not supposed to try to get results before the message was sent")
 
-    def wait(self, timeout=None):
+    def wait(self, timeout=None, cancel_on_timeout: bool = None):
         super(RdisqRequest, self).wait()
-        r = self._response.wait(timeout)
+        r = self._response.wait(timeout, cancel_on_timeout)
         self._finished = True
         return r
 
-    def send_async(self) -> "RdisqRequest":
+    def send_async(self, send_at: float = None, no_reply: bool = False) -> "RdisqRequest":
+        """
+        :param send_at: Unix time. If given, the message isn't handled before then, see queue_task
+        :param no_reply: Fire and forget, the receiver sends no response and the request can't be waited on.
+        """
+        cache_ttl = type(self.message).rdisq_cache_ttl
+        cache_key = None
+        if cache_ttl and not self._sent and not no_reply:
+            cache_key = self.dispatcher.get_cache_key(self.message.get_message_class_id(), (self.message,), {})
+            cached_response = self.dispatcher.get_cached_response(cache_key, cache_ttl)
+            if cached_response is not None:
+                self._sent = True
+                self._response = cached_response
+                return self
+
+        if send_at is None:
+            self.dispatcher.check_rate_limit(self.message.get_message_class_id(), type(self.message).rdisq_rate_limit)
         super(RdisqRequest, self).send_async()
+        queue = self._queue = self._get_queue()
+        coalesce_key = None
+        if type(self.message).rdisq_coalesce and not no_reply:
+            coalesce_key = self.dispatcher.get_coalesce_key(queue, (self.message,), {})
         self._response = self.dispatcher.queue_task(
-            self.get_queue_for_services(self._get_target_uids()),
-            self.message
+            queue,
+            self.message,
+            timeout=type(self.message).rdisq_time_limit,
+            cache_key=cache_key,
+            cache_ttl=cache_ttl,
+            coalesce_key=coalesce_key,
+            send_at=send_at,
+            no_reply=no_reply
         )
+        if self.hedging is not None and send_at is None and not no_reply:
+            self._response = HedgedResponse(self._response, lambda: self._send_hedge(cache_key, cache_ttl),
+                                            self.hedging, type(self.message).__name__)
 
         return self
 
+    def cancel(self) -> bool:
+        """
+        Stop the message from being handled, if its handler didn't start yet. See RdisqResponse.cancel
+
+        :return: Whether the message was cancelled before its handler started.
+        """
+        if not self._sent or self._finished:
+            return False
+        return self._response.cancel()
+
+    def _send_hedge(self, cache_key: str = None, cache_ttl: int = None) -> Optional["RdisqResponse"]:
+        """Send the message again, to a receiver other than the one it was routed to."""
+        target_uids = self._get_target_uids()
+        if len(target_uids) < 2:
+            return None
+        if self._routed_uid is None:
+            # Shared by all the targets, and the receiver that's stuck with the first send can't take this one
+            queue = self._queue
+        else:
+            others = target_uids - {self._routed_uid}
+            if self.routing:
+                uid = choose_receiver(others, self.dispatcher, self.routing)
+            else:
+                uid = random.choice(sorted(others))
+            queue = self.get_queue_for_services({uid})
+        return self.dispatcher.queue_task(queue, self.message, timeout=type(self.message).rdisq_time_limit,
+                                          cache_key=cache_key, cache_ttl=cache_ttl)
+
+    def _get_queue(self) -> QueueName:
+        target_uids = self._get_target_uids()
+        routing_key = self.message.get_routing_key()
+        if routing_key is not None and len(target_uids) > 1:
+            self._routed_uid = get_hash_ring(frozenset(target_uids)).get_receiver(routing_key)
+        elif self.routing and len(target_uids) > 1:
+            self._routed_uid = choose_receiver(target_uids, self.dispatcher, self.routing)
+        if self._routed_uid is not None:
+            target_uids = {self._routed_uid}
+        if type(self.message) in CORE_RECEIVER_MESSAGES and len(target_uids) == 1:
+            # Core messages to a single receiver skip its other queues, see ReceiverService.get_control_queue_name
+            return ReceiverService.get_control_queue_name(next(iter(target_uids)))
+        return self.get_queue_for_services(target_uids)
+
 
 class MultiRequest(_BaseRequest):
     _targets: Set[ServiceUid]
     _requests: List[RdisqRequest]
 
-    def send_async(self) -> "MultiRequest":
+    def send_async(self, no_reply: bool = False) -> "MultiRequest":
+        """:param no_reply: Fire and forget, the receivers send no response and the request can't be waited on."""
         super(MultiRequest, self).send_async()
         self._requests = []
         for target_uid in self._get_target_uids():
             self._requests.append(
-                RdisqRequest(self.message, lambda s: s.uid == target_uid).
-                    send_async())
+                RdisqRequest(self.message, targets={target_uid}, request_dispatcher=self.dispatcher).
+                    send_async(no_reply=no_reply))
         return self
 
     def wait(self, timeout=None):
+        """:param timeout: Seconds for all the replies to arrive."""
         super(MultiRequest, self).wait()
-        queues: List[QueueName] = [r.task_id for r in self._requests]
-        reply_count = 0
-        while reply_count < len(queues):
-            queue_name, response = self.dispatcher.get_redis().brpop(queues, timeout)
-            queue_name = queue_name.decode()
-            for r in self._requests:
-                if r.task_id == queue_name:
-                    r.response.process_response(response)
-                    r._finished = True
-                    reply_count += 1
-                    break
-        if reply_count < len(queues):
-            self._finished = True
+        try:
+            results = gather([r.response for r in self._requests], timeout)
+        except RdisqResponseTimeout:
+            reply_count = sum(r.response.response_payload is not None for r in self._requests)
             raise RuntimeError(f"Timeout waiting for replies. "
-                               f"Got {reply_count} out of {len(queues)}")
-        else:
+                               f"Got {reply_count} out of {len(self._requests)}")
+        finally:
             self._finished = True
-            return [r.returned_value for r in self._requests]
+            for r in self._requests:
+                r._finished = r.response.response_payload is not None
+        return results
+
+
+def provision_queue(service_uids: Set[ServiceUid], dispatcher: RequestDispatcher = None,
+                    wait: bool = True, timeout=None) -> QueueName:
+    """
+    Add a new queue, shared by exactly these receivers.
+
+    :param wait: Wait for all the receivers to add the queue. Otherwise, the queue is marked as pending
+        in the dispatcher, and requests are delivered through other queues until it's ready.
+    :return: The name of the queue.
+    """
+    dispatcher = dispatcher or get_rdisq_config().request_dispatcher
+    queue_base_name = dispatcher.generate_queue_name()
+    queue = ReceiverService.get_queue_name_for_method(queue_base_name)
+    request = MultiRequest(AddQueue(queue_base_name), targets=set(service_uids),
+                           request_dispatcher=dispatcher).send_async()
+    dispatcher.record_queue_usage(queue, force=True)
+    if wait:
+        request.wait(timeout)
+    else:
+        dispatcher.set_pending_queue(service_uids, queue)
+    return queue
+
+
+def prewarm_queue(service_filter: Callable[[ReceiverServiceStatus], bool] = None,
+                  targets: Set[ServiceUid] = None, message_class: Type[RdisqMessage] = None,
+                  dispatcher: RequestDispatcher = None, wait: bool = True) -> QueueName:
+    """
+    Make sure the receivers a request would be sent to share a queue, e.g at startup,
+    so the first request to them doesn't pay for adding one.
+
+    :param message_class: If given, only receivers that handle it are considered, as when sending it.
+    :return: The receivers' shared queue.
+    """
+    dispatcher = dispatcher or get_rdisq_config().request_dispatcher
+    if service_filter is not None and targets is not None:
+        raise RuntimeError("Can't provide both a filter and a target-list")
+    if targets is None and (service_filter is None or isinstance(service_filter, ReceiverFilter)):
+        targets = dispatcher.find_receiver_uids((service_filter or ReceiverFilter()).with_message_class(message_class))
+    elif targets is None:
+        services = dispatcher.filter_services(
+            lambda s: (message_class is None or message_class in s.registered_messages) and service_filter(s))
+        targets = {s.uid for s in services}
+    if not targets:
+        raise RuntimeError("No suitable receiver services were found.")
+    preexisting = dispatcher.find_queues_for_services(targets)
+    if preexisting:
+        return min(preexisting)
+    return provision_queue(targets, dispatcher, wait)
+
+
+def collect_unused_queues(max_idle_seconds: float = 3600, dispatcher: RequestDispatcher = None) -> Set[QueueName]:
+    """
+    Remove generated queues that weren't sent to for max_idle_seconds, and are empty, from the receivers listening
+    to them. max_idle_seconds should be well above RequestDispatcher.QUEUE_USAGE_REPORT_INTERVAL.
+
+    :return: The removed queues.
+    """
+    dispatcher = dispatcher or get_rdisq_config().request_dispatcher
+    redis_con = dispatcher.get_redis()
+    usage = dispatcher.get_queue_usage()
+    now = time.time()
+    removed: Set[QueueName] = set()
+    for queue, listeners in dispatcher.get_queue_listeners().items():
+        if not queue.startswith(_GENERATED_QUEUE_BROADCAST_PREFIX):
+            continue
+        last_used = usage.get(queue)
+        if last_used is not None and now - last_used < max_idle_seconds:
+            continue
+        if redis_con.llen(queue):
+            continue
+        MultiRequest(RemoveQueue(queue[len(_BROADCAST_QUEUE_PREFIX):]), targets=listeners,
+                     request_dispatcher=dispatcher).send_async(no_reply=True)
+        removed.add(queue)
+    dispatcher.forget_queue_usage(removed)
+    return removed
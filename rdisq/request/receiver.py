@@ -1,11 +1,14 @@
 from typing import *
+import time
 
-from rdisq.consts import RECEIVER_SERVICE_NAME
+from rdisq.consts import RECEIVER_SERVICE_NAME, QueueName
 from rdisq.configuration import get_rdisq_config
-from rdisq.payload import SessionResult
+from rdisq.payload import SessionResult, RequestPayload
 from rdisq.request.message import RdisqMessage
-from rdisq.request.dispatcher import RequestDispatcher
+from rdisq.request.dispatcher import RequestDispatcher, ReceiverServiceStatus
 from rdisq.service import RdisqService, remote_method
+from rdisq.rate_limit import RateLimit
+from rdisq.batch import BatchOptions
 
 from rdisq.request.handler import _Handler
 
@@ -40,8 +43,14 @@ class RegisterAll(RdisqMessage):
 
 
 class AddQueue(RdisqMessage):
-    def __init__(self, new_queue_name: str):
+    def __init__(self, new_queue_name: str, priority: int = None, weight: int = None):
+        """
+        :param priority: Scheduling priority of the new queue, see rdisq.scheduling
+        :param weight: Scheduling weight of the new queue, see rdisq.scheduling
+        """
         self.new_queue_name = new_queue_name
+        self.priority = priority
+        self.weight = weight
         super().__init__()
 
 
@@ -67,8 +76,17 @@ class ShutDownReceiver(RdisqMessage):
         super().__init__()
 
 
+class GetSlowCalls(RdisqMessage):
+    def __init__(self, from_redis: bool = False):
+        """:param from_redis: Read the persisted log instead of the receiver's in-memory one."""
+        super().__init__()
+        self.from_redis = from_redis
+
+
 CORE_RECEIVER_MESSAGES = {RegisterMessage, UnregisterMessage, GetRegisteredMessages, AddQueue, RemoveQueue,
-                          RegisterAll, SetReceiverTags, ShutDownReceiver}
+                          RegisterAll, SetReceiverTags, ShutDownReceiver, GetSlowCalls}
+CONTROL_QUEUE_BASE_NAME = "rdisq_control"
+INBOX_QUEUE_BASE_NAME = "rdisq_inbox"
 
 
 class ReceiverService(RdisqService):
@@ -76,13 +94,29 @@ class ReceiverService(RdisqService):
     redis_dispatcher: RequestDispatcher
     _handlers: Dict[Type[RdisqMessage], "_Handler"]
     _tags: Dict = None
+    # In single-inbox mode, registered messages don't get queues of their own.
+    # The receiver listens on one direct inbox, plus one queue per receiver group it's added to (see AddQueue),
+    # and messages are told apart by their type when received.
+    single_inbox: bool = False
+    status_interval_seconds = 1  # how often a processing receiver refreshes its status
+    status_ttl_seconds = 60  # a receiver whose status wasn't refreshed for this long is considered dead
+    janitor_interval_seconds = 30  # how often one of the receivers cleans up after dead ones, None to disable
+    unused_queue_max_idle_seconds = 3600  # the janitor also removes generated queues unused for this long
+    _last_published_status: float = 0
+    _last_janitor_attempt: float = 0
 
     def __init__(self, uid=None, message_class: Type[RdisqMessage] = None, instance: object = None,
-                 dispatcher: RequestDispatcher = None):
+                 dispatcher: RequestDispatcher = None, single_inbox: bool = None):
         self._tags = {}
         self.redis_dispatcher = dispatcher or get_rdisq_config().request_dispatcher
+        if single_inbox is not None:
+            self.single_inbox = single_inbox
         super().__init__(uid)
         self._handlers = dict()
+        self.register_method_to_control_queue(self.receive_message, CONTROL_QUEUE_BASE_NAME)
+        if self.single_inbox:
+            self.unregister_from_queue(self.receive_message.__name__)
+            self.register_method_to_queue(self.receive_message, INBOX_QUEUE_BASE_NAME, broadcast=False)
 
         for m in CORE_RECEIVER_MESSAGES:
             handling_message = RegisterMessage(m, self)
@@ -91,7 +125,12 @@ class ReceiverService(RdisqService):
         if message_class:
             self.register_message(RegisterMessage(message_class, instance))
 
-        self._on_process_loop()
+        self.publish_status()
+
+    @classmethod
+    def get_control_queue_name(cls, uid: str) -> str:
+        """The queue through which a single receiver gets core messages, see CORE_RECEIVER_MESSAGES"""
+        return cls.get_queue_name_for_method(CONTROL_QUEUE_BASE_NAME, uid)
 
     @property
     def tags(self) -> Dict:
@@ -107,75 +146,179 @@ class ReceiverService(RdisqService):
     @ShutDownReceiver.set_handler
     def shut_down_receiver(self, message: ShutDownReceiver = None):
         self.stop()
-        self._on_process_loop()
+        self.publish_status()
 
     @AddQueue.set_handler
     def add_queue(self, message: AddQueue):
-        self.register_method_to_queue(self.receive_message, message.new_queue_name)
-        self._on_process_loop()
+        # In single-inbox mode, the inbox is the only queue that's just for this receiver
+        self.register_method_to_queue(self.receive_message, message.new_queue_name,
+                                      priority=message.priority, weight=message.weight,
+                                      direct=not self.single_inbox)
+        self.publish_status()
         return self.listening_queues
 
     @RemoveQueue.set_handler
     def remove_queue(self, message: RemoveQueue):
         self.unregister_from_queue(message.old_queue_name)
-        self._on_process_loop()
+        self.publish_status()
         return self.listening_queues
 
     @GetRegisteredMessages.set_handler
     def get_registered_messages(
             self, message: GetRegisteredMessages = None) -> Set[Type[RdisqMessage]]:
         f"""{message} is present so as not to break uniformity, but isn't used."""
-        return set(self._handlers.keys())
+        with self._registration_lock:
+            return set(self._handlers.keys())
 
     @RegisterMessage.set_handler
     def register_message(self, message: RegisterMessage) -> Set[Type[RdisqMessage]]:
-        if message.new_message_class in self.get_registered_messages():
-            raise RuntimeError(
-                f"Tried registering {message.new_message_class} to {self}."
-                f"But it's already registered."
-            )
-
-        self.add_queue(AddQueue(message.new_message_class.get_message_class_id()))
-        self._handlers[message.new_message_class] = get_rdisq_config().handler_factory.create_handler(
-            message.new_message_class, message.new_handler_instance, self._handlers.values())
-
-        self._on_process_loop()
+        with self._registration_lock:
+            if message.new_message_class in self._handlers:
+                raise RuntimeError(
+                    f"Tried registering {message.new_message_class} to {self}."
+                    f"But it's already registered."
+                )
+
+            self.__add_message_queue(message.new_message_class)
+            self._handlers[message.new_message_class] = get_rdisq_config().handler_factory.create_handler(
+                message.new_message_class, message.new_handler_instance, self._handlers.values())
+
+        self.publish_status()
         return self.get_registered_messages()
 
+    def __add_message_queue(self, message_class: Type[RdisqMessage]):
+        if not self.single_inbox:
+            self.add_queue(AddQueue(message_class.get_message_class_id(), message_class.rdisq_priority,
+                                    message_class.rdisq_weight))
+
     @RegisterAll.set_handler
     def register_all(self, message: RegisterAll) -> Set[Type[RdisqMessage]]:
         handlers: Dict[Type[RdisqMessage], "_Handler"] = get_rdisq_config().handler_factory.create_handlers_for_object(
             message.new_handler_kwargs, message.handler_class)
-        for message_type, handler in handlers.items():
-            self.add_queue(AddQueue(message_type.get_message_class_id()))
-            self._handlers[message_type] = handler
-        self._on_process_loop()
+        with self._registration_lock:
+            for message_type, handler in handlers.items():
+                self.__add_message_queue(message_type)
+                self._handlers[message_type] = handler
+        self.publish_status()
         return self.get_registered_messages()
 
     @UnregisterMessage.set_handler
     def unregister_message(self, message: UnregisterMessage):
-        self.unregister_from_queue(message.old_message_class.get_message_class_id())
-        self._handlers.pop(message.old_message_class)
+        with self._registration_lock:
+            if not self.single_inbox:
+                self.unregister_from_queue(message.old_message_class.get_message_class_id())
+            self._handlers.pop(message.old_message_class)
 
-        self._on_process_loop()
+        self.publish_status()
         return self.get_registered_messages()
 
     @SetReceiverTags.set_handler
     def set_tags(self, message: SetReceiverTags) -> Dict:
         self.tags = message.new_dict
-        self._on_process_loop()
+        self.publish_status()
         return self.tags
 
+    @GetSlowCalls.set_handler
+    def get_slow_calls_handler(self, message: GetSlowCalls):
+        return self.get_slow_calls(message.from_redis)
+
     @remote_method
     def receive_message(self, message: RdisqMessage):
-        if type(message) not in self.get_registered_messages():
+        with self._registration_lock:
+            handler = self._handlers.get(type(message))
+        if handler is None:
             raise RuntimeError(f"Received an unregistered message {type(message)}")
-        handler_result = self._handlers[type(message)].handle(message)
+        handler_result = handler.handle(message)
         if message.session_data is not None:
             result = SessionResult(result=handler_result, session_data=message.session_data)
         else:
             result = handler_result
         return result
 
+    def _get_call_name(self, call: Callable, request_payload: RequestPayload) -> str:
+        message = self.__get_received_message(request_payload)
+        if message is not None:
+            return type(message).__name__
+        return super()._get_call_name(call, request_payload)
+
+    def _get_slow_call_threshold(self, call: Callable, request_payload: RequestPayload) -> Optional[float]:
+        message = self.__get_received_message(request_payload)
+        if message is not None and type(message).rdisq_slow_call_threshold is not None:
+            return type(message).rdisq_slow_call_threshold
+        return super()._get_slow_call_threshold(call, request_payload)
+
+    def _get_batch_options(self, call: Callable, request_payload: RequestPayload) -> Optional[BatchOptions]:
+        message = self.__get_received_message(request_payload)
+        handler = self._handlers.get(type(message)) if message is not None else None
+        if handler is not None and handler.batch_options is not None:
+            return handler.batch_options
+        return super()._get_batch_options(call, request_payload)
+
+    def _call_batch(self, call: Callable,
+                    request_payloads: List[RequestPayload]) -> List[Tuple[Any, Optional[Exception]]]:
+        messages: List[RdisqMessage] = [request_payload.args[0] for request_payload in request_payloads]
+        # A batch gathered from a queue shared by several message classes goes to each class's handler separately
+        indexes_by_class: Dict[Type[RdisqMessage], List[int]] = {}
+        for i, message in enumerate(messages):
+            indexes_by_class.setdefault(type(message), []).append(i)
+        outcomes: List[Tuple[Any, Optional[Exception]]] = [(None, None)] * len(messages)
+        for message_class, indexes in indexes_by_class.items():
+            handler = self._handlers.get(message_class)
+            if handler is None:
+                error = RuntimeError(f"Received an unregistered message {message_class}")
+                class_outcomes = [(None, error)] * len(indexes)
+            else:
+                class_outcomes = handler.handle_batch([messages[i] for i in indexes])
+            for i, (result, raised_exception) in zip(indexes, class_outcomes):
+                if raised_exception is None and messages[i].session_data is not None:
+                    result = SessionResult(result=result, session_data=messages[i].session_data)
+                outcomes[i] = result, raised_exception
+        return outcomes
+
+    def _get_rate_limit(self, call: Callable, request_payload: RequestPayload) -> Optional[Tuple[str, RateLimit]]:
+        message = self.__get_received_message(request_payload)
+        if message is not None and type(message).rdisq_rate_limit is not None:
+            return message.get_message_class_id(), type(message).rdisq_rate_limit
+        return super()._get_rate_limit(call, request_payload)
+
+    def _is_dedicated_queue(self, queue_name: QueueName, call: Callable, request_payload: RequestPayload) -> bool:
+        message = self.__get_received_message(request_payload)
+        if message is None or type(message).rdisq_rate_limit is None:
+            return super()._is_dedicated_queue(queue_name, call, request_payload)
+        # The inbox and the queues of receiver groups carry messages of other classes too
+        message_queue_base_name = message.get_message_class_id()
+        return queue_name in (self.get_queue_name_for_method(message_queue_base_name),
+                              self.get_queue_name_for_method(message_queue_base_name, self.uid))
+
+    @staticmethod
+    def __get_received_message(request_payload: RequestPayload) -> Optional[RdisqMessage]:
+        if request_payload.args and isinstance(request_payload.args[0], RdisqMessage):
+            return request_payload.args[0]
+        return None
+
+    def publish_status(self) -> ReceiverServiceStatus:
+        """Write this receiver's status to redis, so requests can find it."""
+        self._last_published_status = time.time()
+        with self._registration_lock:
+            return self.redis_dispatcher.update_receiver_service_status(self)
+
+    def _on_heartbeat(self):
+        super()._on_heartbeat()
+        if time.time() - self._last_published_status >= self.status_interval_seconds:
+            self.publish_status()
+
     def _on_process_loop(self):
-        self.redis_dispatcher.update_receiver_service_status(self)
+        now = time.time()
+        if self.janitor_interval_seconds and now - self._last_janitor_attempt >= self.janitor_interval_seconds:
+            self._last_janitor_attempt = now
+            if self.redis_dispatcher.try_become_janitor(self.uid, self.janitor_interval_seconds):
+                self.__clean_up()
+
+    def __clean_up(self):
+        # if we import this at module level, it would cause a circular import
+        from rdisq.request.rdisq_request import collect_unused_queues
+        dead = self.redis_dispatcher.collect_dead_receivers()
+        if dead:
+            self.logger.info(f"Removed dead receivers {dead}")
+        if self.unused_queue_max_idle_seconds:
+            collect_unused_queues(self.unused_queue_max_idle_seconds, self.redis_dispatcher)
@@ -0,0 +1,76 @@
+from typing import *
+
+from rdisq.consts import ServiceUid
+from rdisq.identification import get_receiver_tag_index_key, get_receiver_message_index_key, is_indexed_tag_value, \
+    normalize_tag_value, INDEXED_TAG_VALUE_TYPES
+
+if TYPE_CHECKING:
+    from rdisq.request.message import RdisqMessage
+    from rdisq.request.dispatcher import ReceiverServiceStatus
+
+_TAG_OPTION_TYPES = (set, frozenset, list, tuple)
+
+
+class ReceiverFilter:
+    """
+    A service_filter made of conditions on receivers' tags, registered messages and uids.
+
+    Unlike an arbitrary filter function, it's resolved on the redis server, against index sets that receivers keep
+    up to date when they publish their status, so selecting receivers doesn't fetch the status of every one of them.
+    It can still be called on a status, like any other filter.
+    """
+
+    def __init__(self, tags: Dict = None, message_class: Type["RdisqMessage"] = None, uids: Iterable[ServiceUid] = None):
+        """
+        :param tags: Tags the receivers must have. A set, list or tuple value matches any of its items.
+            Values must be of INDEXED_TAG_VALUE_TYPES.
+        :param message_class: The receivers must handle this message class.
+        :param uids: The receivers must be among these.
+        """
+        self.tags: Dict = dict(tags or {})
+        for tag, value in self.tags.items():
+            if not all(is_indexed_tag_value(option) for option in self._get_tag_options(value)):
+                raise TypeError(f"Tag {tag} can't be filtered by {value!r}, "
+                                f"values must be of {[t.__name__ for t in INDEXED_TAG_VALUE_TYPES]}")
+        self.message_class = message_class
+        self.uids: Optional[FrozenSet[ServiceUid]] = frozenset(uids) if uids is not None else None
+
+    def __call__(self, service_status: "ReceiverServiceStatus") -> bool:
+        if self.uids is not None and service_status.uid not in self.uids:
+            return False
+        if self.message_class is not None and self.message_class not in service_status.registered_messages:
+            return False
+        for tag, value in self.tags.items():
+            if not self._has_tag(service_status.tags, tag, value):
+                return False
+        return True
+
+    def __repr__(self):
+        return f"ReceiverFilter(tags={self.tags}, message_class={self.message_class}, uids={self.uids})"
+
+    def with_message_class(self, message_class: Type["RdisqMessage"]) -> "ReceiverFilter":
+        """:return: A filter that also requires message_class, unless this one already requires a message class."""
+        if message_class is None or self.message_class is not None:
+            return self
+        return ReceiverFilter(self.tags, message_class, self.uids)
+
+    def get_index_key_groups(self) -> List[List[str]]:
+        """:return: Groups of index keys. Matching receivers are in at least one index of every group."""
+        groups = [[get_receiver_tag_index_key(tag, option) for option in self._get_tag_options(value)]
+                  for tag, value in self.tags.items()]
+        if self.message_class is not None:
+            groups.append([get_receiver_message_index_key(self.message_class.get_message_class_id())])
+        return groups
+
+    @classmethod
+    def _has_tag(cls, tags: Dict, tag, value) -> bool:
+        """Matched like the index keys on the server are"""
+        if tag not in tags or not is_indexed_tag_value(tags[tag]):
+            return False
+        return normalize_tag_value(tags[tag]) in [normalize_tag_value(o) for o in cls._get_tag_options(value)]
+
+    @staticmethod
+    def _get_tag_options(value) -> List:
+        if isinstance(value, _TAG_OPTION_TYPES):
+            return list(value)
+        return [value]
@@ -0,0 +1,70 @@
+from typing import *
+from bisect import bisect
+from functools import lru_cache
+import hashlib
+import random
+
+from rdisq.consts import ServiceUid
+from rdisq.load import get_load_score
+
+if TYPE_CHECKING:
+    from rdisq.request.dispatcher import RequestDispatcher
+
+LEAST_LOADED_ROUTING = "least_loaded"  # compare the load of every candidate receiver
+POWER_OF_TWO_ROUTING = "power_of_two"  # compare the load of two random candidates, fetching only their statuses
+ROUTING_POLICIES = frozenset({LEAST_LOADED_ROUTING, POWER_OF_TWO_ROUTING})
+
+
+def validate_routing(routing: Optional[str]):
+    if routing is not None and routing not in ROUTING_POLICIES:
+        raise RuntimeError(f"Unknown routing policy {routing}, must be one of {set(ROUTING_POLICIES)}")
+
+
+def choose_receiver(service_uids: Set[ServiceUid], dispatcher: "RequestDispatcher", routing: str) -> ServiceUid:
+    """
+    Pick the least busy of the receivers, by the load they published with their last status.
+
+    :return: The uid of the chosen receiver.
+    """
+    validate_routing(routing)
+    if not service_uids:
+        raise RuntimeError("Got empty service_uids set")
+    if len(service_uids) == 1:
+        return next(iter(service_uids))
+    candidates = sorted(service_uids)
+    if routing == POWER_OF_TWO_ROUTING:
+        candidates = random.sample(candidates, 2)
+    statuses = dispatcher.get_receiver_statuses(candidates)
+    # Ties are broken randomly, so idle receivers share the work
+    return min(candidates, key=lambda uid: (get_load_score(getattr(statuses.get(uid), "load", None)),
+                                            random.random()))
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    A consistent-hash ring of receivers.
+
+    Each receiver is placed on the ring at virtual_nodes points, and a key belongs to the receiver at the first point
+    after the key's hash. When a receiver joins or leaves, only the keys next to its points move.
+    """
+
+    def __init__(self, service_uids: Iterable[ServiceUid], virtual_nodes: int = 100):
+        points = sorted((_hash(f"{uid}#{i}"), uid) for uid in service_uids for i in range(virtual_nodes))
+        if not points:
+            raise RuntimeError("Can't build a hash ring without receivers")
+        self._hashes = [h for h, _ in points]
+        self._uids = [uid for _, uid in points]
+
+    def get_receiver(self, routing_key: Hashable) -> ServiceUid:
+        index = bisect(self._hashes, _hash(str(routing_key))) % len(self._hashes)
+        return self._uids[index]
+
+
+@lru_cache(maxsize=64)
+def get_hash_ring(service_uids: FrozenSet[ServiceUid]) -> HashRing:
+    """:return: The ring of these receivers, built once for each set of receivers."""
+    return HashRing(service_uids)
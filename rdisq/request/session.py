@@ -5,6 +5,7 @@ import uuid
 from rdisq.consts import RdisqSessionUid, ServiceUid
 from rdisq.request.message import RdisqMessage
 from rdisq.request.rdisq_request import RdisqRequest
+from rdisq.request.routing import validate_routing
 
 if TYPE_CHECKING:
     from rdisq.request.dispatcher import ReceiverServiceStatus
@@ -21,10 +22,13 @@ class RdisqSession:
     _request: Optional[RdisqRequest]
     session_data: Dict = None
 
-    def __init__(self, filter_: Callable[["ReceiverServiceStatus"], bool] = None):
+    def __init__(self, filter_: Callable[["ReceiverServiceStatus"], bool] = None, routing: str = None):
+        """:param routing: How the session picks the receiver it binds to, see rdisq.request.routing"""
+        validate_routing(routing)
         self._session_id = RdisqSessionUid(f"rdisq_session_{uuid.uuid4()}")
         self._request = None
         self._service_filter = filter_
+        self._routing = routing
         self.session_data = {}
 
     @property
@@ -39,7 +43,7 @@ class RdisqSession:
             if self._service_id:
                 self._request = RdisqRequest(message, targets={self._service_id})
             else:
-                self._request = RdisqRequest(message, service_filter=self._service_filter)
+                self._request = RdisqRequest(message, service_filter=self._service_filter, routing=self._routing)
             self._request.send_async()
 
     def send_and_wait(self, message: RdisqMessage, timeout: int = None):
@@ -1,11 +1,15 @@
 __author__ = 'smackware'
 
 from typing import *
+import math
 import time
 
 from redis import Redis
 
-from rdisq.consts import QueueName
+from rdisq.consts import QueueName, MIN_BLOCKING_TIMEOUT
+from rdisq.identification import get_request_key, get_delayed_queue_key, get_stream_ack_key
+from rdisq.payload import StreamChunk
+from rdisq.stream import STOP
 
 if TYPE_CHECKING:
     from rdisq.redis_dispatcher import AbstractRedisDispatcher
@@ -22,6 +26,13 @@ class RdisqResponseTimeout(Exception):
         self.task_id = task_id
 
 
+class RdisqTaskCancelled(Exception):
+    task_id = None
+
+    def __init__(self, task_id):
+        self.task_id = task_id
+
+
 class RdisqResponse(object):
     _task_id = None
     rdisq_consumer: "AbstractRdisqConsumer"
@@ -30,13 +41,24 @@ class RdisqResponse(object):
     called_at_unixtime = None
     timeout = None
     default_timeout = 10
+    cache_key: str = None
+    cache_ttl: int = None
+    queue_name: QueueName = None  # where the request was sent
+    send_at: float = None  # for delayed tasks, when they're due
+    no_reply = False  # sent as fire and forget, so it's never answered
+    cancellable = True  # False for calls that other callers wait on too, e.g coalesced ones
+    cancelled = False
+    buffered = False  # held by the dispatcher's micro batcher, and not in redis yet
 
     @property
     def returned_value(self):
         return self.response_payload.returned_value
 
     def __init__(self, task_id: QueueName, rdisq_consumer: "AbstractRdisqConsumer" = None,
-                 dispatcher: "AbstractRedisDispatcher" = None):
+                 dispatcher: "AbstractRedisDispatcher" = None, response_payload: "ResponsePayload" = None):
+        """
+        :param response_payload: For responses that are already known (e.g cached), so waiting returns immediately.
+        """
         if not rdisq_consumer and not dispatcher:
             raise RuntimeError("RdisqResponse initialized without consumer and without dispatcher.")
 
@@ -47,6 +69,9 @@ class RdisqResponse(object):
         else:
             self.dispatcher = dispatcher
         self.called_at_unixtime = time.time()
+        if response_payload is not None:
+            self.total_time_seconds = 0
+            self.response_payload = response_payload
 
     def get_service_timeout(self) -> int:
         if self.rdisq_consumer:
@@ -54,6 +79,13 @@ class RdisqResponse(object):
         else:
             return self.default_timeout
 
+    def get_default_timeout(self) -> float:
+        """:return: Seconds wait() waits if no timeout is given"""
+        timeout = self.get_service_timeout()
+        if self.send_at is not None:
+            timeout += max(0, math.ceil(self.send_at - time.time()))
+        return timeout
+
     @property
     def task_id(self):
         return self._task_id
@@ -78,21 +110,267 @@ class RdisqResponse(object):
     def exception(self):
         return self.response_payload.raised_exception
 
-    def wait(self, timeout=None):
+    def wait(self, timeout=None, cancel_on_timeout: bool = None):
+        """
+        :param cancel_on_timeout: Cancel the task if it isn't answered in time, so no worker wastes time on it.
+            Defaults to the dispatcher's cancel_on_timeout.
+        """
+        if self.response_payload is not None:
+            return self.__get_result()
+        self.__check_waitable()
         if not timeout:
-            timeout = self.get_service_timeout()
-        redis_response = self.redis_con.brpop(self._task_id,
-                                              timeout=timeout)  # can be tuple of (queue_base_name, string) or None
+            timeout = self.get_default_timeout()
+        redis_response = _pop(self.redis_con, [self._task_id],
+                              timeout)  # can be tuple of (queue_base_name, string) or None
         if redis_response is None:
+            self._on_timeout(cancel_on_timeout)
             raise RdisqResponseTimeout(self._task_id)
         queue_name, response = redis_response
         return self.process_response(response)
 
+    def stream(self, timeout: float = None) -> Iterator:
+        """
+        Iterate over the values a generator handler yields, as they arrive, without holding all of them.
+        Each value is acknowledged once the next one is read, and the worker stays at most its stream_window
+        values ahead. The returned value of a regular handler is yielded as is.
+        wait() on a generator handler's response returns the list of its values.
+
+        :param timeout: Seconds to wait for each value.
+        """
+        if self.response_payload is None:
+            self.__check_waitable()
+            yield from self.__read_stream(timeout or self.get_default_timeout())
+            if self.response_payload.chunk_count is not None:
+                self.__get_result()  # raises the handler's exception, if any
+                return
+        result = self.__get_result()
+        if self.response_payload.chunk_count is None:
+            yield result
+        else:
+            yield from result
+
+    def __read_stream(self, timeout: float, unacked: int = 0) -> Iterator:
+        """Yield the streamed values until the reply that ends the stream is recorded, see rdisq.stream"""
+        redis_con = self.redis_con
+        ack_key = get_stream_ack_key(self._task_id)
+        try:
+            while True:
+                # Acknowledging the values read so far takes no round trip of its own
+                pipe = redis_con.pipeline(transaction=False)
+                if unacked:
+                    pipe.lpush(ack_key, unacked)
+                    pipe.expire(ack_key, math.ceil(timeout))
+                pipe.brpop(self._task_id, timeout=max(timeout, MIN_BLOCKING_TIMEOUT))
+                redis_response = pipe.execute()[-1]
+                unacked = 0
+                if redis_response is None:
+                    self._on_timeout()
+                    raise RdisqResponseTimeout(self._task_id)
+                response = redis_response[1]
+                response_payload = self.dispatcher.serializer.loads(response)
+                if not isinstance(response_payload, StreamChunk):
+                    self.__set_response_payload(response_payload, response)
+                    return
+                unacked += 1
+                yield response_payload.value
+        finally:
+            if self.response_payload is None:
+                # The worker stops producing the next time it waits for the caller
+                pipe = redis_con.pipeline(transaction=False)
+                pipe.lpush(ack_key, STOP)
+                pipe.expire(ack_key, math.ceil(timeout))
+                pipe.execute()
+
+    def __check_waitable(self):
+        if self.cancelled:
+            raise RdisqTaskCancelled(self._task_id)
+        if self.no_reply:
+            raise RuntimeError(f"Task {self._task_id} was sent with no_reply, it has no response to wait for")
+
+    def _on_timeout(self, cancel_on_timeout: bool = None):
+        self._record_outcome(answered=False)
+        if cancel_on_timeout is None:
+            cancel_on_timeout = self.dispatcher.cancel_on_timeout
+        if cancel_on_timeout:
+            self.cancel()
+
+    def cancel(self) -> bool:
+        """
+        Stop the task from being handled: it's removed from its queue, and if a worker already popped it,
+        its request is deleted so the worker skips it. A worker claims the request when it takes the task on,
+        after which the task can't be stopped, but a generator handler stops streaming its values.
+
+        :return: Whether the task was cancelled before a worker took it on.
+        """
+        if self.response_payload is not None or self.queue_name is None or not self.cancellable:
+            return False
+        # Set before checking if it's buffered, the micro batcher checks in the opposite order
+        self.cancelled = True
+        if self.buffered:
+            return True
+        ack_key = get_stream_ack_key(self._task_id)
+        pipe = self.redis_con.pipeline()
+        pipe.lrem(self.queue_name, 0, self._task_id)
+        pipe.zrem(get_delayed_queue_key(self.queue_name), self._task_id)
+        pipe.delete(get_request_key(self._task_id))
+        pipe.lpush(ack_key, STOP)
+        pipe.expire(ack_key, math.ceil(self.get_default_timeout()))
+        removed_from_queue, removed_from_delayed, deleted_request, _, _ = pipe.execute()
+        # A task a worker already took on is still answered
+        self.cancelled = bool(removed_from_queue or removed_from_delayed or deleted_request)
+        return self.cancelled
+
+    def _record_outcome(self, answered: bool):
+        """Let the circuit breaker of the request's queue know if the service answered, see rdisq.circuit_breaker"""
+        breaker = self.dispatcher.get_circuit_breaker(self.queue_name) if self.queue_name else None
+        if breaker is None:
+            return
+        if answered:
+            breaker.on_success()
+        else:
+            breaker.on_failure()
+
+    def _get_reply_keys(self) -> List[str]:
+        """:return: The keys the reply may arrive on."""
+        return [self._task_id]
+
+    def _on_reply(self, reply_key: str, response: bytes):
+        """Record a reply that was popped from reply_key, without raising the exception it may carry."""
+        self._load_response(response)
+
     def process_response(self, response):
-        self.total_time_seconds = time.time() - self.called_at_unixtime
+        self._load_response(response)
+        return self.__get_result()
+
+    def _load_response(self, response: bytes):
         response_payload = self.dispatcher.serializer.loads(response)
+        if isinstance(response_payload, StreamChunk):
+            # The first value of a generator handler, the rest of them are collected into a list
+            values = [response_payload.value]
+            values.extend(self.__read_stream(self.get_default_timeout(), unacked=1))
+            self.response_payload = self.response_payload._replace(returned_value=values)
+            return
+        self.__set_response_payload(response_payload, response)
+
+    def __set_response_payload(self, response_payload: "ResponsePayload", response: bytes):
+        self._record_outcome(answered=True)
+        self.total_time_seconds = time.time() - self.called_at_unixtime
         self.redis_con.delete(self._task_id)
         self.response_payload = response_payload
+        if self.cache_key and response_payload.raised_exception is None and response_payload.chunk_count is None:
+            self.dispatcher.result_cache.remember(self.cache_key, response, self.cache_ttl)
+
+    def __get_result(self):
         if self.is_exception():
             raise self.exception
         return self.response_payload.returned_value
+
+
+def _is_done(response: RdisqResponse) -> bool:
+    return response.response_payload is not None or response.cancelled
+
+
+def _pop(redis_con: Redis, keys: List[str], timeout: float) -> Optional[Tuple[bytes, bytes]]:
+    """
+    BRPOP the keys. A timeout too short for the server to block on would make it wait forever,
+    so the keys are then popped without blocking.
+    """
+    if timeout >= MIN_BLOCKING_TIMEOUT:
+        return redis_con.brpop(keys, timeout=timeout)
+    for key in keys:
+        reply = redis_con.rpop(key)
+        if reply is not None:
+            return key.encode(), reply
+    return None
+
+
+def _pop_any(responses: List[RdisqResponse], timeout: float) -> Optional[RdisqResponse]:
+    """
+    Wait up to timeout for a reply to any of the responses, and record it.
+    Responses of the same dispatcher are waited on with a single BRPOP.
+
+    :return: The answered response, or None on timeout.
+    """
+    done = next((r for r in responses if _is_done(r)), None)
+    if done is not None:
+        return done
+    by_dispatcher: Dict[int, Dict[str, RdisqResponse]] = {}
+    for r in responses:
+        by_dispatcher.setdefault(id(r.dispatcher), {}).update((key, r) for key in r._get_reply_keys())
+    groups = list(by_dispatcher.values())
+    give_up_at = time.time() + timeout
+    while True:
+        for by_key in groups:
+            redis_con = next(iter(by_key.values())).redis_con
+            remaining = give_up_at - time.time()
+            # With several dispatchers, take turns so none of them is waited on for long.
+            # Fractional timeouts need redis 6.0, see the README
+            redis_response = _pop(redis_con, list(by_key), remaining if len(groups) == 1 else min(remaining, 0.05))
+            if redis_response is not None:
+                reply_key, response = redis_response
+                answered = by_key[reply_key.decode()]
+                answered._on_reply(reply_key.decode(), response)
+                return answered
+        if time.time() >= give_up_at:
+            return None
+
+
+def _get_timeout(responses: List[RdisqResponse], timeout: Optional[float]) -> float:
+    if timeout:
+        return timeout
+    return max((r.get_default_timeout() for r in responses), default=0)
+
+
+def as_completed(responses: Iterable[RdisqResponse], timeout: float = None) -> Iterator[RdisqResponse]:
+    """
+    Yield the responses as they're answered. Their wait() then returns right away, with the result or the exception.
+
+    :param timeout: Seconds for all of them to be answered, defaults to the longest default timeout among them.
+        Once it passes, RdisqResponseTimeout is raised for the first one that wasn't answered.
+    """
+    pending = list(responses)
+    give_up_at = time.time() + _get_timeout(pending, timeout)
+    while pending:
+        answered = _pop_any(pending, give_up_at - time.time())
+        if answered is None:
+            for r in pending:
+                r._on_timeout()
+            raise RdisqResponseTimeout(pending[0].task_id)
+        pending.remove(answered)
+        yield answered
+
+
+def wait_any(responses: Iterable[RdisqResponse], timeout: float = None) -> RdisqResponse:
+    """:return: The first of the responses to be answered, see as_completed."""
+    return next(as_completed(responses, timeout))
+
+
+def gather(responses: Iterable[RdisqResponse], timeout: float = None, return_exceptions: bool = False) -> List:
+    """
+    Wait for all the responses, waiting on their replies together rather than one after the other.
+
+    :param timeout: Seconds for all of them to be answered, see as_completed.
+    :param return_exceptions: Instead of raising the first exception that arrives, or a timeout, return
+        the exceptions in place of the results. Responses that weren't answered in time get RdisqResponseTimeout.
+    :return: The results, in the order of the responses.
+    """
+    responses = list(responses)
+    try:
+        for answered in as_completed(responses, timeout):
+            if not return_exceptions:
+                answered.wait()
+    except RdisqResponseTimeout:
+        if not return_exceptions:
+            raise
+    results = []
+    for r in responses:
+        if not _is_done(r):
+            results.append(RdisqResponseTimeout(r.task_id))
+            continue
+        try:
+            results.append(r.wait())
+        except Exception as ex:
+            if not return_exceptions:
+                raise
+            results.append(ex)
+    return results
@@ -0,0 +1,80 @@
+from typing import *
+
+from rdisq.consts import QueueName
+
+PRIORITY_POLICY = "priority"  # strictly prefer higher-priority queues
+WEIGHTED_POLICY = "weighted"  # strict across priority levels, weighted round-robin within a level
+SCHEDULING_POLICIES = frozenset({PRIORITY_POLICY, WEIGHTED_POLICY})
+
+
+class QueuePriority(NamedTuple):
+    priority: int = 0
+    weight: int = 1
+
+
+DEFAULT_QUEUE_PRIORITY = QueuePriority()
+
+
+class QueueScheduler:
+    """
+    Decides the order in which a service's queues are polled.
+
+    BRPOP serves the first non-empty queue in its key list, so the order of the list is the schedule.
+    With the weighted policy, queues of the same priority take turns being first in proportion to their weights
+    (smooth weighted round-robin, advanced by the queue that was actually served).
+    """
+
+    def __init__(self, policy: str = PRIORITY_POLICY):
+        if policy not in SCHEDULING_POLICIES:
+            raise RuntimeError(f"Unknown scheduling policy {policy}, must be one of {set(SCHEDULING_POLICIES)}")
+        self.policy = policy
+        self._priorities: Dict[QueueName, QueuePriority] = {}
+        self._current_weights: Dict[QueueName, int] = {}
+        self._last_order: Tuple[FrozenSet[QueueName], List[QueueName]] = (frozenset(), [])
+
+    def set_queue_priority(self, queue_name: QueueName, priority: int = 0, weight: int = 1):
+        if weight < 1:
+            raise RuntimeError("Queue weight must be a positive integer")
+        self._priorities[queue_name] = QueuePriority(priority, weight)
+        self._last_order = (frozenset(), [])
+
+    def get_queue_priority(self, queue_name: QueueName) -> QueuePriority:
+        return self._priorities.get(queue_name, DEFAULT_QUEUE_PRIORITY)
+
+    def remove_queue(self, queue_name: QueueName):
+        self._priorities.pop(queue_name, None)
+        self._current_weights.pop(queue_name, None)
+        self._last_order = (frozenset(), [])
+
+    def clear(self):
+        self._priorities.clear()
+        self._current_weights.clear()
+        self._last_order = (frozenset(), [])
+
+    def order(self, queues: FrozenSet[QueueName]) -> List[QueueName]:
+        """:return: The queues, in the order they should be polled."""
+        if self.policy == WEIGHTED_POLICY:
+            return sorted(queues, key=lambda q: (-self.get_queue_priority(q).priority,
+                                                 -self._current_weights.get(q, 0), q))
+        cached_queues, cached_order = self._last_order
+        if cached_queues != queues:
+            cached_order = sorted(queues, key=lambda q: (-self.get_queue_priority(q).priority, q))
+            self._last_order = (queues, cached_order)
+        return cached_order
+
+    def on_served(self, served_queue: QueueName, queues: Iterable[QueueName]):
+        """Advance the round-robin after a task was taken from served_queue."""
+        if self.policy != WEIGHTED_POLICY:
+            return
+        priority = self.get_queue_priority(served_queue).priority
+        level = [q for q in queues if self.get_queue_priority(q).priority == priority]
+        total_weight = sum(self.get_queue_priority(q).weight for q in level)
+        for q in level:
+            # Capped, so a queue that was idle for a long time can't hog the worker once it fills up
+            self._current_weights[q] = min(self._current_weights.get(q, 0) + self.get_queue_priority(q).weight,
+                                           total_weight)
+        self._current_weights[served_queue] = self._current_weights.get(served_queue, 0) - total_weight
+
+    def describe(self) -> Dict:
+        """:return: The policy and the non-default queue priorities, for publishing in a service's status."""
+        return {"policy": self.policy, "queues": dict(self._priorities)}
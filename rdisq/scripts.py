@@ -0,0 +1,274 @@
+"""Lua scripts for operations that have to be atomic on the redis server."""
+from typing import *
+import threading
+
+from redis import Redis
+from redis.client import Script
+
+# KEYS: in-flight key of the call, coalesced call key of our task
+# ARGV: our task id, expiry seconds, prefix of waiters keys
+# If an identical call is already in flight, attach our task id to its waiters and return the leader's task id.
+# Otherwise mark our task as the one in flight and return nil.
+JOIN_IN_FLIGHT = """
+local leader = redis.call('GET', KEYS[1])
+if leader then
+    local waiters_key = ARGV[3] .. leader
+    redis.call('RPUSH', waiters_key, ARGV[1])
+    redis.call('EXPIRE', waiters_key, ARGV[2])
+    return leader
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+redis.call('SET', KEYS[2], KEYS[1], 'EX', ARGV[2])
+return false
+"""
+
+# KEYS: in-flight key of the call, waiters key of the finished task, coalesced call key of the finished task
+# ARGV: finished task id, serialized response, response expiry seconds
+# Clears the in-flight mark and pushes the response to every attached waiter. Returns the number of waiters.
+RELEASE_IN_FLIGHT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+end
+redis.call('DEL', KEYS[3])
+local waiters = redis.call('LRANGE', KEYS[2], 0, -1)
+redis.call('DEL', KEYS[2])
+for _, waiter in ipairs(waiters) do
+    redis.call('LPUSH', waiter, ARGV[2])
+    redis.call('EXPIRE', waiter, ARGV[3])
+end
+return #waiters
+"""
+
+# KEYS: queue, request key of the task, hash of queue depth limits
+# ARGV: task id, serialized request, request expiry seconds, admission policy,
+#       prefix of request keys, serialized response for a dropped task,
+#       prefix of coalesced call keys, prefix of waiters keys
+# Queues the task, unless the queue is at its depth limit. Under the drop_oldest policy, the oldest task is dropped
+# to make room, and its caller is sent the given response, as are the callers attached to it if it leads
+# a coalesced call. Returns 1 if the task was queued, 0 if not.
+# The keys of the dropped task are only known on the server, so they can't be declared, and drop_oldest
+# doesn't work on Redis Cluster.
+ENQUEUE = """
+local max_depth = tonumber(redis.call('HGET', KEYS[3], KEYS[1]))
+if max_depth and redis.call('LLEN', KEYS[1]) >= max_depth then
+    if ARGV[4] ~= 'drop_oldest' then
+        return 0
+    end
+    local dropped = redis.call('RPOP', KEYS[1])
+    if dropped then
+        redis.call('DEL', ARGV[5] .. dropped)
+        redis.call('LPUSH', dropped, ARGV[6])
+        redis.call('EXPIRE', dropped, ARGV[3])
+        local coalesced_call_key = ARGV[7] .. dropped
+        local in_flight_key = redis.call('GET', coalesced_call_key)
+        if in_flight_key then
+            redis.call('DEL', coalesced_call_key)
+            if redis.call('GET', in_flight_key) == dropped then
+                redis.call('DEL', in_flight_key)
+            end
+            local waiters_key = ARGV[8] .. dropped
+            for _, waiter in ipairs(redis.call('LRANGE', waiters_key, 0, -1)) do
+                redis.call('LPUSH', waiter, ARGV[6])
+                redis.call('EXPIRE', waiter, ARGV[3])
+            end
+            redis.call('DEL', waiters_key)
+        end
+    end
+end
+redis.call('SETEX', KEYS[2], ARGV[3], ARGV[2])
+redis.call('LPUSH', KEYS[1], ARGV[1])
+return 1
+"""
+
+# KEYS: set of the index keys a receiver is currently in
+# ARGV: receiver uid, the index keys it should be in
+# Moves the receiver from its previous index sets to the given ones.
+UPDATE_RECEIVER_INDEXES = """
+for _, index_key in ipairs(redis.call('SMEMBERS', KEYS[1])) do
+    redis.call('SREM', index_key, ARGV[1])
+end
+redis.call('DEL', KEYS[1])
+for i = 2, #ARGV do
+    redis.call('SADD', ARGV[i], ARGV[1])
+    redis.call('SADD', KEYS[1], ARGV[i])
+end
+return #ARGV - 1
+"""
+
+# KEYS: hash of receiver statuses, sorted set of live receivers, set of the index keys the receiver is in,
+#       then the keys of queues only the receiver used
+# ARGV: receiver uid, current time
+# Removes a dead receiver, unless its status was refreshed since it was found dead. Returns 1 if it was removed.
+COLLECT_DEAD_RECEIVER = """
+local expires_at = redis.call('ZSCORE', KEYS[2], ARGV[1])
+if expires_at and tonumber(expires_at) > tonumber(ARGV[2]) then
+    return 0
+end
+redis.call('HDEL', KEYS[1], ARGV[1])
+redis.call('ZREM', KEYS[2], ARGV[1])
+for _, index_key in ipairs(redis.call('SMEMBERS', KEYS[3])) do
+    redis.call('SREM', index_key, ARGV[1])
+end
+for i = 3, #KEYS do
+    redis.call('DEL', KEYS[i])
+end
+return 1
+"""
+
+# KEYS: sorted set of live receivers, scored by when their status expires
+# ARGV: current time, prefix of queue index keys, prefix of the sets of index keys receivers are in, receiver uids
+# Returns the queues that exactly the given receivers, of the live ones, listen to.
+FIND_QUEUES = """
+local now = tonumber(ARGV[1])
+local prefix = ARGV[2]
+local wanted = {}
+for i = 4, #ARGV do
+    wanted[ARGV[i]] = true
+end
+local found = {}
+for _, index_key in ipairs(redis.call('SMEMBERS', ARGV[3] .. ARGV[4])) do
+    if string.sub(index_key, 1, #prefix) == prefix then
+        local live_count = 0
+        local matches = true
+        for _, uid in ipairs(redis.call('SMEMBERS', index_key)) do
+            local expires_at = redis.call('ZSCORE', KEYS[1], uid)
+            if expires_at and tonumber(expires_at) > now then
+                if not wanted[uid] then
+                    matches = false
+                    break
+                end
+                live_count = live_count + 1
+            end
+        end
+        if matches and live_count == #ARGV - 3 then
+            table.insert(found, string.sub(index_key, #prefix + 1))
+        end
+    end
+end
+return found
+"""
+
+# KEYS: sorted set of live receivers, scored by when their status expires
+# ARGV: current time, number of candidate uids, the candidate uids,
+#       then groups of index keys, each given as the number of keys followed by the keys
+# Returns the live receivers that are candidates (if any were given), and are in at least one index of every group.
+FIND_RECEIVERS = """
+local now = tonumber(ARGV[1])
+local candidate_count = tonumber(ARGV[2])
+local selected = nil
+if candidate_count > 0 then
+    selected = {}
+    for i = 3, 2 + candidate_count do
+        selected[ARGV[i]] = true
+    end
+end
+local i = 3 + candidate_count
+while i <= #ARGV do
+    local key_count = tonumber(ARGV[i])
+    local members
+    if key_count == 1 then
+        members = redis.call('SMEMBERS', ARGV[i + 1])
+    else
+        members = redis.call('SUNION', unpack(ARGV, i + 1, i + key_count))
+    end
+    local group = {}
+    for _, uid in ipairs(members) do
+        group[uid] = true
+    end
+    if selected == nil then
+        selected = group
+    else
+        for uid in pairs(selected) do
+            if not group[uid] then
+                selected[uid] = nil
+            end
+        end
+    end
+    i = i + key_count + 1
+end
+if selected == nil then
+    return redis.call('ZRANGEBYSCORE', KEYS[1], '(' .. ARGV[1], '+inf')
+end
+local live = {}
+for uid in pairs(selected) do
+    local expires_at = redis.call('ZSCORE', KEYS[1], uid)
+    if expires_at and tonumber(expires_at) > now then
+        table.insert(live, uid)
+    end
+end
+return live
+"""
+
+# KEYS: token bucket of the rate limit
+# ARGV: tokens added per second, bucket capacity, tokens to take (0 only checks)
+# Refills the bucket by the time passed since it was last used, by the server's clock, then takes the tokens if
+# there are enough. Returns 0 if they were taken, otherwise the seconds until there will be enough, as a string.
+TAKE_TOKENS = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(bucket[1]) or capacity
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated_at) * rate)
+local needed = math.max(requested, 1)
+if tokens < needed then
+    return tostring((needed - tokens) / rate)
+end
+if requested > 0 then
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens - requested), 'updated_at', tostring(now))
+    redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+end
+return '0'
+"""
+
+# KEYS: request key of the task, delayed tasks of its queue
+# ARGV: task id, serialized request, request expiry milliseconds (0 for none), seconds until the task is due
+# Keeps the task aside until it's due. Due times are by the server's clock, so clocks of senders and workers
+# don't have to agree.
+SCHEDULE_TASK = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+if tonumber(ARGV[3]) > 0 then
+    redis.call('SET', KEYS[1], ARGV[2], 'PX', ARGV[3])
+else
+    redis.call('SET', KEYS[1], ARGV[2])
+end
+redis.call('ZADD', KEYS[2], now + tonumber(ARGV[4]), ARGV[1])
+return 1
+"""
+
+# KEYS: delayed tasks of the queue, the queue
+# ARGV: most tasks to move
+# Moves the tasks that are due by the server's clock to the queue, the earliest due first in line.
+# They're moved in chunks, since unpack() is limited in how many values it can return.
+# Returns the seconds until the next remaining task is due, or nil if none remain.
+MOVE_DUE_TASKS = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now, 'LIMIT', 0, ARGV[1])
+for first = 1, #due, 1000 do
+    local last = math.min(first + 999, #due)
+    redis.call('ZREM', KEYS[1], unpack(due, first, last))
+    redis.call('LPUSH', KEYS[2], unpack(due, first, last))
+end
+local next_task = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+if #next_task == 0 then
+    return false
+end
+return tostring(tonumber(next_task[2]) - now)
+"""
+
+_scripts: Dict[str, Script] = {}
+_scripts_lock = threading.Lock()
+
+
+def run_script(redis_con: Redis, source: str, keys: List = (), args: List = ()) -> Any:
+    """Run a script by its sha, loading it to the server on first use."""
+    with _scripts_lock:
+        script = _scripts.get(source)
+        if script is None:
+            script = _scripts[source] = redis_con.register_script(source)
+    return script(keys=list(keys), args=list(args), client=redis_con)
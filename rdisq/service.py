@@ -1,12 +1,14 @@
 __author__ = 'smackware'
 
+import inspect
 import math
 from typing import *
 import time
 import uuid
 import logging
+import threading
 
-from .consts import QueueName
+from .consts import QueueName, MIN_BLOCKING_TIMEOUT
 from rdisq.configuration import get_rdisq_config
 
 if TYPE_CHECKING:
@@ -22,18 +24,76 @@ from . import EXPORTED_METHOD_PREFIX
 from .payload import RequestPayload, SessionResult
 from .payload import ResponsePayload
 
-from .identification import get_request_key
+from .identification import (get_request_key, get_waiters_key, get_coalesced_call_key, get_task_deadline,
+                             get_delayed_queue_key)
+from .deadline import deadline_scope, RdisqDeadlineExceeded, EXPIRED, UNMEETABLE
+from .scripts import run_script, RELEASE_IN_FLIGHT, MOVE_DUE_TASKS, SCHEDULE_TASK
 from .serialization import PickleSerializer
+from .slow_log import SlowCallLog, SlowCall, summarize_args
+from .scheduling import QueueScheduler, QueuePriority, PRIORITY_POLICY
+from .load import ServiceLoad
+from .rate_limit import RateLimit, take_token
+from .batch import BatchOptions, call_batch
+from .stream import send_stream
 
 from .redis_dispatcher import AbstractRedisDispatcher
 from .consumer import RdisqAsyncConsumer
 from .consumer import RdisqWaitingConsumer
 
 
+class _StreamedResult(NamedTuple):
+    """Replied with in place of a generator, whose values were already sent"""
+    chunk_count: int
+
+
+def _collect(result: Any) -> Any:
+    """A generator's values can't be streamed from within a chunk task, they're returned as a list"""
+    return list(result) if inspect.isgenerator(result) else result
+
+
 # Decorator
-def remote_method(callable_object):
-    callable_object.is_remote = True
-    return callable_object
+def remote_method(callable_object: Callable = None, *, slow_call_threshold: float = None, cache_ttl: int = None,
+                  coalesce: bool = False, priority: int = None, weight: int = None, rate_limit: RateLimit = None,
+                  batch_size: int = None, max_wait: float = 0):
+    """
+    Can be used bare (@remote_method) or with options (@remote_method(slow_call_threshold=0.5)).
+
+    :param slow_call_threshold: Calls to this method taking longer than this (seconds) are recorded as slow.
+        Overrides the service's slow_call_threshold.
+    :param cache_ttl: For pure methods. Results are cached for this many seconds, keyed by the call's arguments,
+        and consumers are answered from the cache without queueing a task.
+    :param coalesce: For idempotent methods. A call identical to one that's already in flight doesn't queue a task,
+        it waits for the in-flight call's reply instead.
+    :param priority: Queues of higher priority methods are served first.
+    :param weight: Under the weighted scheduling policy, share of the worker this method gets among its priority level.
+    :param rate_limit: How often the method may be called, across all instances of the service.
+        Calls over the limit wait in the queue for their turn.
+    :param batch_size: Make the method a batch handler: it's called with a list of up to batch_size queued calls'
+        arguments (each call passes a single one), and returns a list with the result of each, in order.
+        An exception in the returned list is raised to the caller of that item alone.
+    :param max_wait: For batch handlers, seconds to wait for more calls when fewer than batch_size are queued.
+    """
+    def decorate(c: Callable) -> Callable:
+        c.is_remote = True
+        if slow_call_threshold is not None:
+            c.slow_call_threshold = slow_call_threshold
+        if cache_ttl is not None:
+            c.cache_ttl = cache_ttl
+        if coalesce:
+            c.coalesce = True
+        if priority is not None:
+            c.priority = priority
+        if weight is not None:
+            c.weight = weight
+        if rate_limit is not None:
+            c.rate_limit = rate_limit
+        if batch_size is not None:
+            c.batch_options = BatchOptions(batch_size, max_wait)
+        return c
+
+    if callable_object is None:
+        return decorate
+    return decorate(callable_object)
 
 
 class RdisqService(object):
@@ -56,6 +116,25 @@ class RdisqService(object):
     service_name = None
     response_timeout = 10
     polling_timeout = 1
+    slow_call_threshold: float = None  # seconds, None means slow calls are not recorded
+    slow_call_log_size = 100
+    persist_slow_calls = False  # also keep the slow call log in redis
+    scheduling_policy = PRIORITY_POLICY  # how queues are ordered when polling, see rdisq.scheduling
+    use_control_lane = True  # serve control queues on their own thread while process() runs
+    presence_window_seconds = 10  # instances that didn't report in this long aren't listed as live
+    presence_interval_seconds = 1  # how often a processing instance reports it's live
+    heartbeat_tick_seconds = 0.1  # how often the heartbeat thread checks if a report is due
+    _last_reported_presence: float = 0
+    shed_unmeetable_deadlines = True  # drop tasks whose deadline would pass before their handler finishes
+    abandoned_task_count = 0  # tasks skipped since their request was cancelled or expired
+    rate_limit_max_defer = 1  # seconds to wait for a rate limited call's turn before returning it to its queue
+    rate_limited_task_count = 0  # tasks returned to their queue since their rate limit was used up
+    unreplied_error_count = 0  # exceptions raised by no_reply tasks, which are logged instead of sent back
+    delayed_task_check_interval = 0.5  # seconds between checks for delayed tasks that are due, see queue_task
+    delayed_task_batch_size = 1000  # most due tasks moved to a queue at once
+    stream_window = 16  # most values of a generator handler sent ahead of what the caller read, see rdisq.stream
+    stream_ack_timeout = 10  # seconds a generator handler waits for the caller to read, before abandoning the stream
+    latency_ewma_alpha = 0.2  # weight of the latest call in the published handler latency, see get_load
     redis_dispatcher: "AbstractRedisDispatcher" = None
     serializer: ClassVar[PickleSerializer] = PickleSerializer()
     __keep_working = True
@@ -66,6 +145,7 @@ class RdisqService(object):
     _queue_to_callable: Dict[QueueName, Callable]
     _broadcast_queues: Set[QueueName]
     _direct_queues: Set[QueueName]
+    _control_queues: Set[QueueName]
 
     def __init__(self, uid=None):
         if self.redis_dispatcher is None:
@@ -76,6 +156,20 @@ class RdisqService(object):
         if self.logger is None:
             self.logger = self.__setup_logger(self.__uid, logging.DEBUG)
         self.__is_suspended = False
+        self.slow_call_log = SlowCallLog(
+            self.slow_call_log_size, self.get_slow_call_log_key(self.__uid) if self.persist_slow_calls else None)
+        self.queue_scheduler = QueueScheduler(self.scheduling_policy)
+        self._in_flight = 0
+        self._latency_ewma: Optional[float] = None
+        self._queue_latency_ewma: Dict[QueueName, float] = {}
+        self._stream_waits = threading.local()  # seconds the handler of each thread waited on a stream's caller
+        self._shed_counts: Dict[str, int] = {EXPIRED: 0, UNMEETABLE: 0}
+        self._load_lock = threading.Lock()
+        # Guards the registered queues and handlers, which the control lane may change while they're polled
+        self._registration_lock = threading.RLock()
+        self._paused_queues: Dict[QueueName, float] = {}  # queue -> when its rate limit allows polling it again
+        self._next_delayed_check = 0.0
+        self._next_delayed_due = math.inf
         self.__map_exposed_methods_to_queues()
 
     def __setup_logger(self, name, level: int):
@@ -142,19 +236,40 @@ class RdisqService(object):
 
     @classmethod
     def get_service_uid_list_key(cls):
-        return "rdisq_uids:" + cls.get_service_name()
+        """A sorted set of the service's instance uids, scored by when they last reported they're live"""
+        return "rdisq_presence:" + cls.get_service_name()
 
     @classmethod
-    def list_uids(cls):
-        uids = []
-        rdb = get_rdisq_config().request_dispatcher.get_redis()
+    def get_slow_call_log_key(cls, uid) -> str:
+        return "rdisq_slow_calls:" + cls.get_service_name() + ":" + uid
+
+    @classmethod
+    def __get_presence_redis(cls) -> "Redis":
+        dispatcher = cls.redis_dispatcher or get_rdisq_config().request_dispatcher
+        return dispatcher.get_redis()
+
+    @classmethod
+    def list_uids(cls, window_seconds: float = None) -> List[str]:
+        """
+        :param window_seconds: Overrides presence_window_seconds.
+        :return: uids of the instances that reported they're live within the window.
+        """
+        if window_seconds is None:
+            window_seconds = cls.presence_window_seconds
+        now = time.time()
         key = cls.get_service_uid_list_key()
-        for k, v in rdb.hgetall(key).items():
-            if float(v) > time.time() - 10:
-                uids.append(k.decode())
-            else:
-                rdb.hdel(key, k)
-        return uids
+        pipe = cls.__get_presence_redis().pipeline()
+        pipe.zremrangebyscore(key, "-inf", f"({now - max(window_seconds, cls.presence_window_seconds)}")
+        pipe.zrangebyscore(key, now - window_seconds, "+inf")
+        _, uids = pipe.execute()
+        return [uid.decode() for uid in uids]
+
+    @classmethod
+    def count_uids(cls, window_seconds: float = None) -> int:
+        """:return: The number of instances that reported they're live within the window."""
+        if window_seconds is None:
+            window_seconds = cls.presence_window_seconds
+        return cls.__get_presence_redis().zcount(cls.get_service_uid_list_key(), time.time() - window_seconds, "+inf")
 
     @classmethod
     def __set_service_name(cls, service_name):
@@ -175,38 +290,88 @@ class RdisqService(object):
 
     @property
     def listening_queues(self) -> FrozenSet[QueueName]:
-        queues = self._direct_queues.copy()
-        if not self.__is_suspended:
-            queues |= self._broadcast_queues
-        return frozenset(queues)
+        with self._registration_lock:
+            queues = self._direct_queues.copy()
+            if not self.__is_suspended:
+                queues |= self._broadcast_queues
+            return frozenset(queues)
+
+    @property
+    def control_queues(self) -> FrozenSet[QueueName]:
+        """Queues served on the control lane. These are not part of listening_queues."""
+        with self._registration_lock:
+            return frozenset(self._control_queues)
 
     @property
     def callables(self) -> FrozenSet[Callable]:
         """
         :return: A set of all the callables that might be triggered by messages to this Service's queues.
         """
-        return frozenset(self._queue_to_callable.values())
+        with self._registration_lock:
+            return frozenset(self._queue_to_callable.values())
 
     def rdisq_process_one(self, timeout=0):
         return self.__process_one(timeout=timeout)
 
+    def register_method_to_control_queue(self, method: Callable, queue_base_name: str):
+        """
+        Register a method to a direct queue that's served on the control lane.
+
+        While process() runs, control queues are polled by a thread of their own,
+        so control operations aren't stuck behind slow handlers of the other queues.
+        """
+        control_name = self.get_queue_name_for_method(queue_base_name, self.__uid)
+        self.logger.info(f"Registering method to control queue {control_name}")
+        with self._registration_lock:
+            self._queue_to_callable[control_name] = method
+            self._control_queues.add(control_name)
+
     def suspend(self):
         self.__is_suspended = True
 
     def resume(self):
         self.__is_suspended = False
 
-    def register_method_to_queue(self, method: Callable, queue_base_name: str = None):
+    def register_method_to_queue(self, method: Callable, queue_base_name: str = None,
+                                 priority: int = None, weight: int = None, direct: bool = True, broadcast: bool = True):
+        """
+        :param priority: Overrides the method's declared priority for these queues.
+        :param weight: Overrides the method's declared weight for these queues.
+        :param direct: Listen on the queue's direct name, which is unique to this service instance.
+        :param broadcast: Listen on the queue's broadcast name, which is shared with other instances.
+        """
         if not queue_base_name:
             queue_base_name = self.chop_prefix_from_exported_method_name(method.__name__)
-        direct_name = self.get_queue_name_for_method(queue_base_name, self.__uid)
-        self.logger.info(f"Registering method to queue {direct_name}")
-        self._queue_to_callable[direct_name] = method
-        self._direct_queues.add(direct_name)
-
-        broadcast_name = self.get_queue_name_for_method(queue_base_name)
-        self._queue_to_callable[broadcast_name] = method
-        self._broadcast_queues.add(broadcast_name)
+        if priority is None:
+            priority = getattr(method, "priority", None)
+        if weight is None:
+            weight = getattr(method, "weight", None)
+        with self._registration_lock:
+            if direct:
+                direct_name = self.get_queue_name_for_method(queue_base_name, self.__uid)
+                self.logger.info(f"Registering method to queue {direct_name}")
+                self._queue_to_callable[direct_name] = method
+                self._direct_queues.add(direct_name)
+
+            if broadcast:
+                broadcast_name = self.get_queue_name_for_method(queue_base_name)
+                if not direct:
+                    self.logger.info(f"Registering method to queue {broadcast_name}")
+                self._queue_to_callable[broadcast_name] = method
+                self._broadcast_queues.add(broadcast_name)
+
+            if priority is not None or weight is not None:
+                self.set_queue_priority(queue_base_name, priority or 0, weight or 1)
+
+    def set_queue_priority(self, queue_base_name: str, priority: int = 0, weight: int = 1):
+        """Set the scheduling priority and weight of a registered queue (both its direct and broadcast names)."""
+        with self._registration_lock:
+            for queue_name in (self.get_queue_name_for_method(queue_base_name, self.__uid),
+                               self.get_queue_name_for_method(queue_base_name)):
+                self.queue_scheduler.set_queue_priority(queue_name, priority, weight)
+
+    def get_queue_priority(self, queue_base_name: str) -> QueuePriority:
+        return self.queue_scheduler.get_queue_priority(self.get_queue_name_for_method(queue_base_name))
 
     def unregister_all(self):
         # If we want to unregister messages while trying to stop - we must wait until full stop
@@ -216,22 +381,31 @@ class RdisqService(object):
             while self.is_active:
                 pass
         self.logger.info(f"unregistering all handlers")
-        while self._direct_queues:
-            self._direct_queues.pop()
-        while self._broadcast_queues:
-            self._broadcast_queues.pop()
-
-        for k in list(self._queue_to_callable.keys()):
-            self._queue_to_callable.pop(k)
+        with self._registration_lock:
+            while self._direct_queues:
+                self._direct_queues.pop()
+            while self._broadcast_queues:
+                self._broadcast_queues.pop()
+            while self._control_queues:
+                self._control_queues.pop()
+
+            for k in list(self._queue_to_callable.keys()):
+                self._queue_to_callable.pop(k)
+            self.queue_scheduler.clear()
 
     def unregister_from_queue(self, queue_base_name):
         direct_name = self.get_queue_name_for_method(queue_base_name, self.__uid)
-        self._direct_queues.remove(direct_name)
-        self._queue_to_callable.pop(direct_name)
-
         broadcast_name = self.get_queue_name_for_method(queue_base_name)
-        self._broadcast_queues.remove(broadcast_name)
-        self._queue_to_callable.pop(broadcast_name)
+        with self._registration_lock:
+            if direct_name not in self._direct_queues and broadcast_name not in self._broadcast_queues:
+                raise KeyError(f"Not registered to queue {queue_base_name}")
+            self._direct_queues.discard(direct_name)
+            self._queue_to_callable.pop(direct_name, None)
+            self.queue_scheduler.remove_queue(direct_name)
+
+            self._broadcast_queues.discard(broadcast_name)
+            self._queue_to_callable.pop(broadcast_name, None)
+            self.queue_scheduler.remove_queue(broadcast_name)
 
     def wait_for_process_to_start(self, timeout=math.inf):
         start_time = time.time()
@@ -250,17 +424,51 @@ class RdisqService(object):
     def process(self):
         self._on_start()
         redis_con = self.redis_dispatcher.get_redis()
+        control_lane: Optional[threading.Thread] = None
+        heartbeat: Optional[threading.Thread] = None
         try:
             self._on_process_loop()
             self.__running_process_loops += 1
+            self._on_heartbeat()
+            heartbeat = threading.Thread(
+                group=None, target=self.__beat, name=f"{self.__uid}-heartbeat", daemon=True)
+            heartbeat.start()
+            if self.use_control_lane and self._control_queues:
+                control_lane = threading.Thread(
+                    group=None, target=self.__process_control_lane, name=f"{self.__uid}-control", daemon=True)
+                control_lane.start()
             while self.__keep_working:
-                self.__process_one(self.polling_timeout)
-                redis_con.hset(self.get_service_uid_list_key(), self.__uid, time.time())
+                self.__process_one(self.polling_timeout, control=control_lane is None)
                 self._on_process_loop()
         finally:
+            # The other threads loop until told to stop, also when the main loop raised
+            self.__keep_working = False
+            if control_lane is not None:
+                control_lane.join()
+            if heartbeat is not None:
+                heartbeat.join()
             self.__running_process_loops -= 1
+            redis_con.zrem(self.get_service_uid_list_key(), self.__uid)
         self.logger.info("Stopped!")
 
+    def __beat(self):
+        """Report liveness from a thread of its own, so a long handler doesn't make this instance look dead."""
+        while True:
+            time.sleep(self.heartbeat_tick_seconds)
+            if not self.__keep_working:
+                return
+            try:
+                self._on_heartbeat()
+            except Exception as ex:
+                self.logger.exception(ex)
+
+    def __process_control_lane(self):
+        while self.__keep_working:
+            try:
+                self.__process_one(self.polling_timeout, data=False)
+            except Exception as ex:
+                self.logger.exception(ex)
+
     def stop(self):
         self.__keep_working = False
 
@@ -275,6 +483,46 @@ class RdisqService(object):
     def _on_exception(self, exc):
         pass
 
+    def _on_slow_call(self, slow_call: SlowCall):
+        """Hook for reacting to a call that took longer than its threshold"""
+        self.logger.warning(
+            f"Slow call {slow_call.call_name}({slow_call.args_summary}) took {slow_call.handler_seconds:.3f}s"
+            f" (threshold {slow_call.threshold_seconds}s)")
+
+    def _get_call_name(self, call: Callable, request_payload: RequestPayload) -> str:
+        return call.__name__
+
+    def _get_slow_call_threshold(self, call: Callable, request_payload: RequestPayload) -> Optional[float]:
+        threshold = getattr(call, "slow_call_threshold", None)
+        if threshold is None:
+            threshold = self.slow_call_threshold
+        return threshold
+
+    def _get_batch_options(self, call: Callable, request_payload: RequestPayload) -> Optional[BatchOptions]:
+        """:return: How tasks of the call are batched, or None if they're handled one at a time."""
+        return getattr(call, "batch_options", None)
+
+    def _call_batch(self, call: Callable,
+                    request_payloads: List[RequestPayload]) -> List[Tuple[Any, Optional[Exception]]]:
+        """:return: The returned value and the raised exception for each of the tasks, see rdisq.batch.call_batch"""
+        return call_batch(call, [request_payload.args[0] for request_payload in request_payloads])
+
+    def _get_rate_limit(self, call: Callable, request_payload: RequestPayload) -> Optional[Tuple[str, RateLimit]]:
+        """:return: The name the call's rate limit is shared by, and the limit. None if it isn't limited."""
+        rate_limit = getattr(call, "rate_limit", None)
+        if rate_limit is None:
+            return None
+        return self.get_queue_name_for_method(self.chop_prefix_from_exported_method_name(call.__name__)), rate_limit
+
+    def _is_dedicated_queue(self, queue_name: QueueName, call: Callable, request_payload: RequestPayload) -> bool:
+        """:return: Whether the queue carries only tasks that share the task's rate limit."""
+        # Each queue of a service is for a single call
+        return True
+
+    def get_slow_calls(self, from_redis=False) -> List[SlowCall]:
+        """:return: Recent calls that went over their latency threshold, newest first."""
+        return self.slow_call_log.get_calls(self.get_redis() if from_redis else None)
+
     def _on_start(self):
         pass
 
@@ -282,10 +530,18 @@ class RdisqService(object):
         """Hook for doing stuff each cycle of the loop that waits for new messages in the queue"""
         pass
 
+    def _on_heartbeat(self):
+        """Hook for reporting liveness. While process() runs, it's called often from a thread of its own."""
+        now = time.time()
+        if now - self._last_reported_presence >= self.presence_interval_seconds:
+            self.get_redis().zadd(self.get_service_uid_list_key(), {self.__uid: now})
+            self._last_reported_presence = now
+
     def __map_exposed_methods_to_queues(self):
         self._queue_to_callable = {}
         self._broadcast_queues = set()
         self._direct_queues = set()
+        self._control_queues = set()
 
         for attr in dir(self):
             call = getattr(self, attr)
@@ -295,56 +551,418 @@ class RdisqService(object):
         # if not self.__queue_to_callable:
         #     raise AttributeError("Cannot instantiate a service with no exposed methods")
 
-    def __process_one(self, timeout=0):
+    def get_load(self) -> ServiceLoad:
+        """:return: How busy this instance is. Counts the tasks waiting in its direct and control queues."""
+        with self._registration_lock:
+            own_queues = sorted(self._direct_queues | self._control_queues)
+        queue_depth = 0
+        if own_queues:
+            pipe = self.get_redis().pipeline(transaction=False)
+            for q in own_queues:
+                pipe.llen(q)
+            queue_depth = sum(pipe.execute())
+        return ServiceLoad(in_flight=self._in_flight, latency_ewma=self._latency_ewma, queue_depth=queue_depth)
+
+    def __process_one(self, timeout=0, data=True, control=True):
         """Process a single queue_base_name event
         Will pend for an event (unless timeout is specified) then it will process it
+
+        :param data: Poll the listening queues.
+        :param control: Poll the control queues, ahead of the listening queues.
         """
         redis_con = self.redis_dispatcher.get_redis()
-        queues = list(self.listening_queues)
+        with self._registration_lock:
+            listening_queues = self.__get_unpaused_queues() if data else frozenset()
+            queues = list(self._control_queues) if control else []
+            queues += self.queue_scheduler.order(listening_queues)
+        if data:
+            # Don't wait past the time delayed tasks may be due, or a rate limited queue may be polled again
+            wake_in = min([self.__move_due_tasks(redis_con)] +
+                          [until - time.time() for until in self._paused_queues.values()])
+            if wake_in < math.inf and (not timeout or timeout > wake_in):
+                timeout = wake_in
+        if timeout:
+            timeout = max(timeout, MIN_BLOCKING_TIMEOUT)
+        if not queues:
+            time.sleep(timeout)
+            return False
         redis_result = redis_con.brpop(queues, timeout=timeout)
 
         if redis_result is None:  # Timeout
             return False
         method_queue_name, task_id = redis_result
-        request_key = get_request_key(task_id.decode())
         decoded_queue_name = method_queue_name.decode()
-        if decoded_queue_name not in self._queue_to_callable:
-            raise RuntimeError(f"{self.__uid}: Queue not found: {decoded_queue_name}")
-        call = self._queue_to_callable[decoded_queue_name]
-        data_string = redis_con.get(request_key)
+        with self._registration_lock:
+            if decoded_queue_name in listening_queues:
+                self.queue_scheduler.on_served(decoded_queue_name, listening_queues)
+            call = self._queue_to_callable.get(decoded_queue_name)
+        if call is None:
+            # The queue was unregistered after it was polled, leave the task to whoever still listens on it
+            self.logger.warning(f"{self.__uid}: Queue not found: {decoded_queue_name}, returning task to queue")
+            redis_con.rpush(decoded_queue_name, task_id)
+            return False
+        task = self.__fetch_task(redis_con, call, decoded_queue_name, task_id.decode())
+        if task is None:
+            return False
+        batch_options = self._get_batch_options(call, task[0])
+        if batch_options is not None:
+            self.__process_batch(redis_con, call, method_queue_name, task, batch_options)
+        else:
+            self.__process_task(redis_con, call, method_queue_name, task)
+
+    def __fetch_task(self, redis_con: "Redis", call: Callable, queue_name: QueueName,
+                     task_id: str) -> Optional[Tuple[RequestPayload, int]]:
+        """:return: The request of a popped task and its size, or None if it shouldn't be handled (now)."""
+        if self.__shed_if_late(redis_con, queue_name, task_id):
+            return None
+        # Claimed along with the fetch, so a task can't be cancelled once a worker took it on, see RdisqResponse.cancel
+        pipe = redis_con.pipeline(transaction=True)
+        pipe.get(get_request_key(task_id))
+        pipe.pttl(get_request_key(task_id))
+        pipe.delete(get_request_key(task_id))
+        data_string, ttl_ms, _ = pipe.execute()
         if data_string is None:
-            return
-        self._pre(method_queue_name)
+            # Cancelled, or expired while waiting in the queue
+            with self._load_lock:
+                self.abandoned_task_count += 1
+            return None
         request_payload: RequestPayload = self.serializer.loads(data_string)
-        timeout = request_payload.timeout
-        if request_payload.task_id != task_id.decode():
+        if request_payload.task_id != task_id:
             raise ValueError("Memorized task id is mismatching to received-payload task_id")
-        args = request_payload.args
-        kwargs = request_payload.kwargs
+        if not self.__wait_for_rate_limit(redis_con, call, request_payload, queue_name, data_string, ttl_ms):
+            return None
+        return request_payload, len(data_string)
+
+    def __process_task(self, redis_con: "Redis", call: Callable, method_queue_name: bytes,
+                       task: Tuple[RequestPayload, int]):
+        request_payload, request_size = task
+        queue_name = method_queue_name.decode()
+        self._pre(method_queue_name)
+        if request_payload.chunk:
+            def invoke():
+                return [_collect(call(item)) for item in request_payload.args[0]]
+        else:
+            def invoke():
+                return self.__stream_generator(redis_con, request_payload,
+                                               call(*request_payload.args, **request_payload.kwargs))
+        result, raised_exception, time_start, duration_seconds = self.__invoke(
+            queue_name, request_payload.deadline, invoke)
+        if raised_exception is not None:
+            self.__on_call_exception(raised_exception)
+        pipe = redis_con.pipeline(transaction=False)
+        response_size = self.__reply(pipe, request_payload, result, raised_exception, duration_seconds)
+        pipe.execute()
+        self.__track_latency(call, request_payload, queue_name, request_size, response_size, time_start,
+                             duration_seconds)
+        self._post(method_queue_name)
+
+    def __process_batch(self, redis_con: "Redis", call: Callable, method_queue_name: bytes,
+                        first_task: Tuple[RequestPayload, int], batch_options: BatchOptions):
+        """
+        Gather up to batch_size tasks from the queue, waiting up to max_wait for them, and handle them in one call.
+        Gathered tasks that aren't batched are handled one by one afterwards.
+        """
+        queue_name = method_queue_name.decode()
+        batch = [first_task]
+        unbatched = []
+        gather_until = time.time() + batch_options.max_wait
+        while len(batch) < batch_options.batch_size and queue_name not in self._paused_queues:
+            task_ids = self.__pop_tasks(redis_con, queue_name, batch_options.batch_size - len(batch),
+                                        gather_until - time.time())
+            if not task_ids:
+                break
+            for task_id in task_ids:
+                task = self.__fetch_task(redis_con, call, queue_name, task_id)
+                if task is None:
+                    continue
+                if self._get_batch_options(call, task[0]) is None:
+                    unbatched.append(task)
+                else:
+                    batch.append(task)
+
+        request_payloads = [request_payload for request_payload, _ in batch]
+        deadline = min((p.deadline for p in request_payloads if p.deadline is not None), default=None)
+        self._pre(method_queue_name)
+        outcomes, raised_exception, time_start, duration_seconds = self.__invoke(
+            queue_name, deadline, lambda: self._call_batch(call, request_payloads))
+        if raised_exception is not None:
+            outcomes = [(None, raised_exception)] * len(batch)
+        # A failure of the whole batch is reported once, not for each of its tasks
+        for ex in {id(ex): ex for _, ex in outcomes if ex is not None}.values():
+            self.__on_call_exception(ex)
+        pipe = redis_con.pipeline(transaction=False)
+        response_sizes = [self.__reply(pipe, request_payload, result, ex, duration_seconds)
+                          for request_payload, (result, ex) in zip(request_payloads, outcomes)]
+        pipe.execute()
+        for (request_payload, request_size), response_size in zip(batch, response_sizes):
+            self.__track_latency(call, request_payload, queue_name, request_size, response_size, time_start,
+                                 duration_seconds)
+        self._post(method_queue_name)
+        for task in unbatched:
+            self.__process_task(redis_con, call, method_queue_name, task)
+
+    @staticmethod
+    def __pop_tasks(redis_con: "Redis", queue_name: QueueName, count: int, timeout: float) -> List[str]:
+        """
+        Pop up to count tasks in a single round trip. If there are none, wait up to timeout for one,
+        unless it's too short for the server to block on.
+        """
+        pipe = redis_con.pipeline(transaction=False)
+        for _ in range(count):
+            pipe.rpop(queue_name)
+        task_ids = [task_id.decode() for task_id in pipe.execute() if task_id is not None]
+        if not task_ids and timeout >= MIN_BLOCKING_TIMEOUT:
+            redis_result = redis_con.brpop([queue_name], timeout=timeout)
+            if redis_result is not None:
+                task_ids.append(redis_result[1].decode())
+        return task_ids
+
+    def __invoke(self, queue_name: QueueName, deadline: Optional[float],
+                 invoke: Callable[[], Any]) -> Tuple[Any, Optional[Exception], float, float]:
+        """
+        Run a handler call, keeping track of the load.
+
+        :return: The returned value, the raised exception, when the call started and how long it took.
+        """
         time_start = time.time()
+        self._stream_waits.seconds = 0
+        with self._load_lock:
+            self._in_flight += 1
         try:
-            result = call(*args, **kwargs)
+            with deadline_scope(deadline):
+                result = invoke()
             raised_exception = None
         except Exception as ex:
             result = None
             raised_exception = ex
-            if self.log_returned_exceptions and self.logger:
-                self.logger.exception(ex)
-            self._on_exception(ex)
-        duration_seconds = time.time() - time_start
+        # Waiting for the caller to read a stream isn't handler latency
+        duration_seconds = time.time() - time_start - self._stream_waits.seconds
+        with self._load_lock:
+            self._in_flight -= 1
+            self._latency_ewma = self.__update_ewma(self._latency_ewma, duration_seconds)
+            self._queue_latency_ewma[queue_name] = self.__update_ewma(
+                self._queue_latency_ewma.get(queue_name), duration_seconds)
+        return result, raised_exception, time_start, duration_seconds
+
+    def __stream_generator(self, redis_con: "Redis", request_payload: RequestPayload, result: Any) -> Any:
+        """
+        If a generator handler was called, send its values to the caller as they're produced, see rdisq.stream.
+
+        :return: The result to reply with, which ends the stream.
+        """
+        session_data = None
+        if isinstance(result, SessionResult):
+            session_data = result.session_data
+            result = result.result
+        if not inspect.isgenerator(result):
+            pass
+        elif request_payload.no_reply:
+            result = _StreamedResult(sum(1 for _ in result))
+        elif request_payload.coalesce_key:
+            # Callers attached to the call only get its final reply
+            result = list(result)
+        else:
+            result = _StreamedResult(send_stream(redis_con, self.serializer, request_payload.task_id,
+                                                 request_payload.timeout, result, self.stream_window,
+                                                 self.stream_ack_timeout, self.__on_stream_wait))
+        if session_data is not None:
+            result = SessionResult(result=result, session_data=session_data)
+        return result
+
+    def __on_stream_wait(self, seconds: float):
+        self._stream_waits.seconds += seconds
+
+    def __on_call_exception(self, ex: Exception):
+        if self.log_returned_exceptions and self.logger:
+            self.logger.exception(ex)
+        self._on_exception(ex)
+
+    def __reply(self, pipe, request_payload: RequestPayload, result: Any, raised_exception: Optional[Exception],
+                duration_seconds: float) -> int:
+        """Add sending the response of a task to the pipeline. :return: The size of the response"""
+        if request_payload.no_reply:
+            if raised_exception is not None:
+                with self._load_lock:
+                    self.unreplied_error_count += 1
+                if not self.log_returned_exceptions:
+                    self.logger.warning(f"{self.__uid}: No reply task {request_payload.task_id} raised "
+                                        f"{raised_exception!r}")
+            return 0
         if isinstance(result, SessionResult):
             session_data = result.session_data
             result = result.result
         else:
             session_data = None
+        chunk_count = None
+        if isinstance(result, _StreamedResult):
+            chunk_count = result.chunk_count
+            result = None
         response_payload = ResponsePayload(
             returned_value=result,
             processing_time_seconds=duration_seconds,
             raised_exception=raised_exception,
             service_uid=self.uid,
-            session_data=session_data
+            session_data=session_data,
+            chunk_count=chunk_count
         )
         serialized_response = self.serializer.dumps(response_payload)
-        redis_con.lpush(task_id, serialized_response)
-        redis_con.expire(task_id, timeout)
-        self._post(method_queue_name)
+        task_id, timeout = request_payload.task_id, request_payload.timeout
+        pipe.lpush(task_id, serialized_response)
+        pipe.expire(task_id, timeout)
+        if request_payload.cache_key and raised_exception is None and chunk_count is None:
+            pipe.setex(request_payload.cache_key, request_payload.cache_ttl, serialized_response)
+        if request_payload.coalesce_key:
+            run_script(pipe, RELEASE_IN_FLIGHT,
+                       [request_payload.coalesce_key, get_waiters_key(task_id), get_coalesced_call_key(task_id)],
+                       [task_id, serialized_response, timeout])
+        return len(serialized_response)
+
+    def __move_due_tasks(self, redis_con: "Redis") -> float:
+        """
+        Move the delayed tasks that are due to the listening queues and the control queues, in batches.
+        Workers listening on the same queue share the work, each task is moved once.
+
+        :return: Seconds until the next delayed task is due, as of the last check.
+        """
+        now = time.time()
+        queues = self.listening_queues | self.control_queues
+        if now >= self._next_delayed_check and queues:
+            pipe = redis_con.pipeline(transaction=False)
+            for q in queues:
+                run_script(pipe, MOVE_DUE_TASKS, [get_delayed_queue_key(q), q], [self.delayed_task_batch_size])
+            self._next_delayed_due = now + min((float(due_in) for due_in in pipe.execute() if due_in is not None),
+                                               default=math.inf)
+            self._next_delayed_check = min(self._next_delayed_due, now + self.delayed_task_check_interval)
+        return self._next_delayed_due - now
+
+    def __get_unpaused_queues(self) -> FrozenSet[QueueName]:
+        if not self._paused_queues:
+            return self.listening_queues
+        now = time.time()
+        for q, until in list(self._paused_queues.items()):
+            if until <= now:
+                del self._paused_queues[q]
+        return self.listening_queues.difference(self._paused_queues)
+
+    def __wait_for_rate_limit(self, redis_con: "Redis", call: Callable, request_payload: RequestPayload,
+                              queue_name: QueueName, data_string: bytes, ttl_ms: int) -> bool:
+        """
+        Take the task's turn from its rate limit, waiting up to rate_limit_max_defer for it.
+        If it's further away, the task goes back to its queue, and the queue isn't polled until then.
+        A queue that carries other calls too keeps being polled, and just the task is delayed until then.
+
+        :param data_string: The claimed request, restored along with the task if it goes back.
+        :param ttl_ms: What was left of the request's expiry when it was claimed.
+        :return: Whether the task may be handled now.
+        """
+        rate_limit = self._get_rate_limit(call, request_payload)
+        if rate_limit is None:
+            return True
+        name, limit = rate_limit
+        defer_until = time.time() + self.rate_limit_max_defer
+        wait = take_token(redis_con, name, limit)
+        while 0 < wait <= defer_until - time.time():
+            time.sleep(wait)
+            wait = take_token(redis_con, name, limit)
+        if not wait:
+            return True
+        task_id = request_payload.task_id
+        if self._is_dedicated_queue(queue_name, call, request_payload):
+            # To the end of the line, the queue's other tasks are just as limited
+            pipe = redis_con.pipeline(transaction=True)
+            pipe.set(get_request_key(task_id), data_string, px=ttl_ms if ttl_ms > 0 else None)
+            pipe.lpush(queue_name, task_id)
+            pipe.execute()
+            self._paused_queues[queue_name] = time.time() + wait
+        else:
+            run_script(redis_con, SCHEDULE_TASK, [get_request_key(task_id), get_delayed_queue_key(queue_name)],
+                       [task_id, data_string, max(ttl_ms, 0), wait])
+            due = time.time() + wait
+            self._next_delayed_due = min(self._next_delayed_due, due)
+            self._next_delayed_check = min(self._next_delayed_check, due)
+        with self._load_lock:
+            self.rate_limited_task_count += 1
+        self.logger.debug(f"{self.__uid}: Rate limit of {name} is used up, returned task {request_payload.task_id}")
+        return False
+
+    def __update_ewma(self, ewma: Optional[float], sample: float) -> float:
+        if ewma is None:
+            return sample
+        return ewma + self.latency_ewma_alpha * (sample - ewma)
+
+    def __shed_if_late(self, redis_con: "Redis", queue_name: QueueName, task_id: str) -> bool:
+        """
+        Drop a task whose deadline passed, or would pass before its handler finishes, without running it.
+        A caller that's still waiting is told right away, with RdisqDeadlineExceeded, and so are the callers
+        attached to the task, if it's the leader of a coalesced call.
+
+        :return: Whether the task was dropped.
+        """
+        deadline = get_task_deadline(task_id)
+        if deadline is None:
+            return False
+        now = time.time()
+        if deadline <= now:
+            reason = EXPIRED
+        elif self.shed_unmeetable_deadlines and now + self._queue_latency_ewma.get(queue_name, 0) > deadline:
+            reason = UNMEETABLE
+        else:
+            return False
+        # The request is fetched along with its removal, in case it holds a coalesced call that must be released
+        pipe = redis_con.pipeline(transaction=True)
+        pipe.get(get_request_key(task_id))
+        pipe.delete(get_request_key(task_id))
+        data_string, _ = pipe.execute()
+        request_payload: Optional[RequestPayload] = self.serializer.loads(data_string) if data_string else None
+        response_payload = ResponsePayload(
+            returned_value=None,
+            raised_exception=RdisqDeadlineExceeded(task_id, deadline),
+            processing_time_seconds=0,
+            service_uid=self.uid
+        )
+        serialized_response = self.serializer.dumps(response_payload)
+        pipe = redis_con.pipeline(transaction=False)
+        if reason == UNMEETABLE:
+            pipe.lpush(task_id, serialized_response)
+            pipe.expire(task_id, math.ceil(deadline - now))
+        if request_payload is not None and request_payload.coalesce_key:
+            run_script(pipe, RELEASE_IN_FLIGHT,
+                       [request_payload.coalesce_key, get_waiters_key(task_id), get_coalesced_call_key(task_id)],
+                       [task_id, serialized_response, request_payload.timeout])
+        pipe.execute()
+        with self._load_lock:
+            self._shed_counts[reason] += 1
+        self.logger.debug(f"{self.__uid}: Dropped task {task_id}, its deadline is {reason}")
+        return True
+
+    def get_shed_counts(self) -> Dict[str, int]:
+        """:return: How many tasks were dropped for their deadline, by reason (see rdisq.deadline)"""
+        with self._load_lock:
+            return dict(self._shed_counts)
+
+    def __track_latency(self, call: Callable, request_payload: RequestPayload, queue_name: QueueName,
+                        request_size: int, response_size: int, time_start: float, duration_seconds: float):
+        threshold = self._get_slow_call_threshold(call, request_payload)
+        if threshold is None:
+            return
+        call_name = self._get_call_name(call, request_payload)
+        is_slow = duration_seconds > threshold
+        self.slow_call_log.observe(call_name, is_slow)
+        if not is_slow:
+            return
+        enqueued_at = request_payload.enqueued_at
+        slow_call = SlowCall(
+            service_uid=self.uid,
+            queue_name=queue_name,
+            task_id=request_payload.task_id,
+            call_name=call_name,
+            args_summary=summarize_args(request_payload.args, request_payload.kwargs),
+            request_size=request_size,
+            response_size=response_size,
+            queue_wait_seconds=time_start - enqueued_at if enqueued_at is not None else None,
+            handler_seconds=duration_seconds,
+            threshold_seconds=threshold,
+            recorded_at=time.time()
+        )
+        self.slow_call_log.record(slow_call, self.get_redis())
+        self._on_slow_call(slow_call)
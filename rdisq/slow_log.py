@@ -0,0 +1,80 @@
+from typing import *
+from collections import deque, defaultdict
+import reprlib
+
+from redis import Redis
+
+from rdisq.consts import QueueName, ServiceUid
+from rdisq.serialization import PickleSerializer
+
+_args_repr = reprlib.Repr()
+_args_repr.maxstring = 80
+_args_repr.maxother = 80
+
+
+def summarize_args(args: Tuple, kwargs: Dict) -> str:
+    """A short, bounded description of a call's arguments, safe to keep around in a log."""
+    parts = [_args_repr.repr(a) for a in args]
+    parts += [f"{k}={_args_repr.repr(v)}" for k, v in kwargs.items()]
+    return ", ".join(parts)
+
+
+class SlowCall(NamedTuple):
+    service_uid: ServiceUid
+    queue_name: QueueName
+    task_id: str
+    call_name: str
+    args_summary: str
+    request_size: int
+    response_size: int
+    queue_wait_seconds: Optional[float]
+    handler_seconds: float
+    threshold_seconds: float
+    recorded_at: float
+
+
+class SlowCallLog:
+    """
+    A bounded ring buffer of calls that went over their latency threshold.
+
+    Also counts, per call name, how many calls were observed and how many of them were slow,
+    so the fraction of calls meeting the threshold can be tracked.
+    If redis_key is given, slow calls are also kept in a capped redis list, so they can be read from other processes.
+    """
+    serializer: ClassVar[PickleSerializer] = PickleSerializer()
+
+    def __init__(self, max_size: int = 100, redis_key: str = None):
+        self.max_size = max_size
+        self.redis_key = redis_key
+        self._calls: Deque[SlowCall] = deque(maxlen=max_size)
+        self._call_counts: Dict[str, int] = defaultdict(int)
+        self._slow_counts: Dict[str, int] = defaultdict(int)
+
+    def observe(self, call_name: str, is_slow: bool):
+        self._call_counts[call_name] += 1
+        if is_slow:
+            self._slow_counts[call_name] += 1
+
+    def record(self, slow_call: SlowCall, redis_con: Redis = None):
+        self._calls.appendleft(slow_call)
+        if self.redis_key and redis_con is not None:
+            pipe = redis_con.pipeline()
+            pipe.lpush(self.redis_key, self.serializer.dumps(slow_call))
+            pipe.ltrim(self.redis_key, 0, self.max_size - 1)
+            pipe.execute()
+
+    def get_calls(self, redis_con: Redis = None) -> List[SlowCall]:
+        """:return: The recorded slow calls, newest first. Read from redis if redis_con is given."""
+        if redis_con is not None and self.redis_key:
+            return [self.serializer.loads(c) for c in redis_con.lrange(self.redis_key, 0, self.max_size - 1)]
+        return list(self._calls)
+
+    def get_stats(self) -> Dict[str, Tuple[int, int]]:
+        """:return: A mapping of call name to (calls observed, slow calls)."""
+        return {name: (count, self._slow_counts[name]) for name, count in self._call_counts.items()}
+
+    def clear(self):
+        self._calls.clear()
+        self._call_counts.clear()
+        self._slow_counts.clear()
+
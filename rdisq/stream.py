@@ -0,0 +1,62 @@
+"""
+Responses of generator handlers, which are sent a value at a time as they're produced, see RdisqResponse.stream
+
+Each yielded value is pushed to the reply key as a StreamChunk, and the ResponsePayload that follows ends the stream.
+The caller acknowledges the values it read on the stream's ack key, and the worker stays at most a window
+of values ahead of it. A caller that doesn't read for the service's stream_ack_timeout, or cancels, abandons the stream.
+"""
+from typing import *
+import time
+
+from rdisq.identification import get_stream_ack_key
+from rdisq.payload import StreamChunk
+
+if TYPE_CHECKING:
+    from redis import Redis
+    from rdisq.serialization import PickleSerializer
+
+STOP = b"stop"  # pushed to the ack key by a caller that stopped reading
+
+
+class StreamAbandoned(Exception):
+    """The caller stopped reading a streamed response, or didn't read it in time"""
+    task_id = None
+
+    def __init__(self, task_id):
+        self.task_id = task_id
+
+
+def send_stream(redis_con: "Redis", serializer: "PickleSerializer", task_id: str, timeout: int,
+                values: Generator, window: int, ack_timeout: int,
+                on_wait: Callable[[float], None] = None) -> int:
+    """
+    Push values to the reply key of a task as they're produced.
+
+    :param timeout: The expiry of the reply key.
+    :param ack_timeout: Seconds to wait for the caller to read, when window values are unread.
+    :param on_wait: Called with the seconds spent waiting for the caller each time, which isn't handler time.
+    :return: How many values were sent.
+    """
+    ack_key = get_stream_ack_key(task_id)
+    sent = acked = 0
+    try:
+        for value in values:
+            while sent - acked >= window:
+                wait_start = time.time()
+                try:
+                    ack = redis_con.brpop([ack_key], timeout=ack_timeout)
+                finally:
+                    if on_wait is not None:
+                        on_wait(time.time() - wait_start)
+                if ack is None or ack[1] == STOP:
+                    raise StreamAbandoned(task_id)
+                acked += int(ack[1])
+            pipe = redis_con.pipeline(transaction=False)
+            pipe.lpush(task_id, serializer.dumps(StreamChunk(value)))
+            pipe.expire(task_id, timeout)
+            pipe.execute()
+            sent += 1
+    finally:
+        values.close()
+        redis_con.delete(ack_key)
+    return sent
@@ -1,4 +1,8 @@
+import time
+from typing import *
+
 from rdisq.request.message import RdisqMessage
+from rdisq.rate_limit import RateLimit
 
 
 class SumMessage(RdisqMessage):
@@ -37,4 +41,138 @@ class Summer:
     @SubtractMessage.set_handler
     def subtract(self, message: SubtractMessage):
         self.sum -= message.subtrahend
-        return self.sum
\ No newline at end of file
+        return self.sum
+
+class SleepMessage(RdisqMessage):
+    rdisq_slow_call_threshold = 0.05
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        super().__init__()
+
+
+@SleepMessage.set_handler
+def sleep_(message: SleepMessage):
+    time.sleep(message.seconds)
+    return message.seconds
+
+
+class SquareMessage(RdisqMessage):
+    rdisq_cache_ttl = 10
+    handled_count = 0
+
+    def __init__(self, number: int):
+        self.number = number
+        super().__init__()
+
+
+@SquareMessage.set_handler
+def square(message: SquareMessage):
+    SquareMessage.handled_count += 1
+    return message.number ** 2
+
+
+class CubeMessage(RdisqMessage):
+    rdisq_coalesce = True
+    handled_count = 0
+
+    def __init__(self, number: int):
+        self.number = number
+        super().__init__()
+
+
+@CubeMessage.set_handler
+def cube(message: CubeMessage):
+    CubeMessage.handled_count += 1
+    return message.number ** 3
+
+
+class UrgentMessage(RdisqMessage):
+    rdisq_priority = 10
+
+
+@UrgentMessage.set_handler
+def urgent(message: UrgentMessage):
+    return "urgent"
+
+
+class LookupMessage(RdisqMessage):
+    def __init__(self, key: str):
+        self.key = key
+        super().__init__()
+
+    def get_routing_key(self):
+        return self.key
+
+
+@LookupMessage.set_handler
+def lookup(message: LookupMessage):
+    return message.key
+
+
+class StallMessage(RdisqMessage):
+    def __init__(self):
+        super().__init__()
+
+
+class Staller:
+    def __init__(self, delay: float = 0):
+        self.delay = delay
+
+    @StallMessage.set_handler
+    def stall(self, message: StallMessage):
+        time.sleep(self.delay)
+        return self.delay
+
+
+class NapMessage(RdisqMessage):
+    rdisq_time_limit = 2
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        super().__init__()
+
+
+@NapMessage.set_handler
+def nap(message: NapMessage):
+    time.sleep(message.seconds)
+    return message.seconds
+
+
+class ThrottledMessage(RdisqMessage):
+    rdisq_rate_limit = RateLimit(rate=5, burst=1)
+
+    def __init__(self, value: int):
+        self.value = value
+        super().__init__()
+
+
+@ThrottledMessage.set_handler
+def throttled(message: ThrottledMessage):
+    return message.value
+
+
+class DoubleMessage(RdisqMessage):
+    batch_sizes = []  # sizes of the batches the handler was called with
+
+    def __init__(self, value: int):
+        self.value = value
+        super().__init__()
+
+
+@DoubleMessage.set_batch_handler(batch_size=4, max_wait=0.2)
+def double(messages: List[DoubleMessage]):
+    DoubleMessage.batch_sizes.append(len(messages))
+    return [ValueError(m.value) if m.value < 0 else m.value * 2 for m in messages]
+
+
+class CountMessage(RdisqMessage):
+    def __init__(self, up_to: int):
+        self.up_to = up_to
+        super().__init__()
+
+
+@CountMessage.set_handler
+def count(message: CountMessage):
+    for i in range(message.up_to):
+        yield i
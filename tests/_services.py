@@ -0,0 +1,94 @@
+"""Services used by the consumer tests"""
+import time
+
+from rdisq.service import RdisqService, remote_method
+from rdisq.redis_dispatcher import PoolRedisDispatcher
+from rdisq.rate_limit import RateLimit
+
+
+class LookupWorker(RdisqService):
+    service_name = "LookupWorker"
+    response_timeout = 5
+    redis_dispatcher = PoolRedisDispatcher(host='127.0.0.1', port=6379, db=0)
+    lookup_count = 0
+
+    @remote_method(cache_ttl=10)
+    def lookup(self, key):
+        LookupWorker.lookup_count += 1
+        return key.upper()
+
+
+class StallingWorker(RdisqService):
+    service_name = "StallingWorker"
+    response_timeout = 5
+    redis_dispatcher = PoolRedisDispatcher(host='127.0.0.1', port=6379, db=0)
+
+    def __init__(self, delay: float = 0):
+        self.delay = delay
+        super().__init__()
+
+    @remote_method
+    def stall(self):
+        time.sleep(self.delay)
+        return self.uid
+
+
+class UnstaffedWorker(RdisqService):
+    """Has a dispatcher of its own, so its circuit breakers don't affect other tests"""
+    service_name = "UnstaffedWorker"
+    response_timeout = 1
+    redis_dispatcher = PoolRedisDispatcher(host='127.0.0.1', port=6379, db=0)
+
+    @remote_method
+    def ping(self):
+        return "pong"
+
+
+class ThrottledWorker(RdisqService):
+    service_name = "ThrottledWorker"
+    response_timeout = 5
+    redis_dispatcher = PoolRedisDispatcher(host='127.0.0.1', port=6379, db=0)
+
+    @remote_method(rate_limit=RateLimit(rate=5, burst=2))
+    def echo(self, value):
+        return value
+
+
+class BatchWorker(RdisqService):
+    service_name = "BatchWorker"
+    response_timeout = 5
+    redis_dispatcher = PoolRedisDispatcher(host='127.0.0.1', port=6379, db=0)
+
+    @remote_method(batch_size=3)
+    def double(self, values):
+        if None in values:
+            raise TypeError("Can't double None")
+        return [v * 2 for v in values]
+
+
+class MathWorker(RdisqService):
+    service_name = "MathWorker"
+    response_timeout = 5
+    redis_dispatcher = PoolRedisDispatcher(host='127.0.0.1', port=6379, db=0)
+
+    @remote_method
+    def square(self, value):
+        if value < 0:
+            raise ValueError(value)
+        return value ** 2
+
+
+class StreamingWorker(RdisqService):
+    service_name = "StreamingWorker"
+    response_timeout = 5
+    stream_window = 2
+    redis_dispatcher = PoolRedisDispatcher(host='127.0.0.1', port=6379, db=0)
+    produced = 0
+
+    @remote_method
+    def count(self, up_to, fail_at=None):
+        for i in range(up_to):
+            if i == fail_at:
+                raise ValueError(i)
+            StreamingWorker.produced = i + 1
+            yield i
@@ -0,0 +1,82 @@
+import time
+from typing import *
+
+import pytest
+
+from rdisq.admission import QueueFullError, BLOCK_POLICY, DROP_OLDEST_POLICY
+from rdisq.configuration import get_rdisq_config
+from rdisq.request.rdisq_request import RdisqRequest
+from tests._messages import SumMessage
+
+if TYPE_CHECKING:
+    from tests.conftest import _RdisqMessageFixture
+
+
+def test_queue_limit(rdisq_message_fixture: "_RdisqMessageFixture"):
+    dispatcher = get_rdisq_config().request_dispatcher
+    redis_con = dispatcher.get_redis()
+    dispatcher.set_queue_limit("limited_queue", 2)
+    assert dispatcher.get_queue_limit("limited_queue") == 2
+
+    oldest = dispatcher.queue_task("limited_queue", 1)
+    dispatcher.queue_task("limited_queue", 2)
+    with pytest.raises(QueueFullError):
+        dispatcher.queue_task("limited_queue", 3)
+    assert redis_con.llen("limited_queue") == 2
+
+    start_time = time.time()
+    dispatcher.admission_timeout = 0.3
+    try:
+        with pytest.raises(QueueFullError):
+            dispatcher.queue_task("limited_queue", 3, admission_policy=BLOCK_POLICY)
+    finally:
+        del dispatcher.admission_timeout
+    assert time.time() - start_time >= 0.3
+
+    dispatcher.queue_task("limited_queue", 3, admission_policy=DROP_OLDEST_POLICY)
+    assert redis_con.llen("limited_queue") == 2
+    assert oldest.task_id.encode() not in redis_con.lrange("limited_queue", 0, -1)
+    with pytest.raises(QueueFullError):
+        oldest.wait(1)
+
+    dispatcher.set_queue_limit("limited_queue", None)
+    dispatcher.queue_task("limited_queue", 4)
+    assert redis_con.llen("limited_queue") == 3
+
+
+def test_request_admission(rdisq_message_fixture: "_RdisqMessageFixture"):
+    receiver = rdisq_message_fixture.spawn_receiver(message_class=SumMessage)
+    dispatcher = get_rdisq_config().request_dispatcher
+    first = RdisqRequest(SumMessage(1, 1)).send_async()
+    dispatcher.set_queue_limit(first.response.queue_name, 1)
+
+    with pytest.raises(QueueFullError):
+        RdisqRequest(SumMessage(2, 2)).send_async()
+    dispatcher.admission_policy = BLOCK_POLICY
+    try:
+        receiver.rdisq_process_one(1)
+        second = RdisqRequest(SumMessage(2, 2)).send_async()
+    finally:
+        del dispatcher.admission_policy
+    receiver.rdisq_process_one(1)
+    assert first.wait(1) == 2
+    assert second.wait(1) == 4
+
+
+def test_drop_coalesced_call(rdisq_message_fixture: "_RdisqMessageFixture"):
+    dispatcher = get_rdisq_config().request_dispatcher
+    redis_con = dispatcher.get_redis()
+    coalesce_key = dispatcher.get_coalesce_key("limited_queue", (1,), {})
+    leader = dispatcher.queue_task("limited_queue", 1, coalesce_key=coalesce_key)
+    attached = dispatcher.queue_task("limited_queue", 1, coalesce_key=coalesce_key)
+    assert redis_con.llen("limited_queue") == 1
+    dispatcher.set_queue_limit("limited_queue", 1)
+    try:
+        dispatcher.queue_task("limited_queue", 2, admission_policy=DROP_OLDEST_POLICY)
+    finally:
+        dispatcher.set_queue_limit("limited_queue", None)
+    with pytest.raises(QueueFullError):
+        leader.wait(1)
+    with pytest.raises(QueueFullError):
+        attached.wait(1)
+    assert not redis_con.exists(coalesce_key)
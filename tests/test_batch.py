@@ -0,0 +1,69 @@
+import time
+from threading import Thread
+from unittest.mock import patch
+from typing import *
+
+import pytest
+
+from rdisq.batch import call_batch, BatchSizeMismatch, BatchOptions
+from tests._messages import DoubleMessage
+from tests._services import BatchWorker
+
+if TYPE_CHECKING:
+    from tests.conftest import _RdisqMessageFixture
+
+
+def test_call_batch():
+    error = ValueError()
+    assert call_batch(lambda items: [1, error], ["a", "b"]) == [(1, None), (None, error)]
+    outcomes = call_batch(lambda items: [1], ["a", "b"])
+    assert all(isinstance(ex, BatchSizeMismatch) for _, ex in outcomes)
+
+
+def test_batch_handler(rdisq_message_fixture: "_RdisqMessageFixture"):
+    receiver = rdisq_message_fixture.spawn_receiver(message_class=DoubleMessage)
+    DoubleMessage.batch_sizes.clear()
+    requests = [DoubleMessage(i).send_async() for i in [1, 2, -3, 4, 5, 6]]
+
+    receiver.rdisq_process_one(1)
+    assert DoubleMessage.batch_sizes == [4]
+    start_time = time.time()
+    receiver.rdisq_process_one(1)
+    # Waited for more messages, up to max_wait
+    assert time.time() - start_time >= 0.2
+    assert DoubleMessage.batch_sizes == [4, 2]
+
+    assert [r.wait(1) for r in requests[:2] + requests[3:]] == [2, 4, 8, 10, 12]
+    with pytest.raises(ValueError):
+        requests[2].wait(1)
+
+
+def test_batch_remote_method(rdisq_message_fixture: "_RdisqMessageFixture"):
+    worker = BatchWorker()
+    consumer = BatchWorker.get_async_consumer()
+    responses = [consumer.double(i) for i in range(4)]
+    worker.rdisq_process_one(1)
+    assert all(r.is_processed() for r in responses[:3])
+    worker.rdisq_process_one(1)
+    assert [r.wait(1) for r in responses] == [0, 2, 4, 6]
+
+    with pytest.raises(TypeError):
+        consumer.double(1, 2)
+    # A handler that raises fails the whole batch
+    responses = [consumer.double(1), consumer.double(None)]
+    worker.rdisq_process_one(1)
+    for r in responses:
+        with pytest.raises(TypeError):
+            r.wait(1)
+
+
+def test_batch_wait_too_short_to_block(rdisq_message_fixture: "_RdisqMessageFixture"):
+    worker = BatchWorker()
+    response = BatchWorker.get_async_consumer().double(2)
+    with patch.object(BatchWorker.double, "batch_options", BatchOptions(batch_size=8, max_wait=0.0008)):
+        processor = Thread(group=None, target=worker.rdisq_process_one, args=(1,), daemon=True)
+        processor.start()
+        processor.join(2)
+    # The partial batch is handled, rather than waiting forever for more
+    assert not processor.is_alive()
+    assert response.wait(1) == 4
@@ -0,0 +1,71 @@
+import time
+from typing import *
+
+import pytest
+
+from rdisq.circuit_breaker import CircuitBreaker, CircuitOpenError, CLOSED, OPEN, HALF_OPEN
+from rdisq.request.dispatcher import RequestDispatcher
+from rdisq.request.rdisq_request import RdisqRequest
+from rdisq.response import RdisqResponseTimeout
+from tests._messages import SumMessage
+from tests._services import UnstaffedWorker
+
+if TYPE_CHECKING:
+    from tests.conftest import _RdisqMessageFixture
+
+
+def test_circuit_breaker_states():
+    breaker = CircuitBreaker("queue", failure_threshold=2, reset_timeout=0.2, probes=2)
+    breaker.on_failure()
+    breaker.before_call()
+    breaker.on_failure()
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    time.sleep(0.2)
+    breaker.before_call()
+    breaker.before_call()
+    assert breaker.state == HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.on_success()
+    breaker.on_failure()
+    assert breaker.state == OPEN
+
+    time.sleep(0.2)
+    breaker.before_call()
+    breaker.before_call()
+    breaker.on_success()
+    breaker.on_success()
+    assert breaker.state == CLOSED
+
+
+def test_no_live_workers():
+    UnstaffedWorker.redis_dispatcher.enable_circuit_breaker(reset_timeout=10)
+    UnstaffedWorker.redis_dispatcher.get_redis().flushdb()
+    start_time = time.time()
+    with pytest.raises(CircuitOpenError):
+        UnstaffedWorker.get_consumer().ping()
+    with pytest.raises(CircuitOpenError):
+        UnstaffedWorker.get_async_consumer().ping()
+    assert time.time() - start_time < 0.5
+
+
+def test_consecutive_timeouts(rdisq_message_fixture: "_RdisqMessageFixture"):
+    receiver = rdisq_message_fixture.spawn_receiver(message_class=SumMessage)
+    dispatcher = RequestDispatcher(host='127.0.0.1', port=6379, db=0)
+    dispatcher.enable_circuit_breaker(failure_threshold=2, reset_timeout=0.5)
+    for _ in range(2):
+        with pytest.raises(RdisqResponseTimeout):
+            RdisqRequest(SumMessage(1, 1), request_dispatcher=dispatcher).send_and_wait_reply(1)
+    with pytest.raises(CircuitOpenError):
+        RdisqRequest(SumMessage(1, 1), request_dispatcher=dispatcher).send_async()
+    assert set(dispatcher.circuit_breakers.get_states().values()) == {OPEN}
+
+    time.sleep(0.5)
+    probe = RdisqRequest(SumMessage(2, 2), request_dispatcher=dispatcher).send_async()
+    for _ in range(3):
+        receiver.rdisq_process_one(1)
+    assert probe.wait(1) == 4
+    assert set(dispatcher.circuit_breakers.get_states().values()) == {CLOSED}
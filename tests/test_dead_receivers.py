@@ -0,0 +1,81 @@
+from typing import *
+from threading import Thread
+import time
+from unittest.mock import patch
+
+from rdisq.configuration import get_rdisq_config
+from rdisq.request.rdisq_request import RdisqRequest, provision_queue
+from rdisq.request.receiver import ShutDownReceiver
+from tests._messages import SumMessage, SleepMessage
+
+if TYPE_CHECKING:
+    from tests.conftest import _RdisqMessageFixture
+
+
+def test_expired_status(rdisq_message_fixture: "_RdisqMessageFixture"):
+    dispatcher = get_rdisq_config().request_dispatcher
+    receiver = rdisq_message_fixture.spawn_receiver(message_class=SumMessage)
+    assert receiver.uid in dispatcher.get_receiver_services()
+
+    receiver.status_ttl_seconds = 0
+    receiver.publish_status()
+    assert receiver.uid not in dispatcher.get_receiver_services()
+    assert receiver.uid in dispatcher.get_all_receiver_statuses()
+
+    assert dispatcher.collect_dead_receivers() == {receiver.uid}
+    assert receiver.uid not in dispatcher.get_all_receiver_statuses()
+
+
+def test_collect_dead_receivers(rdisq_message_fixture: "_RdisqMessageFixture"):
+    dispatcher = get_rdisq_config().request_dispatcher
+    redis_con = dispatcher.get_redis()
+    alive, dead = rdisq_message_fixture.spawn_receiver(message_class=SumMessage), \
+                  rdisq_message_fixture.spawn_receiver(message_class=SumMessage)
+    queue = provision_queue({dead.uid}, wait=False)
+    rdisq_message_fixture.process_all_receivers()
+
+    # Leave some work behind in the queues of the dead receiver
+    RdisqRequest(SumMessage(1, 2), targets={dead.uid}).send_async()
+    RdisqRequest(ShutDownReceiver(), targets={dead.uid}).send_async()
+    dead.rdisq_process_one(1)
+    assert dead.uid not in dispatcher.get_receiver_services()
+    dead_queues = {q for q in dead.listening_queues if q.startswith(dead.uid) or queue in q}
+    assert redis_con.exists(*dead_queues)
+
+    assert dispatcher.try_become_janitor(alive.uid, 5)
+    assert not dispatcher.try_become_janitor(dead.uid, 5)
+    assert dispatcher.collect_dead_receivers() == {dead.uid}
+    assert not redis_con.exists(*dead_queues)
+    assert dispatcher.find_queues_for_services({alive.uid})
+    # Message queues are shared with the live receiver
+    assert SumMessage.get_message_class_id() in " ".join(dispatcher.get_queue_listeners())
+    assert dispatcher.collect_dead_receivers() == set()
+
+
+def test_busy_receiver_is_alive(rdisq_message_fixture: "_RdisqMessageFixture"):
+    dispatcher = get_rdisq_config().request_dispatcher
+    receiver = rdisq_message_fixture.spawn_receiver(message_class=SleepMessage)
+    receiver.status_interval_seconds = 0.1
+    receiver.status_ttl_seconds = 0.5
+    Thread(group=None, target=receiver.process).start()
+
+    request = RdisqRequest(SleepMessage(1.5)).send_async()
+    time.sleep(1)
+    # The handler runs longer than the ttl, but the status is still refreshed
+    assert dispatcher.collect_dead_receivers() == set()
+    assert request.wait(2) == 1.5
+
+
+def test_refreshed_receiver_is_not_collected(rdisq_message_fixture: "_RdisqMessageFixture"):
+    dispatcher = get_rdisq_config().request_dispatcher
+    receiver = rdisq_message_fixture.spawn_receiver(message_class=SumMessage)
+    receiver.status_ttl_seconds = 0
+    receiver.publish_status()
+
+    statuses = dispatcher.get_all_receiver_statuses()
+    receiver.status_ttl_seconds = 60
+    receiver.publish_status()
+    # The expired status was read before the receiver refreshed it
+    with patch.object(dispatcher, "get_all_receiver_statuses", return_value=statuses):
+        assert dispatcher.collect_dead_receivers() == set()
+    assert receiver.uid in dispatcher.get_receiver_services()
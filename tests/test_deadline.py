@@ -0,0 +1,68 @@
+import time
+from typing import *
+
+import pytest
+
+from rdisq.configuration import get_rdisq_config
+from rdisq.deadline import deadline_scope, get_current_deadline, RdisqDeadlineExceeded, EXPIRED, UNMEETABLE
+from rdisq.identification import get_task_deadline, get_request_key
+from tests._messages import NapMessage, CubeMessage
+
+if TYPE_CHECKING:
+    from tests.conftest import _RdisqMessageFixture
+
+
+def test_inherited_deadline():
+    dispatcher = get_rdisq_config().request_dispatcher
+    assert get_current_deadline() is None
+    deadline = time.time() + 2
+    with deadline_scope(deadline):
+        with deadline_scope(deadline + 10):
+            assert get_current_deadline() == deadline
+        response = dispatcher.queue_task("some_queue", timeout=10)
+        assert get_task_deadline(response.task_id) == pytest.approx(deadline, abs=0.001)
+        assert dispatcher.get_redis().ttl(get_request_key(response.task_id)) <= 2
+    assert get_current_deadline() is None
+    with deadline_scope(time.time() - 1):
+        with pytest.raises(RdisqDeadlineExceeded):
+            dispatcher.queue_task("some_queue", timeout=10)
+
+
+def test_shed_expired(rdisq_message_fixture: "_RdisqMessageFixture"):
+    receiver = rdisq_message_fixture.spawn_receiver(message_class=NapMessage)
+    request = NapMessage(0).send_async()
+    time.sleep(2.1)
+    receiver.rdisq_process_one(1)
+    assert receiver.get_shed_counts()[EXPIRED] == 1
+    assert not request.response.is_processed()
+
+
+def test_shed_unmeetable(rdisq_message_fixture: "_RdisqMessageFixture"):
+    receiver = rdisq_message_fixture.spawn_receiver(message_class=NapMessage)
+    request = NapMessage(1.5).send_async()
+    receiver.rdisq_process_one(1)
+    assert request.wait(1) == 1.5
+
+    request = NapMessage(1.5).send_async()
+    time.sleep(0.6)
+    start_time = time.time()
+    receiver.rdisq_process_one(1)
+    with pytest.raises(RdisqDeadlineExceeded):
+        request.wait(2)
+    assert time.time() - start_time < 0.5
+    assert receiver.get_shed_counts() == {EXPIRED: 0, UNMEETABLE: 1}
+
+
+def test_shed_coalesced(rdisq_message_fixture: "_RdisqMessageFixture"):
+    receiver = rdisq_message_fixture.spawn_receiver(message_class=CubeMessage)
+    with deadline_scope(time.time() + 0.3):
+        leader, attached = CubeMessage(5).send_async(), CubeMessage(5).send_async()
+    time.sleep(0.4)
+    receiver.rdisq_process_one(1)
+    assert receiver.get_shed_counts()[EXPIRED] == 1
+    # Callers attached to the dropped call are told, and identical calls are no longer attached to it
+    with pytest.raises(RdisqDeadlineExceeded):
+        attached.wait(1)
+    request = CubeMessage(5).send_async()
+    receiver.rdisq_process_one(1)
+    assert request.wait(1) == 125
@@ -0,0 +1,70 @@
+import time
+from typing import *
+
+from rdisq.identification import get_delayed_queue_key
+from rdisq.request.receiver import SetReceiverTags
+from tests._messages import SumMessage
+from tests._services import LookupWorker
+
+if TYPE_CHECKING:
+    from tests.conftest import _RdisqMessageFixture
+
+
+def test_send_after(rdisq_message_fixture: "_RdisqMessageFixture"):
+    receiver = rdisq_message_fixture.spawn_receiver(message_class=SumMessage)
+    later = SumMessage(2, 2).send_after(0.5)
+    now = SumMessage(1, 1).send_async()
+    receiver.rdisq_process_one(1)
+    assert now.wait(1) == 2
+    queue_name = later.response.queue_name
+    assert rdisq_message_fixture.redis.llen(queue_name) == 0
+    assert rdisq_message_fixture.redis.zcard(get_delayed_queue_key(queue_name)) == 1
+
+    start_time = time.time()
+    while not later.response.is_processed():
+        receiver.rdisq_process_one(1)
+    # The worker woke up for it, rather than after a full polling timeout
+    assert time.time() - start_time < 0.8
+    assert later.wait() == 4
+    assert rdisq_message_fixture.redis.zcard(get_delayed_queue_key(queue_name)) == 0
+
+
+def test_due_tasks_moved_in_order(rdisq_message_fixture: "_RdisqMessageFixture"):
+    worker = LookupWorker()
+    worker.delayed_task_batch_size = 2
+    consumer = LookupWorker.get_async_consumer()
+    send_at = time.time() + 0.2
+    responses = [consumer.send_at(send_at + i * 0.01, "lookup", f"key{i}") for i in range(5)]
+    responses[3].cancel()
+    time.sleep(0.3)
+    remaining = [responses[i] for i in [0, 1, 2, 4]]
+    while remaining:
+        worker.rdisq_process_one(1)
+        # Handled in the order they were due
+        assert not any(r.is_processed() for r in remaining[1:])
+        if remaining[0].is_processed():
+            remaining.pop(0)
+    assert [responses[i].wait() for i in [0, 1, 2, 4]] == ["KEY0", "KEY1", "KEY2", "KEY4"]
+    assert not responses[3].is_processed()
+
+
+def test_many_due_tasks(rdisq_message_fixture: "_RdisqMessageFixture"):
+    worker = LookupWorker()
+    worker.delayed_task_batch_size = 10000
+    queue_name = LookupWorker.get_queue_name_for_method("lookup")
+    rdisq_message_fixture.redis.zadd(get_delayed_queue_key(queue_name), {f"task{i}": 0 for i in range(10000)})
+    # More than a Lua script can unpack at once
+    worker.rdisq_process_one(0.1)
+    assert rdisq_message_fixture.redis.zcard(get_delayed_queue_key(queue_name)) == 0
+    assert rdisq_message_fixture.redis.llen(queue_name) == 9999
+
+
+def test_delayed_core_message(rdisq_message_fixture: "_RdisqMessageFixture"):
+    receiver = rdisq_message_fixture.spawn_receiver(message_class=SumMessage)
+    # Sent through the receiver's control queue
+    request = SetReceiverTags({"region": "eu"}).send_after(0.2, targets={receiver.uid})
+    start_time = time.time()
+    while not request.response.is_processed() and time.time() - start_time < 2:
+        receiver.rdisq_process_one(0.5)
+    request.wait(1)
+    assert receiver.tags == {"region": "eu"}
@@ -0,0 +1,102 @@
+import threading
+import time
+
+import pytest
+
+from rdisq.request.rdisq_request import RdisqRequest, MultiRequest
+from rdisq.response import RdisqResponseTimeout, gather, as_completed, wait_any
+from tests._messages import SumMessage
+from tests._services import MathWorker
+
+
+@pytest.fixture
+def math_worker():
+    worker = MathWorker()
+    worker.get_redis().flushdb()
+    yield worker
+
+
+def test_gather(math_worker):
+    consumer = MathWorker.get_async_consumer()
+    responses = [consumer.square(i) for i in range(5)]
+    for _ in responses:
+        math_worker.rdisq_process_one()
+    assert gather(reversed(responses)) == [16, 9, 4, 1, 0]
+    # Answered responses don't wait again
+    assert responses[2].wait() == 4
+
+    responses = [consumer.square(1), consumer.square(-1)]
+    for _ in responses:
+        math_worker.rdisq_process_one()
+    with pytest.raises(ValueError):
+        gather(responses)
+
+
+def test_gather_partial_results(math_worker):
+    consumer = MathWorker.get_async_consumer()
+    responses = [consumer.square(2), consumer.square(-2), consumer.square(3)]
+    math_worker.rdisq_process_one()
+    math_worker.rdisq_process_one()
+    started_at = time.time()
+    results = gather(responses, timeout=0.3, return_exceptions=True)
+    assert time.time() - started_at < 1
+    assert results[0] == 4
+    assert isinstance(results[1], ValueError)
+    assert isinstance(results[2], RdisqResponseTimeout)
+
+    with pytest.raises(RdisqResponseTimeout):
+        gather([consumer.square(4)], timeout=0.2)
+
+
+def test_as_completed(math_worker):
+    consumer = MathWorker.get_async_consumer()
+    responses = [consumer.square(i) for i in range(3)]
+    math_worker.rdisq_process_one()
+    assert wait_any(responses, timeout=1) is responses[0]
+    math_worker.rdisq_process_one()
+    math_worker.rdisq_process_one()
+    assert [r.wait() for r in as_completed(responses, timeout=1)] == [0, 1, 4]
+
+    completed = as_completed([consumer.square(5), consumer.square(6)], timeout=0.3)
+    math_worker.rdisq_process_one()
+    assert next(completed).wait() == 25
+    with pytest.raises(RdisqResponseTimeout):
+        next(completed)
+
+
+def test_mixed_dispatchers(rdisq_message_fixture, math_worker):
+    receiver = rdisq_message_fixture.spawn_receiver(message_class=SumMessage)
+    request = RdisqRequest(SumMessage(1, 2)).send_async()
+    response = MathWorker.get_async_consumer().square(3)
+    receiver.rdisq_process_one()
+    math_worker.rdisq_process_one()
+    assert gather([request.response, response], timeout=1) == [3, 9]
+
+
+def test_multi_request_timeout(rdisq_message_fixture):
+    receivers = [rdisq_message_fixture.spawn_receiver(message_class=SumMessage) for _ in range(2)]
+    request = MultiRequest(SumMessage(2, 2)).send_async()
+    receivers[0].rdisq_process_one()
+    started_at = time.time()
+    with pytest.raises(RuntimeError, match="Got 1 out of 2"):
+        request.wait(0.3)
+    assert time.time() - started_at < 1
+
+
+def test_timeout_too_short_to_block(math_worker):
+    consumer = MathWorker.get_async_consumer()
+    errors = []
+
+    def wait_briefly():
+        for wait in [lambda r: gather([r], timeout=0.001), lambda r: r.wait(0.001)]:
+            try:
+                wait(consumer.square(2))
+            except RdisqResponseTimeout as ex:
+                errors.append(ex)
+
+    waiter = threading.Thread(group=None, target=wait_briefly, daemon=True)
+    waiter.start()
+    waiter.join(2)
+    # Timed out, rather than waiting forever
+    assert not waiter.is_alive()
+    assert len(errors) == 2
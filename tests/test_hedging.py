@@ -0,0 +1,62 @@
+import time
+from threading import Thread
+from typing import *
+
+from rdisq.consts import MIN_BLOCKING_TIMEOUT
+from rdisq.hedging import HedgingPolicy
+from rdisq.response import RdisqResponseTimeout
+from rdisq.request.rdisq_request import RdisqRequest
+from tests._messages import StallMessage, Staller
+
+if TYPE_CHECKING:
+    from tests.conftest import _RdisqMessageFixture
+
+
+def test_hedging_delay():
+    policy = HedgingPolicy(percentile=90, min_samples=10)
+    assert policy.get_delay("call") is None
+    for i in range(1, 11):
+        policy.observe("call", i / 10, hedged=False, hedge_won=False)
+    assert policy.get_delay("call") == 0.9
+    assert policy.get_delay("other_call") is None
+    assert policy.get_stats()["call"].requests == 10
+    assert policy.get_stats()["call"].hedge_rate == 0
+    assert HedgingPolicy(initial_delay=0).get_delay("call") == MIN_BLOCKING_TIMEOUT
+
+
+def test_hedged_request(rdisq_message_fixture: "_RdisqMessageFixture"):
+    stalled = rdisq_message_fixture.spawn_receiver(message_class=StallMessage, instance=Staller(2))
+    fast = rdisq_message_fixture.spawn_receiver(message_class=StallMessage, instance=Staller(0))
+    Thread(group=None, target=stalled.process).start()
+    stalled.wait_for_process_to_start(3)
+
+    policy = HedgingPolicy(initial_delay=0.3)
+    request = RdisqRequest(StallMessage(), hedging=policy).send_async()
+    time.sleep(0.1)  # Taken by the stalled receiver
+    Thread(group=None, target=fast.process).start()
+    assert request.wait(2) == 0
+    assert request.response.response_payload.service_uid == fast.uid
+    assert policy.get_stats()["StallMessage"] == (1, 1, 1)
+    rdisq_message_fixture.kill_all()
+
+
+def test_hedged_timeout_too_short_to_block(rdisq_message_fixture: "_RdisqMessageFixture"):
+    stalled = rdisq_message_fixture.spawn_receiver(message_class=StallMessage, instance=Staller(2))
+    Thread(group=None, target=stalled.process).start()
+    stalled.wait_for_process_to_start(3)
+    request = RdisqRequest(StallMessage(), hedging=HedgingPolicy(initial_delay=1)).send_async()
+    errors = []
+
+    def wait_briefly():
+        try:
+            request.wait(0.001)
+        except RdisqResponseTimeout as ex:
+            errors.append(ex)
+
+    waiter = Thread(group=None, target=wait_briefly, daemon=True)
+    waiter.start()
+    waiter.join(2)
+    # Timed out, rather than waiting forever
+    assert not waiter.is_alive()
+    assert len(errors) == 1
+    rdisq_message_fixture.kill_all()
@@ -0,0 +1,72 @@
+import threading
+from typing import *
+from unittest.mock import patch
+
+import pytest
+
+from tests._services import MathWorker, BatchWorker, LookupWorker
+
+
+@pytest.fixture
+def math_workers():
+    workers = [MathWorker(), MathWorker(), BatchWorker()]
+    workers[0].get_redis().flushdb()
+    for w in workers:
+        threading.Thread(group=None, target=w.process).start()
+    yield workers
+    for w in workers:
+        w.stop()
+    for w in workers:
+        w.wait_for_process_to_stop(5)
+
+
+def test_map(math_workers):
+    assert MathWorker.get_async_consumer().map("square", range(20), chunksize=3) == [i ** 2 for i in range(20)]
+    assert MathWorker.get_consumer().map("square", iter([3, 4]), max_in_flight=1) == [9, 16]
+    # Batch handlers get a task per item, and gather them on the worker
+    assert BatchWorker.get_async_consumer().map("double", range(5), chunksize=2) == [0, 2, 4, 6, 8]
+    with pytest.raises(ValueError):
+        MathWorker.get_async_consumer().map("square", [1, -1, 2])
+
+
+def test_imap_is_lazy(math_workers):
+    consumed = []
+
+    def values():
+        for i in range(1000):
+            consumed.append(i)
+            yield i
+
+    results = MathWorker.get_async_consumer().imap("square", values(), chunksize=2, max_in_flight=2)
+    assert next(results) == 0
+    assert next(results) == 1
+    assert len(consumed) == 4
+    results.close()
+
+
+def test_imap_unordered(math_workers):
+    results = MathWorker.get_async_consumer().imap_unordered("square", range(30), chunksize=4, max_in_flight=3)
+    assert sorted(results) == [i ** 2 for i in range(30)]
+
+
+def test_map_applies_call_options(math_workers):
+    worker = LookupWorker()
+    threading.Thread(group=None, target=worker.process).start()
+    try:
+        consumer = LookupWorker.get_async_consumer()
+        lookup_count = LookupWorker.lookup_count
+        assert consumer.map("lookup", ["a", "b"], chunksize=2) == ["A", "B"]
+        # Cached like calls made with send
+        assert consumer.map("lookup", ["a", "b"], chunksize=2) == ["A", "B"]
+        assert LookupWorker.lookup_count == lookup_count + 2
+    finally:
+        worker.stop()
+        worker.wait_for_process_to_stop(5)
+
+
+def test_map_task_timeout(math_workers):
+    dispatcher = MathWorker.redis_dispatcher
+    with patch.object(dispatcher, "queue_task", wraps=dispatcher.queue_task) as queue_task:
+        assert MathWorker.get_async_consumer().map("square", range(4), chunksize=2, timeout=2) == [0, 1, 4, 9]
+    # The tasks don't outlive the caller's wait for them
+    assert [c.kwargs["timeout"] for c in queue_task.call_args_list] == [2, 2]
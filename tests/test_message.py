@@ -1,6 +1,7 @@
 import time
 from typing import *
 from threading import Thread
+from unittest.mock import patch
 
 import pytest
 from redis import Redis
@@ -9,11 +10,15 @@ from rdisq.configuration import get_rdisq_config
 from rdisq.request.handler import _HandlerFactory
 from rdisq.request.rdisq_request import RdisqRequest, MultiRequest
 from rdisq.request.dispatcher import RequestDispatcher, ReceiverServiceStatus
+from rdisq.request.receiver_filter import ReceiverFilter
 from rdisq.request.receiver import (
     ReceiverService, RegisterMessage, UnregisterMessage, GetRegisteredMessages, RegisterAll,
-    CORE_RECEIVER_MESSAGES, AddQueue, RemoveQueue, SetReceiverTags, ShutDownReceiver)
-from rdisq.response import RdisqResponseTimeout
-from tests._messages import SumMessage, sum_, AddMessage, SubtractMessage, Summer
+    CORE_RECEIVER_MESSAGES, AddQueue, RemoveQueue, SetReceiverTags, ShutDownReceiver, GetSlowCalls)
+from rdisq.identification import get_request_key
+from rdisq.response import RdisqResponseTimeout, RdisqTaskCancelled
+from tests._messages import (
+    SumMessage, sum_, AddMessage, SubtractMessage, Summer, SleepMessage, SquareMessage, CubeMessage,
+    UrgentMessage)
 from tests._other_module import MessageFromExternalModule
 
 if TYPE_CHECKING:
@@ -283,6 +288,54 @@ def test_custom_filter_with_tags(rdisq_message_fixture: "_RdisqMessageFixture"):
     assert receivers[3]._handlers[AddMessage]._handler_instance.sum == 0
 
 
+def test_receiver_filter(rdisq_message_fixture: "_RdisqMessageFixture"):
+    receivers: List[ReceiverService] = rdisq_message_fixture.spawn_receivers(4)
+    dispatcher = get_rdisq_config().request_dispatcher
+    receivers[0].register_message(RegisterMessage(SumMessage))
+    receivers[1].register_message(RegisterMessage(SumMessage))
+    for r, region in zip(receivers, ["eu", "us", "eu", "asia"]):
+        r.set_tags(SetReceiverTags({"region": region}))
+
+    uids = [r.uid for r in receivers]
+    assert dispatcher.find_receiver_uids(ReceiverFilter({"region": "eu"})) == {uids[0], uids[2]}
+    assert dispatcher.find_receiver_uids(ReceiverFilter({"region": {"eu", "us"}})) == set(uids[:3])
+    assert dispatcher.find_receiver_uids(ReceiverFilter({"region": "eu"}, SumMessage)) == {uids[0]}
+    assert dispatcher.find_receiver_uids(ReceiverFilter(uids=uids[1:], message_class=SumMessage)) == {uids[1]}
+    assert dispatcher.find_receiver_uids(ReceiverFilter()) == set(uids)
+    # Agrees with running it on the statuses
+    assert {s.uid for s in filter(ReceiverFilter({"region": "eu"}), dispatcher.get_receiver_services().values())} \
+           == {uids[0], uids[2]}
+
+    # Indexes follow changes in tags and registered messages
+    receivers[2].set_tags(SetReceiverTags({"region": "us"}))
+    receivers[0].unregister_message(UnregisterMessage(SumMessage))
+    assert dispatcher.find_receiver_uids(ReceiverFilter({"region": "eu"})) == {uids[0]}
+    assert dispatcher.find_receiver_uids(ReceiverFilter(message_class=SumMessage)) == {uids[1]}
+
+    request = MultiRequest(SumMessage(1, 2), ReceiverFilter({"region": "us"})).send_async()
+    rdisq_message_fixture.process_all_receivers()
+    assert request.wait(1) == [3]
+
+    receivers[3].shut_down_receiver()
+    assert dispatcher.find_receiver_uids(ReceiverFilter({"region": "asia"})) == set()
+
+
+def test_receiver_filter_tag_types(rdisq_message_fixture: "_RdisqMessageFixture"):
+    receivers: List[ReceiverService] = rdisq_message_fixture.spawn_receivers(3)
+    dispatcher = get_rdisq_config().request_dispatcher
+    for r, tier in zip(receivers, [1, True, "1"]):
+        r.set_tags(SetReceiverTags({"tier": tier, "zones": [tier]}))
+
+    uids = [r.uid for r in receivers]
+    statuses = dispatcher.get_receiver_services().values()
+    # Equal values match, on the server and in process alike
+    for tier, expected in [(1, {uids[0], uids[1]}), (1.0, {uids[0], uids[1]}), ("1", {uids[2]})]:
+        assert dispatcher.find_receiver_uids(ReceiverFilter({"tier": tier})) == expected
+        assert {s.uid for s in filter(ReceiverFilter({"tier": tier}), statuses)} == expected
+    with pytest.raises(TypeError):
+        ReceiverFilter({"zones": [[1]]})
+
+
 def test_register_entire_class_with_kwargs(rdisq_message_fixture: "_RdisqMessageFixture"):
     rdisq_message_fixture.spawn_receiver()
     request = RegisterAll({"start": 2}, Summer).send_async()
@@ -312,3 +365,199 @@ def test_another_server(rdisq_message_fixture: "_RdisqMessageFixture"):
     request = RegisterAll({"start": 2}, Summer).send_async(request_dispatcher=dispatcher)
     rdisq_message_fixture.process_all_receivers()
     assert {AddMessage, SubtractMessage} < request.wait()
+
+
+def test_slow_calls(rdisq_message_fixture: "_RdisqMessageFixture"):
+    receiver_service = rdisq_message_fixture.spawn_receiver(message_class=SleepMessage)
+
+    for seconds in (0, 0.1):
+        request = SleepMessage(seconds).send_async()
+        receiver_service.rdisq_process_one(1)
+        request.wait(1)
+
+    request = GetSlowCalls().send_async()
+    receiver_service.rdisq_process_one(1)
+    slow_calls = request.wait(1)
+    assert len(slow_calls) == 1
+    assert slow_calls[0].call_name == "SleepMessage"
+    assert slow_calls[0].args_summary == "SleepMessage(seconds=0.1)"
+    assert slow_calls[0].handler_seconds >= 0.1
+    assert slow_calls[0].queue_wait_seconds >= 0
+    assert receiver_service.slow_call_log.get_stats()["SleepMessage"] == (2, 1)
+
+
+def test_cached_message(rdisq_message_fixture: "_RdisqMessageFixture"):
+    receiver_service = rdisq_message_fixture.spawn_receiver(message_class=SquareMessage)
+    SquareMessage.handled_count = 0
+
+    request = SquareMessage(3).send_async()
+    receiver_service.rdisq_process_one(1)
+    assert request.wait(1) == 9
+
+    # Answered from the cache, nothing is queued for the receiver
+    assert SquareMessage(3).send_and_wait(timeout=1) == 9
+    assert SquareMessage.handled_count == 1
+    assert receiver_service.rdisq_process_one(0.1) is False
+
+    request = SquareMessage(4).send_async()
+    receiver_service.rdisq_process_one(1)
+    assert request.wait(1) == 16
+    assert SquareMessage.handled_count == 2
+
+
+def test_coalesced_message(rdisq_message_fixture: "_RdisqMessageFixture"):
+    receiver_service = rdisq_message_fixture.spawn_receiver(message_class=CubeMessage)
+    CubeMessage.handled_count = 0
+
+    requests = [CubeMessage(2).send_async() for _ in range(3)]
+    other_request = CubeMessage(3).send_async()
+    receiver_service.rdisq_process_one(1)
+    receiver_service.rdisq_process_one(1)
+    assert receiver_service.rdisq_process_one(0.1) is False
+
+    assert [r.wait(1) for r in requests] == [8, 8, 8]
+    assert other_request.wait(1) == 27
+    assert CubeMessage.handled_count == 2
+
+    # Once the call is done, an identical one is queued again
+    request = CubeMessage(2).send_async()
+    receiver_service.rdisq_process_one(1)
+    assert request.wait(1) == 8
+    assert CubeMessage.handled_count == 3
+
+
+def test_registration_while_processing(rdisq_message_fixture: "_RdisqMessageFixture"):
+    receiver_service = rdisq_message_fixture.spawn_receiver(message_class=SumMessage)
+    Thread(target=receiver_service.process).start()
+    try:
+        requests = []
+        for i in range(20):
+            # Core messages are served on the control lane, concurrently with the data thread
+            RdisqRequest(RegisterMessage(AddMessage, {"start": 0}), targets={receiver_service.uid}).send_async().wait(5)
+            requests.append(SumMessage(i, 1).send_async())
+            RdisqRequest(UnregisterMessage(AddMessage), targets={receiver_service.uid}).send_async().wait(5)
+        assert [r.wait(5) for r in requests] == [i + 1 for i in range(20)]
+    finally:
+        receiver_service.stop()
+        receiver_service.wait_for_process_to_stop(5)
+
+
+def test_message_fields_dont_set_options(rdisq_message_fixture: "_RdisqMessageFixture"):
+    receiver_service = rdisq_message_fixture.spawn_receiver(message_class=SumMessage)
+    message = SumMessage(1, 2)
+    message.time_limit = 0.01
+    message.priority = 10
+    request = message.send_async()
+    time.sleep(0.05)
+    receiver_service.rdisq_process_one(1)
+    assert request.wait(1) == 3
+
+
+def test_message_priority(rdisq_message_fixture: "_RdisqMessageFixture"):
+    receiver_service = rdisq_message_fixture.spawn_receiver(message_class=SumMessage)
+    receiver_service.register_message(RegisterMessage(UrgentMessage))
+
+    status = get_rdisq_config().request_dispatcher.get_receiver_services()[receiver_service.uid]
+    assert status.scheduling["policy"] == "priority"
+    assert status.scheduling["queues"][
+        receiver_service.get_queue_name_for_method(UrgentMessage.get_message_class_id())].priority == 10
+
+    sum_request = SumMessage(1, 2).send_async()
+    urgent_request = UrgentMessage().send_async()
+    receiver_service.rdisq_process_one(1)
+    assert urgent_request.response.is_processed()
+    assert not sum_request.response.is_processed()
+    receiver_service.rdisq_process_one(1)
+    assert sum_request.wait(1) == 3
+
+
+def test_control_lane(rdisq_message_fixture: "_RdisqMessageFixture"):
+    receiver_service = rdisq_message_fixture.spawn_receiver(message_class=SleepMessage)
+    Thread(group=None, target=receiver_service.process).start()
+    receiver_service.wait_for_process_to_start(3)
+
+    slow_request = SleepMessage(2).send_async()
+    time.sleep(0.5)
+    start_time = time.time()
+    assert SetReceiverTags({"busy": True}).send_and_wait(timeout=1) == {"busy": True}
+    assert time.time() - start_time < 1
+    assert not slow_request.response.is_processed()
+    assert slow_request.wait(3) == 2
+
+    ShutDownReceiver().send_and_wait(timeout=1)
+    receiver_service.wait_for_process_to_stop(3)
+
+
+def test_single_inbox(rdisq_message_fixture: "_RdisqMessageFixture"):
+    receivers = [ReceiverService(single_inbox=True) for _ in range(2)]
+    rdisq_message_fixture.receivers.extend(receivers)
+    for r in receivers:
+        r.register_all(RegisterAll({}, Summer))
+        r.register_message(RegisterMessage(SumMessage))
+        assert r.listening_queues == {r.get_queue_name_for_method("rdisq_inbox", r.uid)}
+        Thread(group=None, target=r.process).start()
+        r.wait_for_process_to_start(3)
+
+    assert RdisqRequest(SumMessage(1, 2), targets={receivers[0].uid}).send_and_wait_reply(1) == 3
+
+    # A request to a group of receivers provisions one queue for the group
+    assert AddMessage(2).send_and_wait(timeout=3) == 2
+    for r in receivers:
+        assert len(r.listening_queues) == 2
+    assert sorted(MultiRequest(SubtractMessage(1)).send_and_wait_reply(1)) == [-1, 1]
+    rdisq_message_fixture.kill_all()
+
+
+def test_cancel(rdisq_message_fixture: "_RdisqMessageFixture"):
+    receiver = rdisq_message_fixture.spawn_receiver(message_class=SumMessage)
+    redis_con = rdisq_message_fixture.redis
+
+    request = SumMessage(1, 2).send_async()
+    assert redis_con.llen(request.response.queue_name) == 1
+    assert request.cancel()
+    assert redis_con.llen(request.response.queue_name) == 0
+    with pytest.raises(RdisqTaskCancelled):
+        request.wait(1)
+
+    request = SumMessage(1, 2).send_async()
+    with pytest.raises(RdisqResponseTimeout):
+        request.wait(1, cancel_on_timeout=True)
+    assert redis_con.llen(request.response.queue_name) == 0
+    assert not request.cancel()
+
+    # A task whose request is gone by the time it's popped is skipped
+    request = SumMessage(1, 2).send_async()
+    redis_con.delete(get_request_key(request.task_id))
+    receiver.rdisq_process_one(1)
+    assert receiver.abandoned_task_count == 1
+    assert not request.response.is_processed()
+
+    request = SumMessage(1, 2).send_async()
+    receiver.rdisq_process_one(1)
+    assert request.wait(1) == 3
+    assert not request.cancel()
+
+    # A task that a worker took on can't be cancelled, even before its reply is read
+    request = SumMessage(1, 2).send_async()
+    receiver.rdisq_process_one(1)
+    assert not request.cancel()
+
+
+def test_control_lane_stops_on_exception(rdisq_message_fixture: "_RdisqMessageFixture"):
+    receiver_service = rdisq_message_fixture.spawn_receiver(message_class=SumMessage)
+    errors = []
+
+    def process():
+        try:
+            receiver_service.process()
+        except ConnectionError as ex:
+            errors.append(ex)
+
+    with patch.object(receiver_service, "_on_process_loop", side_effect=[None, ConnectionError()]):
+        processor = Thread(group=None, target=process)
+        processor.start()
+        processor.join(receiver_service.polling_timeout + 3)
+    # The control lane was stopped too, rather than keeping process() from returning
+    assert not processor.is_alive()
+    assert len(errors) == 1
+    assert not receiver_service.is_active
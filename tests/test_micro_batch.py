@@ -0,0 +1,120 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import *
+
+import pytest
+from redis import ResponseError
+
+from rdisq.admission import QueueFullError
+from rdisq.micro_batch import MicroBatcher
+from rdisq.request.dispatcher import RequestDispatcher
+from rdisq.request.rdisq_request import RdisqRequest
+from tests._messages import SumMessage
+from tests._services import StallingWorker
+
+if TYPE_CHECKING:
+    from tests.conftest import _RdisqMessageFixture
+
+
+def test_micro_batcher():
+    batches = []
+    batcher = MicroBatcher(batches.append, max_size=3, max_delay=0.1)
+    with ThreadPoolExecutor(4) as executor:
+        list(executor.map(batcher.add, range(4)))
+    time.sleep(0.05)
+    # A full batch is flushed right away, the rest waits for max_delay
+    assert [len(b) for b in batches] == [3]
+    time.sleep(0.1)
+    assert sorted(i for b in batches for i in b) == [0, 1, 2, 3]
+
+    batcher.add(4)
+    batcher.close()
+    assert batches[-1] == [4]
+    with pytest.raises(RuntimeError):
+        batcher.add(5)
+
+
+def test_micro_batcher_errors():
+    batches, failed = [], []
+
+    def flush(items):
+        if items == [0]:
+            raise ValueError()
+        batches.append(items)
+
+    batcher = MicroBatcher(flush, max_size=1, on_error=lambda items, ex: failed.append((items, type(ex))))
+    batcher.add(0)
+    batcher.add(1)
+    batcher.close()
+    assert failed == [([0], ValueError)]
+    assert batches == [[1]]
+
+
+def test_micro_batched_requests(rdisq_message_fixture: "_RdisqMessageFixture"):
+    receiver = rdisq_message_fixture.spawn_receiver(message_class=SumMessage)
+    dispatcher = RequestDispatcher(host='127.0.0.1', port=6379, db=0)
+    dispatcher.enable_micro_batching(max_size=100, max_delay=0.1)
+    try:
+        with ThreadPoolExecutor(8) as executor:
+            requests = list(executor.map(
+                lambda i: RdisqRequest(SumMessage(i, i), request_dispatcher=dispatcher).send_async(), range(8)))
+        queue_name = requests[0].response.queue_name
+        assert rdisq_message_fixture.redis.llen(queue_name) == 0
+        time.sleep(0.15)
+        assert rdisq_message_fixture.redis.llen(queue_name) == 8
+        for _ in requests:
+            receiver.rdisq_process_one(1)
+        assert sorted(r.wait(1) for r in requests) == [i * 2 for i in range(8)]
+
+        dispatcher.set_queue_limit(queue_name, 1)
+        first, second = [RdisqRequest(SumMessage(1, 1), request_dispatcher=dispatcher).send_async()
+                         for _ in range(2)]
+        dispatcher.micro_batcher.flush()
+        receiver.rdisq_process_one(1)
+        assert first.wait(1) == 2
+        with pytest.raises(QueueFullError):
+            second.wait(1)
+    finally:
+        dispatcher.close()
+
+
+def test_micro_batched_consumer(rdisq_message_fixture: "_RdisqMessageFixture"):
+    worker = StallingWorker()
+    StallingWorker.redis_dispatcher.enable_micro_batching()
+    try:
+        responses = [StallingWorker.get_async_consumer().stall() for _ in range(3)]
+        for _ in responses:
+            worker.rdisq_process_one(1)
+        assert [r.wait(1) for r in responses] == [worker.uid] * 3
+    finally:
+        StallingWorker.redis_dispatcher.disable_micro_batching()
+
+
+def test_micro_batched_errors(rdisq_message_fixture: "_RdisqMessageFixture"):
+    dispatcher = RequestDispatcher(host='127.0.0.1', port=6379, db=0)
+    dispatcher.enable_micro_batching(max_size=100, max_delay=0.3)
+    try:
+        rdisq_message_fixture.redis.set("not_a_queue", "")
+        failing = dispatcher.queue_task("not_a_queue", timeout=5)
+        queued = dispatcher.queue_task("some_queue", timeout=5)
+        # The caller is already waiting when the batch fails
+        with pytest.raises(ResponseError):
+            failing.wait(1)
+        assert rdisq_message_fixture.redis.lrange("some_queue", 0, -1) == [queued.task_id.encode()]
+    finally:
+        dispatcher.close()
+
+
+def test_cancel_buffered(rdisq_message_fixture: "_RdisqMessageFixture"):
+    dispatcher = RequestDispatcher(host='127.0.0.1', port=6379, db=0)
+    dispatcher.enable_micro_batching(max_size=100, max_delay=0.1)
+    try:
+        cancelled = dispatcher.queue_task("some_queue", timeout=5)
+        queued = dispatcher.queue_task("some_queue", timeout=5)
+        assert cancelled.cancel()
+        dispatcher.micro_batcher.flush()
+        assert rdisq_message_fixture.redis.lrange("some_queue", 0, -1) == [queued.task_id.encode()]
+        assert queued.cancel()
+        assert not rdisq_message_fixture.redis.llen("some_queue")
+    finally:
+        dispatcher.close()
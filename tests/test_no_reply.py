@@ -0,0 +1,29 @@
+import pytest
+
+from rdisq.request.rdisq_request import RdisqRequest
+from tests._messages import SumMessage
+from tests._services import MathWorker
+
+
+def test_no_reply(rdisq_message_fixture):
+    worker = MathWorker()
+    worker.log_returned_exceptions = False
+    redis_con = worker.get_redis()
+    redis_con.flushdb()
+    consumer = MathWorker.get_consumer()
+
+    response = consumer.send("square", 3, rdisq_no_reply=True)
+    assert worker.rdisq_process_one(1) is not False
+    assert not redis_con.exists(response.task_id)
+    with pytest.raises(RuntimeError):
+        response.wait()
+
+    consumer.send_no_reply("square", -3)
+    worker.rdisq_process_one(1)
+    assert worker.unreplied_error_count == 1
+    assert not redis_con.keys("MathWorker_square*")
+
+    receiver = rdisq_message_fixture.spawn_receiver(message_class=SumMessage)
+    request = RdisqRequest(SumMessage(1, 2)).send_async(no_reply=True)
+    receiver.rdisq_process_one(1)
+    assert not redis_con.exists(request.response.task_id)
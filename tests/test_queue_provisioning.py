@@ -0,0 +1,108 @@
+import time
+from threading import Thread
+from typing import *
+from unittest.mock import patch
+
+from rdisq.configuration import get_rdisq_config
+import pytest
+
+from rdisq.request.receiver import ReceiverService
+from rdisq.request.rdisq_request import RdisqRequest, prewarm_queue, collect_unused_queues, provision_queue
+from tests._messages import SumMessage
+
+if TYPE_CHECKING:
+    from tests.conftest import _RdisqMessageFixture
+
+
+def _start_receivers(rdisq_message_fixture: "_RdisqMessageFixture", count: int):
+    receivers = [rdisq_message_fixture.spawn_receiver(message_class=SumMessage) for _ in range(count)]
+    for r in receivers:
+        Thread(group=None, target=r.process).start()
+        r.wait_for_process_to_start(3)
+    return receivers
+
+
+@pytest.fixture
+def background_provisioning():
+    dispatcher = get_rdisq_config().request_dispatcher
+    dispatcher.provision_in_background = True
+    yield
+    del dispatcher.provision_in_background
+
+
+def test_background_provisioning(rdisq_message_fixture: "_RdisqMessageFixture", background_provisioning):
+    receivers = _start_receivers(rdisq_message_fixture, 3)
+    dispatcher = get_rdisq_config().request_dispatcher
+    pair = {receivers[0].uid, receivers[1].uid}
+
+    # Delivered right away, while the pair is given a queue of its own
+    assert RdisqRequest(SumMessage(1, 2), lambda s: s.uid in pair).send_and_wait_reply(1) == 3
+    queue = dispatcher.get_pending_queue(pair)
+    assert queue is not None
+    time.sleep(1.5)
+    assert dispatcher.find_queues_for_services(pair) == {queue}
+
+    request = RdisqRequest(SumMessage(2, 2), lambda s: s.uid in pair).send_async()
+    assert request.task_id.startswith(queue)
+    assert request.wait(1) == 4
+
+    # Recently used queues are kept
+    assert collect_unused_queues() == set()
+    control_replies = ReceiverService.get_control_queue_name("*") + "*"
+    replies_before = set(rdisq_message_fixture.redis.keys(control_replies))
+    assert collect_unused_queues(max_idle_seconds=0) == {queue}
+    time.sleep(1.5)
+    assert not dispatcher.find_queues_for_services(pair)
+    # Nobody reads the replies of the removal, so none are sent
+    assert set(rdisq_message_fixture.redis.keys(control_replies)) <= replies_before
+    rdisq_message_fixture.kill_all()
+
+
+def test_background_provisioning_without_own_queues(rdisq_message_fixture: "_RdisqMessageFixture",
+                                                    background_provisioning):
+    receivers = _start_receivers(rdisq_message_fixture, 3)
+    dispatcher = get_rdisq_config().request_dispatcher
+    pair = {receivers[0].uid, receivers[1].uid}
+    find_queues_for_services = dispatcher.find_queues_for_services
+
+    def find_shared_queues(service_uids, *args):
+        return find_queues_for_services(service_uids, *args) if len(service_uids) > 1 else frozenset()
+
+    # With no queue of a single receiver to deliver through, the request waits for the shared queue
+    with patch.object(dispatcher, "find_queues_for_services", find_shared_queues):
+        request = RdisqRequest(SumMessage(1, 2), targets=pair).send_async()
+    assert request.task_id.startswith(tuple(find_queues_for_services(pair)))
+    assert request.wait(1) == 3
+    rdisq_message_fixture.kill_all()
+
+
+def test_prewarm_queue(rdisq_message_fixture: "_RdisqMessageFixture"):
+    receivers = _start_receivers(rdisq_message_fixture, 3)
+    dispatcher = get_rdisq_config().request_dispatcher
+    pair = {receivers[0].uid, receivers[2].uid}
+
+    queue = prewarm_queue(lambda s: s.uid in pair, message_class=SumMessage)
+    assert dispatcher.find_queues_for_services(pair) == {queue}
+    assert prewarm_queue(targets=pair) == queue
+
+    request = RdisqRequest(SumMessage(1, 1), targets=pair).send_async()
+    assert request.task_id.startswith(queue)
+    assert request.wait(1) == 2
+    rdisq_message_fixture.kill_all()
+
+
+def test_targeted_send_uses_queue_index(rdisq_message_fixture: "_RdisqMessageFixture"):
+    receivers = [rdisq_message_fixture.spawn_receiver(message_class=SumMessage) for _ in range(3)]
+    dispatcher = get_rdisq_config().request_dispatcher
+    pair = {receivers[0].uid, receivers[1].uid}
+    queue = provision_queue(pair, wait=False)
+    rdisq_message_fixture.process_all_receivers()
+    assert dispatcher.find_queues_for_services(pair) == {queue}
+    assert dispatcher.find_queues_for_services(pair, dispatcher.get_queue_listeners()) == {queue}
+
+    # The queue is found without reading the status of every receiver
+    with patch.object(dispatcher, "get_all_receiver_statuses", side_effect=AssertionError):
+        request = RdisqRequest(SumMessage(2, 2), targets=pair).send_async()
+    assert request.task_id.startswith(queue)
+    receivers[0].rdisq_process_one(1)
+    assert request.wait(1) == 4
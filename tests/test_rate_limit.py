@@ -0,0 +1,113 @@
+import time
+from threading import Thread
+from typing import *
+
+import pytest
+
+from rdisq.configuration import get_rdisq_config
+from rdisq.rate_limit import RateLimit, RateLimitExceeded, take_token, get_rate_limit_wait
+from rdisq.request.rdisq_request import RdisqRequest
+from rdisq.request.receiver import ReceiverService, RegisterMessage
+from tests._messages import ThrottledMessage, SumMessage
+from tests._services import ThrottledWorker
+
+if TYPE_CHECKING:
+    from tests.conftest import _RdisqMessageFixture
+
+
+def test_token_bucket(rdisq_message_fixture: "_RdisqMessageFixture"):
+    redis_con = rdisq_message_fixture.redis
+    limit = RateLimit(rate=10, burst=2)
+    assert take_token(redis_con, "bucket", limit) == 0
+    assert take_token(redis_con, "bucket", limit) == 0
+    wait = take_token(redis_con, "bucket", limit)
+    assert 0 < wait <= 0.1
+    time.sleep(wait)
+    assert get_rate_limit_wait(redis_con, "bucket", limit) == 0
+    assert get_rate_limit_wait(redis_con, "bucket", limit) == 0
+    assert take_token(redis_con, "bucket", limit) == 0
+    assert get_rate_limit_wait(redis_con, "bucket", limit) > 0
+
+
+def test_rate_limited_message(rdisq_message_fixture: "_RdisqMessageFixture"):
+    receiver = rdisq_message_fixture.spawn_receiver(message_class=ThrottledMessage)
+    requests = [RdisqRequest(ThrottledMessage(i)).send_async() for i in range(3)]
+
+    receiver.rdisq_process_one(1)
+    start_time = time.time()
+    receiver.rdisq_process_one(1)
+    # Deferred until the limit allowed it
+    assert 0.1 < time.time() - start_time < 0.5
+    assert [r.wait(1) for r in requests[:2]] == [0, 1]
+
+    receiver.rate_limit_max_defer = 0
+    receiver.rdisq_process_one(0.1)
+    assert receiver.rate_limited_task_count == 1
+    assert ThrottledMessage.get_rate_limit_wait() > 0
+    # The queue is paused until the limit allows the task, then it's handled
+    assert not receiver.rdisq_process_one(1)
+    receiver.rdisq_process_one(1)
+    assert requests[2].wait(1) == 2
+
+
+def test_client_check(rdisq_message_fixture: "_RdisqMessageFixture"):
+    receiver = rdisq_message_fixture.spawn_receiver(message_class=ThrottledMessage)
+    dispatcher = get_rdisq_config().request_dispatcher
+    dispatcher.check_rate_limits = True
+    try:
+        request = RdisqRequest(ThrottledMessage(1)).send_async()
+        receiver.rdisq_process_one(1)
+        assert request.wait(1) == 1
+        with pytest.raises(RateLimitExceeded):
+            RdisqRequest(ThrottledMessage(2)).send_async()
+    finally:
+        del dispatcher.check_rate_limits
+
+
+def test_rate_limited_method(rdisq_message_fixture: "_RdisqMessageFixture"):
+    worker = ThrottledWorker()
+    consumer = ThrottledWorker.get_async_consumer()
+    responses = [consumer.echo(i) for i in range(3)]
+    for _ in responses:
+        worker.rdisq_process_one(1)
+    assert [r.wait(1) for r in responses] == [0, 1, 2]
+    assert consumer.get_rate_limit_wait("echo") > 0
+
+    ThrottledWorker.redis_dispatcher.check_rate_limits = True
+    try:
+        with pytest.raises(RateLimitExceeded):
+            consumer.echo(3)
+    finally:
+        del ThrottledWorker.redis_dispatcher.check_rate_limits
+
+
+def test_rate_limited_message_in_shared_queue(rdisq_message_fixture: "_RdisqMessageFixture"):
+    receiver = ReceiverService(message_class=ThrottledMessage, single_inbox=True)
+    rdisq_message_fixture.receivers.append(receiver)
+    receiver.register_message(RegisterMessage(SumMessage))
+    receiver.rate_limit_max_defer = 0
+    requests = [RdisqRequest(ThrottledMessage(i), targets={receiver.uid}).send_async() for i in range(2)]
+    receiver.rdisq_process_one(1)
+    receiver.rdisq_process_one(1)
+    assert receiver.rate_limited_task_count == 1
+
+    # The inbox isn't paused for messages of other classes
+    request = RdisqRequest(SumMessage(1, 2), targets={receiver.uid}).send_async()
+    start_time = time.time()
+    receiver.rdisq_process_one(1)
+    assert request.wait(1) == 3
+    assert time.time() - start_time < 0.1
+    time.sleep(0.2)
+    receiver.rdisq_process_one(1)
+    assert [r.wait(1) for r in requests] == [0, 1]
+
+
+def test_queue_resuming_right_away(rdisq_message_fixture: "_RdisqMessageFixture"):
+    worker = ThrottledWorker()
+    queue_name = next(iter(worker.listening_queues))
+    worker._paused_queues[queue_name] = time.time() + 0.0008
+    processor = Thread(group=None, target=worker.rdisq_process_one, args=(1,), daemon=True)
+    processor.start()
+    # A wait too short for the server to block on doesn't turn into waiting forever
+    processor.join(2)
+    assert not processor.is_alive()
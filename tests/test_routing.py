@@ -0,0 +1,72 @@
+from typing import *
+
+from rdisq.configuration import get_rdisq_config
+from rdisq.load import ServiceLoad, get_load_score
+from rdisq.request.rdisq_request import RdisqRequest
+from rdisq.request.routing import LEAST_LOADED_ROUTING, POWER_OF_TWO_ROUTING, choose_receiver, HashRing
+from rdisq.request.session import RdisqSession
+from tests._messages import SumMessage, LookupMessage
+
+if TYPE_CHECKING:
+    from tests.conftest import _RdisqMessageFixture
+
+
+def test_load_score():
+    assert get_load_score(ServiceLoad()) < get_load_score(ServiceLoad(queue_depth=1))
+    # A fast receiver with a backlog can still be the better choice
+    assert get_load_score(ServiceLoad(queue_depth=3, latency_ewma=0.01)) < \
+           get_load_score(ServiceLoad(queue_depth=0, latency_ewma=1))
+    assert get_load_score(ServiceLoad(in_flight=5, latency_ewma=1)) < get_load_score(None)
+
+
+def test_least_loaded_routing(rdisq_message_fixture: "_RdisqMessageFixture"):
+    dispatcher = get_rdisq_config().request_dispatcher
+    busy, idle = rdisq_message_fixture.spawn_receiver(message_class=SumMessage), \
+                 rdisq_message_fixture.spawn_receiver(message_class=SumMessage)
+    for i in range(3):
+        RdisqRequest(SumMessage(i, i), targets={busy.uid}).send_async()
+    busy.publish_status()
+    assert dispatcher.get_receiver_services()[busy.uid].load.queue_depth == 3
+
+    for routing in [LEAST_LOADED_ROUTING, POWER_OF_TWO_ROUTING]:
+        assert choose_receiver({busy.uid, idle.uid}, dispatcher, routing) == idle.uid
+        request = RdisqRequest(SumMessage(1, 2), routing=routing).send_async()
+        idle.rdisq_process_one(1)
+        assert request.wait(1) == 3
+
+    idle.publish_status()
+    assert dispatcher.get_receiver_services()[idle.uid].load.latency_ewma is not None
+
+    session = RdisqSession(routing=LEAST_LOADED_ROUTING)
+    session.send(SumMessage(2, 2))
+    idle.rdisq_process_one(1)
+    assert session.wait(1) == 4
+    assert session._service_id == idle.uid
+
+
+def test_hash_ring_rebalancing():
+    keys = [f"key{i}" for i in range(1000)]
+    ring = HashRing(["a", "b", "c"])
+    before = {k: ring.get_receiver(k) for k in keys}
+    assert set(before.values()) == {"a", "b", "c"}
+
+    after = {k: HashRing(["a", "b", "c", "d"]).get_receiver(k) for k in keys}
+    moved = {k for k in keys if before[k] != after[k]}
+    assert moved and all(after[k] == "d" for k in moved)
+    assert len(moved) < len(keys) / 2
+
+    after = {k: HashRing(["a", "b"]).get_receiver(k) for k in keys}
+    assert {k for k in keys if before[k] != after[k]} == {k for k in keys if before[k] == "c"}
+
+
+def test_key_affinity(rdisq_message_fixture: "_RdisqMessageFixture"):
+    receivers = [rdisq_message_fixture.spawn_receiver(message_class=LookupMessage) for _ in range(3)]
+    handled_by: Dict[str, Set[str]] = {}
+    for i in range(6):
+        key = f"key{i % 3}"
+        request = RdisqRequest(LookupMessage(key)).send_async()
+        rdisq_message_fixture.process_all_receivers()
+        assert request.wait(1) == key
+        handled_by.setdefault(key, set()).add(request.response.response_payload.service_uid)
+    assert all(len(uids) == 1 for uids in handled_by.values())
+    assert {uid for uids in handled_by.values() for uid in uids} <= {r.uid for r in receivers}
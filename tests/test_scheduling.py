@@ -0,0 +1,27 @@
+from collections import Counter
+
+from rdisq.scheduling import QueueScheduler, WEIGHTED_POLICY
+
+
+def test_priority_order():
+    scheduler = QueueScheduler()
+    scheduler.set_queue_priority("high", priority=5)
+    scheduler.set_queue_priority("low", priority=-1)
+    assert scheduler.order(frozenset({"low", "b", "high", "a"})) == ["high", "a", "b", "low"]
+
+
+def test_weighted_round_robin():
+    scheduler = QueueScheduler(WEIGHTED_POLICY)
+    scheduler.set_queue_priority("heavy", weight=3)
+    scheduler.set_queue_priority("urgent", priority=1)
+    queues = frozenset({"heavy", "light", "urgent"})
+
+    assert scheduler.order(queues)[0] == "urgent"
+
+    # When every queue always has work, the first of each priority level is the one served
+    served = Counter()
+    for _ in range(40):
+        queue = [q for q in scheduler.order(queues) if q != "urgent"][0]
+        served[queue] += 1
+        scheduler.on_served(queue, queues)
+    assert served == {"heavy": 30, "light": 10}
@@ -0,0 +1,73 @@
+import threading
+import time
+
+import pytest
+
+from rdisq.request.rdisq_request import RdisqRequest
+from rdisq.identification import get_stream_ack_key
+from tests._messages import CountMessage
+from tests._services import StreamingWorker
+
+
+@pytest.fixture
+def streaming_worker():
+    worker = StreamingWorker()
+    worker.get_redis().flushdb()
+    StreamingWorker.produced = 0
+    threading.Thread(group=None, target=worker.process).start()
+    yield worker
+    worker.stop()
+    worker.wait_for_process_to_stop(5)
+
+
+def test_stream(streaming_worker):
+    consumer = StreamingWorker.get_async_consumer()
+    assert list(consumer.count(5).stream()) == [0, 1, 2, 3, 4]
+    assert consumer.count(5).wait() == [0, 1, 2, 3, 4]
+    assert list(consumer.count(0).stream()) == []
+
+    values = consumer.count(5, fail_at=3).stream()
+    assert [next(values) for _ in range(3)] == [0, 1, 2]
+    with pytest.raises(ValueError):
+        next(values)
+    with pytest.raises(ValueError):
+        consumer.count(5, fail_at=3).wait()
+
+
+def test_stream_flow_control(streaming_worker):
+    values = StreamingWorker.get_async_consumer().count(100).stream()
+    assert next(values) == 0
+    time.sleep(0.3)
+    # The worker is at most stream_window values ahead of what was read
+    assert StreamingWorker.produced <= 1 + StreamingWorker.stream_window
+    assert next(values) == 1
+    values.close()
+    time.sleep(0.3)
+    assert StreamingWorker.produced < 100
+    assert not streaming_worker.get_redis().keys(get_stream_ack_key("*"))
+
+
+def test_stream_message(rdisq_message_fixture):
+    receiver = rdisq_message_fixture.spawn_receiver(message_class=CountMessage)
+    request = RdisqRequest(CountMessage(3)).send_async()
+    receiver.rdisq_process_one(1)
+    assert list(request.response.stream()) == [0, 1, 2]
+
+
+def test_unread_stream(streaming_worker):
+    streaming_worker.stream_ack_timeout = 1
+    consumer = StreamingWorker.get_async_consumer()
+    consumer.count(100)
+    # The worker gives up on a caller that doesn't read, and serves the next call
+    assert consumer.count(2).wait(3) == [0, 1]
+    # Waiting for the caller isn't handler latency
+    assert streaming_worker.get_load().latency_ewma < 0.5
+
+
+def test_cancel_stream(streaming_worker):
+    consumer = StreamingWorker.get_async_consumer()
+    response = consumer.count(100)
+    time.sleep(0.3)
+    response.cancel()
+    assert consumer.count(2).wait(1) == [0, 1]
+    assert StreamingWorker.produced < 100
@@ -2,11 +2,18 @@
 if __name__ == "__main__" and __package__ is None:
     __package__ = "tests"
 
+import os
+import subprocess
+import sys
 import threading
+import time
 from unittest.mock import Mock, patch
 import pytest
 from examples.simple.worker import SimpleWorker, GrumpyException
 from examples.complex.complex_worker import ComplexWorker
+from rdisq.consumer import RdisqAsyncConsumer
+from rdisq.hedging import HedgingPolicy
+from tests._services import LookupWorker, StallingWorker, MathWorker
 
 
 @pytest.fixture
@@ -34,6 +41,20 @@ def complex_worker():
     _worker.stop()
 
 
+@pytest.fixture
+def lookup_worker():
+    _worker = LookupWorker()
+    _worker.get_redis().flushdb()
+    _processor = threading.Thread(
+        group=None,
+        target=_worker.process
+    )
+    _processor.start()
+    yield _worker
+    _worker.stop()
+    _worker.wait_for_process_to_stop(5)
+
+
 def test_simple_positive(simple_worker):
     assert SimpleWorker.get_consumer().add(1, 2) == 3
     assert SimpleWorker.get_consumer().build("a house")['message from the worker'] == "I'm done!"
@@ -63,3 +84,86 @@ def test_complex_positive(complex_worker):
     # # If we go async, we can tell the processing time and the total roundtrip time
     # consumer.add_log("Got: %d, Processed in %f seconds, total seconds: %f" % (
     #     result, async.process_time_seconds, async.total_time_seconds,))
+
+
+def test_cached_remote_method(lookup_worker):
+    LookupWorker.lookup_count = 0
+    consumer = LookupWorker.get_consumer()
+    assert consumer.lookup("a") == "A"
+    assert consumer.lookup("a") == "A"
+    assert consumer.lookup(key="a") == "A"
+    assert LookupWorker.lookup_count == 2  # kwargs are keyed separately from positional args
+
+    consumer.invalidate_cache("lookup")
+    assert consumer.lookup("a") == "A"
+    assert LookupWorker.lookup_count == 3
+
+    LookupWorker.redis_dispatcher.enable_local_cache()
+    try:
+        assert consumer.lookup("b") == "B"
+        LookupWorker.redis_dispatcher.get_redis().flushdb()
+        assert consumer.lookup("b") == "B"  # served from the local cache
+        assert LookupWorker.lookup_count == 4
+    finally:
+        LookupWorker.redis_dispatcher.result_cache.local_cache = None
+
+
+def test_call_digest_is_stable_across_processes():
+    script = ("from rdisq.cache import get_call_digest; from rdisq.serialization import PickleSerializer; "
+              "print(get_call_digest(PickleSerializer(), ({'a', 'b', 'c', 'd'},), {'tags': frozenset(range(5))}))")
+    digests = {subprocess.check_output([sys.executable, "-c", script], env=dict(os.environ, PYTHONHASHSEED=seed))
+               for seed in ("1", "2", "3")}
+    assert len(digests) == 1
+
+
+def test_presence(lookup_worker):
+    lookup_worker.wait_for_process_to_start(3)
+    time.sleep(1.5)
+    assert LookupWorker.list_uids() == [lookup_worker.uid]
+    assert LookupWorker.count_uids() == 1
+    assert LookupWorker.count_uids(window_seconds=0) == 0
+
+    lookup_worker.stop()
+    lookup_worker.wait_for_process_to_stop(5)
+    assert LookupWorker.list_uids() == []
+
+
+def test_hedged_consumer():
+    stalled, fast = StallingWorker(delay=2), StallingWorker()
+    stalled.get_redis().flushdb()
+    threading.Thread(group=None, target=stalled.process).start()
+    stalled.wait_for_process_to_start(3)
+    try:
+        policy = HedgingPolicy(initial_delay=0.3)
+        response = RdisqAsyncConsumer(StallingWorker, hedging=policy).stall()
+        time.sleep(0.1)  # Taken by the stalled worker
+        threading.Thread(group=None, target=fast.process).start()
+        assert response.wait(2) == fast.uid
+        assert policy.get_stats()["stall"].hedge_wins == 1
+    finally:
+        for w in [stalled, fast]:
+            w.stop()
+            w.wait_for_process_to_stop(5)
+
+
+def test_process_loop_exception():
+    worker = MathWorker()
+    worker.presence_interval_seconds = 0.1
+    errors = []
+
+    def process():
+        try:
+            worker.process()
+        except ConnectionError as ex:
+            errors.append(ex)
+
+    with patch.object(worker, "_on_process_loop", side_effect=[None, ConnectionError()]):
+        processor = threading.Thread(group=None, target=process)
+        processor.start()
+        processor.join(3)
+    assert not processor.is_alive()
+    assert len(errors) == 1
+    # A crashed worker no longer reports it's live
+    assert worker.uid not in MathWorker.list_uids()
+    time.sleep(0.3)
+    assert worker.uid not in MathWorker.list_uids()